@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Protocol, Tuple
+import threading
+
+
+class PagedFile(Protocol):
+    """
+    A file the buffer pool can cache pages for. Implementations own the
+    on-disk encoding; the pool only tracks recency and dirtiness.
+    """
+
+    def read_page(self, page_no: int) -> Any:
+        pass
+
+    def write_pages(self, page_no: int, pages: List[Any]):
+        """write a run of contiguous pages starting at page_no"""
+        pass
+
+
+class BufferPool:
+    """
+    Bounded LRU cache of pages shared by every file of a database.
+
+    - dirty pages are written back on eviction and flush()
+    - before_write, if set, is called before any page is written back. A
+      write-ahead log uses it to make sure it is durable first.
+    - threadsafe, but the pages themselves are not locked
+    """
+
+    DEFAULT_SIZE = 1024  # pages
+
+    def __init__(self, size: int = DEFAULT_SIZE):
+        if size < 1:
+            raise ValueError("buffer pool size must be positive")
+        self._size = size
+        # (file, page_no) -> [page, dirty]
+        self._pages = OrderedDict()  # type: OrderedDict[Tuple[PagedFile, int], List]
+        self._lock = threading.RLock()
+        self.before_write = None  # type: Optional[Callable[[], None]]
+        self.hits = 0
+        self.misses = 0
+
+    def size(self) -> int:
+        return self._size
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get(self, file: PagedFile, page_no: int) -> Any:
+        key = (file, page_no)
+        with self._lock:
+            entry = self._pages.get(key, None)
+            if entry is not None:
+                self.hits += 1
+                self._pages.move_to_end(key)
+                return entry[0]
+            self.misses += 1
+            page = file.read_page(page_no)
+            self._insert(key, page, False)
+            return page
+
+    def put(self, file: PagedFile, page_no: int, page: Any, dirty: bool = True):
+        key = (file, page_no)
+        with self._lock:
+            if key in self._pages:
+                entry = self._pages[key]
+                entry[0] = page
+                entry[1] = entry[1] or dirty
+                self._pages.move_to_end(key)
+            else:
+                self._insert(key, page, dirty)
+
+    def mark_dirty(self, file: PagedFile, page_no: int):
+        with self._lock:
+            entry = self._pages.get((file, page_no), None)
+            if entry is None:
+                raise KeyError("page {} is not cached".format(page_no))
+            entry[1] = True
+
+    def flush(self, file: Optional[PagedFile] = None):
+        """write back dirty pages, coalescing contiguous pages into one write"""
+        with self._lock:
+            dirty = {}  # type: Dict[PagedFile, List[int]]
+            for (owner, page_no), entry in self._pages.items():
+                if entry[1] and (file is None or owner is file):
+                    dirty.setdefault(owner, []).append(page_no)
+            if dirty and self.before_write:
+                self.before_write()
+            for owner, page_nos in dirty.items():
+                page_nos.sort()
+                start = 0
+                for i in range(1, len(page_nos) + 1):
+                    if i == len(page_nos) or page_nos[i] != page_nos[i - 1] + 1:
+                        run = page_nos[start:i]
+                        owner.write_pages(
+                            run[0], [self._pages[(owner, p)][0] for p in run]
+                        )
+                        for p in run:
+                            self._pages[(owner, p)][1] = False
+                        start = i
+
+    def write_through(self, file: PagedFile, page_no: int, pages: List[Any]):
+        """write a run of pages straight to the file, bypassing the cache"""
+        with self._lock:
+            if self.before_write:
+                self.before_write()
+            file.write_pages(page_no, pages)
+            for i in range(len(pages)):
+                self._pages.pop((file, page_no + i), None)
+
+    def discard(self, file: PagedFile):
+        """drop every cached page of file without writing it back"""
+        with self._lock:
+            for key in [key for key in self._pages if key[0] is file]:
+                del self._pages[key]
+
+    def _insert(self, key, page, dirty):
+        while len(self._pages) >= self._size:
+            self._evict()
+        self._pages[key] = [page, dirty]
+
+    def _evict(self):
+        key, (page, dirty) = next(iter(self._pages.items()))
+        file, page_no = key
+        if dirty:
+            if self.before_write:
+                self.before_write()
+            file.write_pages(page_no, [page])
+        del self._pages[key]
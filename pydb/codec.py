@@ -0,0 +1,149 @@
+import pickle
+import struct
+from typing import Any, Callable, Protocol, Tuple
+
+from .table import DataType, Schema, check_type
+
+
+class Codec(Protocol):
+    """
+    Encodes rows to bytes and back. decode() takes any bytes-like object,
+    including a memoryview. They're attributes rather than methods so a
+    codec can set them to functions it generates.
+    """
+
+    NAME: str
+    encode: Callable[[Tuple], bytes]
+    decode: Callable[[Any], Tuple]
+
+
+class PickleCodec(Codec):
+    """Encodes arbitrary tuples. Used when there is no schema."""
+
+    NAME = "pickle"
+
+    def encode(self, row):
+        return pickle.dumps(row)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class RowCodec(Codec):
+    """
+    Binary row encoding compiled from a Schema.
+
+    [null mask][INT: int64 | STRING: uint32 length]...[utf-8 string area]
+
+    The null mask has one bit per column; null columns are zero in the fixed
+    part. String lengths count characters, so the string area is encoded and
+    decoded with a single call and split by slicing. Specialized encode and
+    decode functions are generated for each schema.
+    """
+
+    NAME = "row"
+    FIXED_TYPES = {DataType.INT: "q", DataType.STRING: "L"}
+    MASK_TYPES = ((8, "B"), (16, "H"), (32, "L"), (64, "Q"))
+
+    def __init__(self, schema: Schema):
+        self._schema = schema
+        self._ncols = len(schema.columns)
+        mask = next((fmt for n, fmt in self.MASK_TYPES if self._ncols <= n), None)
+        if not mask:
+            raise ValueError("too many columns: {}".format(self._ncols))
+        for col in schema.columns:
+            if col.dtype not in self.FIXED_TYPES:
+                raise ValueError("unsupported dtype: {}".format(col.dtype))
+        self._fixed = struct.Struct(
+            "<" + mask + "".join(self.FIXED_TYPES[col.dtype] for col in schema.columns)
+        )
+        self._strings = tuple(
+            i for i, col in enumerate(schema.columns) if col.dtype == DataType.STRING
+        )
+        self.encode, self.decode = self._compile()
+
+    def _compile(self):
+        cols = ["c{}".format(i) for i in range(self._ncols)]
+        fixed = [
+            "len({})".format(col) if i in self._strings else col
+            for i, col in enumerate(cols)
+        ]
+        strings = [cols[i] for i in self._strings]
+        area = '({}).encode("utf-8")'.format(" + ".join(strings)) if strings else ""
+
+        encode = [
+            "def encode(row):",
+            "    if None in row:",
+            "        return encode_nulls(row)",
+            "    try:",
+            "        {}, = row".format(", ".join(cols)),
+            "        return pack(0, {}){}".format(
+                ", ".join(fixed), " + " + area if area else ""
+            ),
+            "    except (TypeError, ValueError, struct.error) as err:",
+            "        raise encode_error(row, err)",
+        ]
+
+        fields = [
+            "n{}".format(i) if i in self._strings else col for i, col in enumerate(cols)
+        ]
+        decode = [
+            "def decode(data):",
+            "    mask, {}, = unpack_from(data, 0)".format(", ".join(fields)),
+            "    if mask:",
+            "        return decode_nulls(data)",
+        ]
+        if strings:
+            decode.append('    s = str(data[{}:], "utf-8")'.format(self._fixed.size))
+            end = "0"
+            for i in self._strings:
+                decode.append("    {} = s[{}:{} + n{}]".format(cols[i], end, end, i))
+                end = "{} + n{}".format(end, i) if end != "0" else "n{}".format(i)
+        decode.append("    return ({},)".format(", ".join(cols)))
+
+        scope = {
+            "struct": struct,
+            "pack": self._fixed.pack,
+            "unpack_from": self._fixed.unpack_from,
+            "encode_nulls": self._encode_nulls,
+            "encode_error": self._encode_error,
+            "decode_nulls": self._decode_nulls,
+        }
+        exec("\n".join(encode + decode), scope)
+        return scope["encode"], scope["decode"]
+
+    def _encode_nulls(self, row):
+        self._check_types(row)
+        mask = 0
+        fixed = list(row)
+        strings = []
+        for i, val in enumerate(row):
+            if val is None:
+                mask |= 1 << i
+                fixed[i] = 0
+            elif i in self._strings:
+                fixed[i] = len(val)
+                strings.append(val)
+        return self._fixed.pack(mask, *fixed) + "".join(strings).encode("utf-8")
+
+    def _decode_nulls(self, data):
+        mask, *row = self._fixed.unpack_from(data, 0)
+        area = str(data[self._fixed.size :], "utf-8")
+        pos = 0
+        for i in range(self._ncols):
+            if mask >> i & 1:
+                row[i] = None
+            elif i in self._strings:
+                row[i], pos = area[pos : pos + row[i]], pos + row[i]
+        return tuple(row)
+
+    def _encode_error(self, row, err):
+        if len(row) != self._ncols:
+            return ValueError("expected {} columns".format(self._ncols))
+        self._check_types(row)
+        return ValueError("can't encode row: {}".format(err))
+
+    def _check_types(self, row):
+        for col, val in zip(self._schema.columns, row):
+            if val is not None:
+                check_type(col.dtype, val)
@@ -10,6 +10,6 @@ def connect(url, *flags, **options) -> Database:
     if url.scheme == "mem":
         return MemDatabase(url.path)
     elif url.scheme in ("disk", ""):
-        return DiskDatabase.open(url.path)
+        return DiskDatabase.open(url.path, **options)
     else:
         raise ValueError("unrecognized scheme: {}".format(url.scheme))
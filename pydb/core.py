@@ -17,6 +17,10 @@ class Database(Protocol):
     def exec(self, query: Union[Text, Query], **options) -> Cursor:
         pass
 
+    def prepare(self, query: Union[Text, Query], **options):
+        """a PreparedStatement of a Select with Params, see pydb.prepared"""
+        pass
+
     def delete(self):
         pass
 
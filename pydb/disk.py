@@ -1,59 +1,224 @@
 from dataclasses import dataclass
 from typing import (
+    Any,
+    Callable,
+    Iterable,
     Iterator,
     Optional,
+    Set,
     Tuple,
     List,
     Sequence,
+    Union,
 )
-import io
+from array import array
+from contextlib import contextmanager
+import functools
+import mmap
 import os
 import pickle
 import struct
-from .core import Database
-from .index import Index
-from .table import ITable, Schema
+import threading
+import zlib
+from .buffer import BufferPool
+from .codec import Codec, PickleCodec, RowCodec
 from .core import Cursor, Database
-from .index import Index
+from .explain import explain_query
+from .expr import Expr, unbatched
+from .index import BitmapIndex, BTreeIndex, Index, IndexKind, MultiSortedIndex
 from .parse import parse_query
-from .plan import SimplePlanner
-from .query import CreateTable, Insert, Select
-from .table import Dict, ITable, Schema, check_schema
+from .pipeline import compile_pipeline
+from .plan import CostBasedPlanner
+from .prepared import PlanCache, PreparedStatement, plan_key
+from .query import (
+    Analyze,
+    CreateIndex,
+    CreateTable,
+    Explain,
+    Insert,
+    InsertMany,
+    Select,
+)
+from .stats import TableStats, analyze
+from .table import (
+    Dict,
+    IndexDef,
+    ITable,
+    Schema,
+    check_index_def,
+    check_schema,
+    is_unique,
+)
+from .wal import LogOp, LogRecord, WriteAheadLog
 
 
 @dataclass
 class RowHeader:
-    SIZE = 5
+    SIZE = 13
+    FORMAT = struct.Struct("<L?Q")
     size: int
     tombstone: bool
+    rowid: int = 0
 
     def write(self, w):
-        w.write(struct.pack("<L?", self.size, self.tombstone))
+        w.write(self.FORMAT.pack(self.size, self.tombstone, self.rowid))
+
+    def pack_into(self, buf, offset: int):
+        self.FORMAT.pack_into(buf, offset, self.size, self.tombstone, self.rowid)
 
     @classmethod
     def read(cls, r):
-        size, tombstone = struct.unpack("<L?", r.read(cls.SIZE))
-        return RowHeader(size, tombstone)
+        return RowHeader(*cls.FORMAT.unpack(r.read(cls.SIZE)))
+
+    @classmethod
+    def unpack_from(cls, buf, offset: int):
+        return RowHeader(*cls.FORMAT.unpack_from(buf, offset))
+
+
+class Page:
+    """
+    Slotted page.
+
+    [num_slots][free_end][slot 0]..[slot n-1] ... free ... [record n-1]..[record 0]
+
+    Slots hold the page offset of their record and grow up from the front.
+    Records are a RowHeader followed by the payload and grow down from the
+    back. Slots are never reused, so (page_no, slot) stays a stable address.
+    """
+
+    HEADER = struct.Struct("<HH")
+    SLOT = struct.Struct("<H")
+
+    def __init__(self, data: Union[bytearray, memoryview]):
+        self.data = data
+
+    @classmethod
+    def empty(cls, size: int) -> "Page":
+        return Page(cls.empty_data(size))
+
+    @classmethod
+    def empty_data(cls, size: int) -> bytearray:
+        data = bytearray(size)
+        cls.HEADER.pack_into(data, 0, 0, size)
+        return data
+
+    @classmethod
+    def capacity(cls, size: int) -> int:
+        """largest payload that fits on an empty page"""
+        return size - cls.HEADER.size - cls.SLOT.size - RowHeader.SIZE
+
+    def num_slots(self) -> int:
+        return self.HEADER.unpack_from(self.data, 0)[0]
+
+    def free_space(self) -> int:
+        num_slots, free_end = self.HEADER.unpack_from(self.data, 0)
+        return free_end - self.HEADER.size - num_slots * self.SLOT.size
+
+    def insert(self, payload, rowid: int = 0) -> Optional[int]:
+        """returns the new slot or None if the page is full"""
+        num_slots, free_end = self.HEADER.unpack_from(self.data, 0)
+        size = RowHeader.SIZE + len(payload)
+        slot_end = self.HEADER.size + (num_slots + 1) * self.SLOT.size
+        if free_end - size < slot_end:
+            return None
+        offset = free_end - size
+        RowHeader.FORMAT.pack_into(self.data, offset, len(payload), False, rowid)
+        self.data[offset + RowHeader.SIZE : free_end] = payload
+        self.SLOT.pack_into(self.data, slot_end - self.SLOT.size, offset)
+        self.HEADER.pack_into(self.data, 0, num_slots + 1, offset)
+        return num_slots
+
+    def header(self, slot: int) -> RowHeader:
+        return RowHeader.unpack_from(self.data, self._offset(slot))
+
+    def read(self, slot: int) -> Tuple[RowHeader, memoryview]:
+        offset = self._offset(slot)
+        header = RowHeader.unpack_from(self.data, offset)
+        start = offset + RowHeader.SIZE
+        return header, memoryview(self.data)[start : start + header.size]
+
+    def remove(self, slot: int) -> bool:
+        """returns False if the record was already removed"""
+        offset = self._offset(slot)
+        header = RowHeader.unpack_from(self.data, offset)
+        if header.tombstone:
+            return False
+        header.tombstone = True
+        header.pack_into(self.data, offset)
+        return True
+
+    def _offset(self, slot: int) -> int:
+        if slot >= self.num_slots():
+            raise ValueError("bad slot {}".format(slot))
+        pos = self.HEADER.size + slot * self.SLOT.size
+        return self.SLOT.unpack_from(self.data, pos)[0]
 
 
-# TODO: Minimize seeks
-# TODO: Prefix file with HEADER
 class HeapFile:
     """
+    Heap of records stored in slotted pages.
+
+    Page 0 holds HEADER followed by the name of the codec used to encode
+    records; a file can only be opened with the codec it was created with.
+    STATS at the end of page 0 holds the file's generation, which compaction
+    bumps, and the bytes taken up by removed records. The latter is only
+    written back on flush, so it is an estimate after a crash. Each record
+    header also stores the rowid it was appended with.
+
+    Records are addressed by offset = page_no * PAGE_SIZE + slot. Pages are
+    read and written through a BufferPool, which may be shared with other
+    files.
+
+    With use_mmap, the file is mapped instead and pages are memoryviews of the
+    mapping: records are decoded straight out of the OS page cache and writes
+    land in it directly. The pool is bypassed.
+
     - not threadsafe
     - at most one open instance of the file at any time
     """
 
     MAGIK = "hfmagik"
-    VERSION = 1
+    VERSION = 5
     HEADER = "{} v{}".format(MAGIK, VERSION).encode("utf-8")
-    PREFIX_SIZE = 4
+    PAGE_SIZE = 8192
+    STATS = struct.Struct("<QQ")  # generation, dead bytes
+    STATS_OFFSET = PAGE_SIZE - STATS.size
 
-    def __init__(self, file):
+    def __init__(
+        self,
+        file,
+        pool: BufferPool,
+        use_mmap: bool = False,
+        codec: Optional[Codec] = None,
+    ):
         self._file = file
+        self._fd = file.fileno()
+        self.path = file.name
+        self._pool = pool
+        self._codec = codec or PickleCodec()
+        self._mmap = None  # type: Optional[mmap.mmap]
+        self._view = None  # type: Optional[memoryview]
+        self._generation = 0
+        self._dead_bytes = 0
+        self.bytes_read = 0  # of records, by get() and scan()
+        self._num_pages = os.fstat(self._fd).st_size // self.PAGE_SIZE
+        if self._num_pages == 0:
+            self._write_header()
+            self._num_pages = 1
+        else:
+            self._check_header()
+        if use_mmap:
+            # drop a trailing partial page so the mapping is page aligned
+            os.ftruncate(self._fd, self._num_pages * self.PAGE_SIZE)
+            self._remap()
 
     @staticmethod
-    def open(path: str):
+    def open(
+        path: str,
+        pool: Optional[BufferPool] = None,
+        use_mmap: bool = False,
+        codec: Optional[Codec] = None,
+    ):
         # We want read/write/create if DNE. Incredibly, no mode seems to
         # accomplish this. WTF. I thought I understood you unix. Alas,
         # it's not me it's you.
@@ -61,87 +226,650 @@ class HeapFile:
         #   'w' modes truncate if it exists
         #   'a' modes only allow appends so seek()+write() doesn't work D:
         mode = "rb+" if os.path.exists(path) else "wb+"
-        return HeapFile(open(path, mode))
+        file = open(path, mode, buffering=0)
+        try:
+            return HeapFile(file, pool or BufferPool(), use_mmap, codec)
+        except:
+            file.close()
+            raise
+
+    def flush(self):
+        self._write_stats()
+        if self._mmap is not None:
+            self._mmap.flush()
+        else:
+            self._pool.flush(self)
+
+    def sync(self):
+        """flush and wait for the file to reach the disk"""
+        self.flush()
+        os.fsync(self._fd)
 
     def close(self):
-        self._file.close()
+        try:
+            self.flush()
+        finally:
+            self._pool.discard(self)
+            if self._mmap is not None:
+                self._unmap()
+            self._file.close()
+
+    def create_empty(self, path: str) -> "HeapFile":
+        """
+        A new, empty file at path with the same pool, codec and mapping mode
+        and the next generation. Replaces any existing file.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        file = HeapFile.open(path, self._pool, self._mmap is not None, self._codec)
+        file.set_generation(self._generation + 1)
+        return file
+
+    def rename(self, path: str):
+        """atomically replace path with this file"""
+        os.replace(self.path, path)
+        folder = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(folder)
+        finally:
+            os.close(folder)
+        self.path = path
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._file.close()
+        self.close()
+
+    def read_page(self, page_no: int) -> bytearray:
+        data = os.pread(self._fd, self.PAGE_SIZE, page_no * self.PAGE_SIZE)
+        if len(data) < self.PAGE_SIZE:
+            # allocated page that was never written back
+            return Page.empty_data(self.PAGE_SIZE)
+        return bytearray(data)
+
+    def write_pages(self, page_no: int, pages: List[bytearray]):
+        data = pages[0] if len(pages) == 1 else b"".join(pages)
+        os.pwrite(self._fd, data, page_no * self.PAGE_SIZE)
+
+    def num_pages(self) -> int:
+        return self._num_pages
+
+    def generation(self) -> int:
+        return self._generation
 
-    def append(self, record: Tuple) -> int:
-        self._file.seek(0, io.SEEK_END)  # TODO: avoid seek
-        offset = self._file.tell()
-        data = pickle.dumps(record)
-        header = RowHeader(size=len(data), tombstone=False)
-        header.write(self._file)
-        self._file.write(data)
-        return offset
+    def set_generation(self, generation: int):
+        self._generation = generation
+
+    def dead_space(self) -> float:
+        """fraction of the record pages taken up by removed records"""
+        if self._num_pages <= 1:
+            return 0.0
+        return self._dead_bytes / ((self._num_pages - 1) * self.PAGE_SIZE)
+
+    def append(self, record: Tuple, rowid: int = 0) -> int:
+        data = self._codec.encode(record)
+        if len(data) > Page.capacity(self.PAGE_SIZE):
+            raise ValueError("record too large: {} bytes".format(len(data)))
+        page_no = self._num_pages - 1
+        slot = None
+        if page_no > 0:
+            slot = self._page(page_no).insert(data, rowid)
+        if slot is None:
+            page_no = self._num_pages
+            slot = self._alloc_page().insert(data, rowid)
+            assert slot is not None  # fits an empty page, checked above
+        self._mark_dirty(page_no)
+        return page_no * self.PAGE_SIZE + slot
+
+    def append_many(self, records: Sequence[Tuple], rowid: int = 0) -> List[int]:
+        """
+        Appends records with consecutive rowids starting at rowid. Records
+        that don't fit on the last page are laid out on new pages which are
+        written with a single write.
+        """
+        return self.append_encoded(
+            self.encode(records), range(rowid, rowid + len(records))
+        )
+
+    def encode(self, records: Sequence[Tuple]) -> List[bytes]:
+        """raises ValueError if any record can't be appended"""
+        encoded = [self._codec.encode(record) for record in records]
+        capacity = Page.capacity(self.PAGE_SIZE)
+        for data in encoded:
+            if len(data) > capacity:
+                raise ValueError("record too large: {} bytes".format(len(data)))
+        return encoded
+
+    def append_encoded(self, encoded: List[bytes], rowids: Sequence[int]) -> List[int]:
+        """append_many() for the result of encode(), with a rowid per record"""
+        offsets = []  # type: List[int]
+        i = 0
+        if self._num_pages > 1:
+            page_no = self._num_pages - 1
+            page = self._page(page_no)
+            for i, data in enumerate(encoded):
+                slot = page.insert(data, rowids[i])
+                if slot is None:
+                    break
+                offsets.append(page_no * self.PAGE_SIZE + slot)
+            else:
+                i = len(encoded)
+            if offsets:
+                self._mark_dirty(page_no)
+        first_page = page_no = self._num_pages
+        pages = []  # type: List[bytearray]
+        new_page = None  # type: Optional[Page]
+        for i in range(i, len(encoded)):
+            slot = new_page.insert(encoded[i], rowids[i]) if new_page else None
+            if slot is None:
+                page_no = first_page + len(pages)
+                pages.append(Page.empty_data(self.PAGE_SIZE))
+                new_page = Page(pages[-1])
+                slot = new_page.insert(encoded[i], rowids[i])
+                assert slot is not None  # fits an empty page, see encode()
+            offsets.append(page_no * self.PAGE_SIZE + slot)
+        if pages:
+            self._num_pages += len(pages)
+            if self._mmap is None:
+                self._pool.write_through(self, first_page, pages)
+            else:
+                os.ftruncate(self._fd, self._num_pages * self.PAGE_SIZE)
+                self._remap()
+                assert self._view is not None
+                start = first_page * self.PAGE_SIZE
+                end = start + len(pages) * self.PAGE_SIZE
+                self._view[start:end] = b"".join(pages)
+        return offsets
 
     def get(self, offset: int) -> Tuple:
-        self._file.seek(offset)
-        header, record = self._iget()
+        page_no, slot = self._locate(offset)
+        header, data = self._page(page_no).read(slot)
         if header.tombstone:
             raise ValueError("row is removed")
-        return record
-
-    def _iget(self):
-        header = RowHeader.read(self._file)
-        if header.tombstone:
-            self._file.seek(header.size, io.SEEK_CUR)
-            return header, None
-        data = self._file.read(header.size)
-        record = pickle.loads(data)
-        return header, record
+        self.bytes_read += len(data)
+        return self._codec.decode(data)
 
     def remove(self, offset: int):
-        self._file.seek(offset)
-        header = RowHeader.read(self._file)
-        if not header.tombstone:
-            header.tombstone = True
-            self._file.seek(offset)
-            header.write(self._file)
+        page_no, slot = self._locate(offset)
+        page = self._page(page_no)
+        if page.remove(slot):
+            self._mark_dirty(page_no)
+            size = page.header(slot).size
+            self._dead_bytes += Page.SLOT.size + RowHeader.SIZE + size
 
     def scan(self, start=0) -> Iterator[Tuple[int, Tuple]]:
-        self._file.seek(0, io.SEEK_END)
-        end = self._file.tell()
-        self._file.seek(start)
-        offset = start
-        while offset < end:
-            header, record = self._iget()
-            if not header.tombstone:
-                yield offset, record
-            offset = self._file.tell()
-
-    # TODO: allow append(), get() while iterating
+        end = self._num_pages
+        page_no, slot = divmod(start, self.PAGE_SIZE)
+        page_no = max(page_no, 1)
+        while page_no < end:
+            page = self._page(page_no)
+            for slot in range(slot, page.num_slots()):
+                header, data = page.read(slot)
+                if not header.tombstone:
+                    self.bytes_read += len(data)
+                    yield page_no * self.PAGE_SIZE + slot, self._codec.decode(data)
+            page_no += 1
+            slot = 0
+
     def __iter__(self) -> Iterator[Tuple[int, Tuple]]:
         return self.scan()
 
+    def offsets(self) -> Iterator[Tuple[int, RowHeader]]:
+        """yields (offset, header) for every record without decoding it"""
+        for page_no in range(1, self._num_pages):
+            page = self._page(page_no)
+            for slot in range(page.num_slots()):
+                yield page_no * self.PAGE_SIZE + slot, page.header(slot)
+
+    def payloads(self, start: int, end: int) -> Iterator[Tuple[int, bytes]]:
+        """yields (rowid, encoded record) for live records on pages [start, end)"""
+        for page_no in range(max(start, 1), min(end, self._num_pages)):
+            page = self._page(page_no)
+            for slot in range(page.num_slots()):
+                header, data = page.read(slot)
+                if not header.tombstone:
+                    yield header.rowid, bytes(data)
+
+    def _write_header(self):
+        header = bytearray(self.PAGE_SIZE)
+        data = self.HEADER + b"\0" + self._codec.NAME.encode("utf-8") + b"\0"
+        header[: len(data)] = data
+        self.STATS.pack_into(header, self.STATS_OFFSET, 0, 0)
+        self.write_pages(0, [header])
+
+    def _check_header(self):
+        header = bytes(self.read_page(0))
+        magik, _, rest = header.partition(b" v")
+        if magik != self.MAGIK.encode("utf-8"):
+            raise ValueError("unrecognized heap file header")
+        version, _, rest = rest.partition(b"\0")
+        if version != str(self.VERSION).encode("utf-8"):
+            raise ValueError("unsupported heap file version {}".format(version))
+        codec = rest.partition(b"\0")[0].decode("utf-8")
+        if codec != self._codec.NAME:
+            raise ValueError("heap file is encoded with {} codec".format(codec))
+        stats = self.STATS.unpack_from(header, self.STATS_OFFSET)
+        self._generation, self._dead_bytes = stats
+
+    def _write_stats(self):
+        page = self._page(0)
+        stats = (self._generation, self._dead_bytes)
+        if self.STATS.unpack_from(page.data, self.STATS_OFFSET) != stats:
+            self.STATS.pack_into(page.data, self.STATS_OFFSET, *stats)
+            self._mark_dirty(0)
+
+    def _page(self, page_no: int) -> Page:
+        if self._view is not None:
+            start = page_no * self.PAGE_SIZE
+            return Page(self._view[start : start + self.PAGE_SIZE])
+        return Page(self._pool.get(self, page_no))
+
+    def _alloc_page(self) -> Page:
+        page_no = self._num_pages
+        self._num_pages += 1
+        if self._mmap is None:
+            page = Page.empty(self.PAGE_SIZE)
+            self._pool.put(self, page_no, page.data)
+            return page
+        os.ftruncate(self._fd, self._num_pages * self.PAGE_SIZE)
+        self._remap()
+        page = self._page(page_no)
+        Page.HEADER.pack_into(page.data, 0, 0, self.PAGE_SIZE)
+        return page
+
+    def _mark_dirty(self, page_no: int):
+        if self._mmap is None:
+            self._pool.mark_dirty(self, page_no)
+
+    def _remap(self):
+        if self._mmap is not None:
+            self._unmap()
+        self._mmap = mmap.mmap(self._fd, self._num_pages * self.PAGE_SIZE)
+        self._view = memoryview(self._mmap)
+
+    def _unmap(self):
+        # Pages handed out by scan() may still reference the old mapping. It
+        # stays valid (and coherent, the mapping is shared) until the last of
+        # them is released, so leave it to the garbage collector.
+        assert self._mmap is not None and self._view is not None
+        mapping, view = self._mmap, self._view
+        self._mmap = self._view = None
+        try:
+            view.release()
+            mapping.close()
+        except BufferError:
+            pass
+
+    def _locate(self, offset: int) -> Tuple[int, int]:
+        page_no, slot = divmod(offset, self.PAGE_SIZE)
+        if not 0 < page_no < self._num_pages:
+            raise ValueError("bad offset {}".format(offset))
+        return page_no, slot
+
+
+class HeapRange(ITable):
+    """
+    The rows on pages [start, end) of a heap file, read straight from the
+    file rather than through an open HeapFile, so that other processes can
+    scan it. Records never span pages, so page ranges of a file split its
+    rows. It has no indexes and can only be scanned.
+    """
+
+    READ_PAGES = 32  # pages read at a time
+
+    def __init__(self, schema: Schema, path: str, start: int, end: int):
+        self._schema = schema
+        self.path = path
+        self.start = start
+        self.end = end
+
+    def schema(self):
+        return self._schema
+
+    def insert(self, row: Tuple) -> Tuple[int, Tuple]:
+        raise ValueError("a HeapRange is read only")
+
+    def delete(self, rowid: int):
+        raise ValueError("a HeapRange is read only")
+
+    def get(self, rowid: int) -> Optional[Tuple]:
+        raise ValueError("a HeapRange can only be scanned")
+
+    def index_defs(self) -> Sequence[Tuple[IndexDef, Index]]:
+        return ()
+
+    def create_index(self, definition: IndexDef) -> Index:
+        raise ValueError("a HeapRange is read only")
+
+    def rows(self) -> Iterator[Tuple]:
+        decode = RowCodec(self._schema).decode
+        size = HeapFile.PAGE_SIZE
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            for first in range(self.start, self.end, self.READ_PAGES):
+                count = min(self.READ_PAGES, self.end - first)
+                data = memoryview(os.pread(fd, count * size, first * size))
+                for start in range(0, len(data) - size + 1, size):
+                    page = Page(data[start : start + size])
+                    for slot in range(page.num_slots()):
+                        header, payload = page.read(slot)
+                        if not header.tombstone:
+                            yield decode(payload)
+        finally:
+            os.close(fd)
+
+
+class RowIndex:
+    """
+    rowid -> heap file offset, kept in memory as a packed array and persisted
+    next to the heap file.
+
+    [HEADER][offset 0]..[offset n-1]
+
+    Changes are written incrementally on flush(). The header holds the
+    number of rows, a checksum of the offsets and the generation and size of
+    the heap file they describe. It is marked unclean on disk before the
+    first change after a flush, so an index that missed changes (e.g. after
+    a crash) fails validation and is rebuilt from the rowids in the heap's
+    record headers.
+    """
+
+    MAGIK = b"rimagik2"
+    # magik, count, crc32, heap generation, heap pages, clean
+    HEADER = struct.Struct("<8sQLQQ?")
+    REMOVED = -1
+
+    def __init__(self, fd: int, heap: HeapFile, offsets: array, synced: int):
+        self._fd = fd
+        self._heap = heap
+        self._offsets = offsets
+        self._synced = synced  # offsets[:synced] are on disk
+        self._changed_rows = set()  # type: Set[int]
+        self._clean = synced == len(offsets)
+        self._live = len(offsets) - offsets.count(self.REMOVED)
+
+    @staticmethod
+    def open(path: str, heap: HeapFile) -> "RowIndex":
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            offsets = RowIndex._load(fd, heap)
+            if offsets is not None:
+                return RowIndex(fd, heap, offsets, len(offsets))
+            offsets = array("q")
+            for offset, header in heap.offsets():
+                if header.rowid >= len(offsets):
+                    missing = header.rowid + 1 - len(offsets)
+                    offsets.extend([RowIndex.REMOVED] * missing)
+                if not header.tombstone:
+                    offsets[header.rowid] = offset
+            os.ftruncate(fd, RowIndex.HEADER.size)
+            return RowIndex(fd, heap, offsets, 0)
+        except:
+            os.close(fd)
+            raise
+
+    @staticmethod
+    def _load(fd: int, heap: HeapFile) -> Optional[array]:
+        data = os.pread(fd, os.fstat(fd).st_size, 0)
+        if len(data) < RowIndex.HEADER.size:
+            return None
+        header = RowIndex.HEADER.unpack_from(data)
+        magik, count, crc, generation, heap_pages, clean = header
+        body = memoryview(data)[RowIndex.HEADER.size :]
+        offsets = array("q")
+        if (
+            magik != RowIndex.MAGIK
+            or not clean
+            or generation != heap.generation()
+            or heap_pages != heap.num_pages()
+            or len(body) != count * offsets.itemsize
+            or zlib.crc32(body) != crc
+        ):
+            return None
+        offsets.frombytes(body)
+        return offsets
+
+    def flush(self):
+        if self._clean:
+            return
+        itemsize = self._offsets.itemsize
+        for rowid in self._changed_rows:
+            if rowid < self._synced:
+                data = struct.pack("<q", self._offsets[rowid])
+                os.pwrite(self._fd, data, self.HEADER.size + rowid * itemsize)
+        data = self._offsets[self._synced :].tobytes()
+        os.pwrite(self._fd, data, self.HEADER.size + self._synced * itemsize)
+        os.fsync(self._fd)
+        self._synced = len(self._offsets)
+        self._changed_rows.clear()
+        self._write_header(True)
+        os.fsync(self._fd)
+
+    def close(self, flush: bool = True):
+        try:
+            if flush:
+                self.flush()
+        finally:
+            os.close(self._fd)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def live(self) -> int:
+        """number of rowids that aren't removed"""
+        return self._live
+
+    def __getitem__(self, rowid: int) -> Optional[int]:
+        offset = self._offsets[rowid]
+        return None if offset == self.REMOVED else offset
+
+    def append(self, offset: int) -> int:
+        self._changed()
+        self._offsets.append(offset)
+        self._live += 1
+        return len(self._offsets) - 1
+
+    def extend(self, offsets: Sequence[int]) -> range:
+        self._changed()
+        start = len(self._offsets)
+        self._offsets.extend(offsets)
+        self._live += len(offsets)
+        return range(start, len(self._offsets))
+
+    def remove(self, rowid: int):
+        self.put(rowid, self.REMOVED)
+
+    def put(self, rowid: int, offset: int):
+        self._changed()
+        if rowid >= len(self._offsets):
+            self._offsets.extend([self.REMOVED] * (rowid + 1 - len(self._offsets)))
+        self._live += (offset != self.REMOVED) - (self._offsets[rowid] != self.REMOVED)
+        self._offsets[rowid] = offset
+        self._changed_rows.add(rowid)
+
+    def reset(self, heap: HeapFile, offsets: array):
+        """replace every offset, e.g. with those of a rewritten heap file"""
+        self._changed()
+        self._heap = heap
+        self._offsets = offsets
+        self._live = len(offsets) - offsets.count(self.REMOVED)
+        self._synced = 0
+        self._changed_rows.clear()
+        os.ftruncate(self._fd, self.HEADER.size)
+
+    def _changed(self):
+        if self._clean:
+            self._write_header(False)
+            os.fsync(self._fd)
+
+    def _write_header(self, clean: bool):
+        crc = zlib.crc32(self._offsets) if clean else 0
+        header = self.HEADER.pack(
+            self.MAGIK,
+            len(self._offsets),
+            crc,
+            self._heap.generation(),
+            self._heap.num_pages(),
+            clean,
+        )
+        os.pwrite(self._fd, header, 0)
+        self._clean = clean
+
+
+class Compaction:
+    """
+    Copies the live records of a heap file into a new one a few pages at a
+    time, keeping their rowids. The source stays in use meanwhile. Appends
+    only touch its last page, which step() never copies, so rows inserted
+    in between are picked up; rows deleted after they were copied must be
+    passed to remove().
+    """
+
+    def __init__(self, source: HeapFile, target: HeapFile):
+        self._source = source
+        self.target = target
+        self.offsets = array("q")  # rowid -> target offset
+        self._page_no = 1  # next source page to copy
+
+    def step(self, max_pages: int) -> bool:
+        """copy up to max_pages pages. True once only the last page is left"""
+        end = min(self._page_no + max_pages, self._source.num_pages() - 1)
+        self._copy(end)
+        return self._page_no >= self._source.num_pages() - 1
+
+    def finish(self):
+        self._copy(self._source.num_pages())
+
+    def remove(self, rowid: int):
+        if rowid < len(self.offsets) and self.offsets[rowid] != RowIndex.REMOVED:
+            self.target.remove(self.offsets[rowid])
+            self.offsets[rowid] = RowIndex.REMOVED
+
+    def _copy(self, end: int):
+        if end <= self._page_no:
+            return
+        rowids, encoded = [], []
+        for rowid, data in self._source.payloads(self._page_no, end):
+            rowids.append(rowid)
+            encoded.append(data)
+        self._page_no = end
+        if not rowids:
+            return
+        offsets = self.target.append_encoded(encoded, rowids)
+        if rowids[-1] >= len(self.offsets):
+            missing = rowids[-1] + 1 - len(self.offsets)
+            self.offsets.extend([RowIndex.REMOVED] * missing)
+        for rowid, offset in zip(rowids, offsets):
+            self.offsets[rowid] = offset
+
 
-# TODO: Support secondary indexes
 class DiskTable(ITable):
-    def __init__(self, schema: Schema, file: HeapFile, row_index: List[Optional[int]]):
+    """
+    Rows in a HeapFile, addressed through a RowIndex. PRIMARY_KEY and UNIQUE
+    columns are indexed by a BTreeIndex each, stored in <table>.<column>.btree
+    and rebuilt from the rows if it missed changes. Null values aren't
+    indexed.
+
+    Indexes added by create_index() may repeat keys. They are stored in
+    <table>.<column>,...,<column>.btree, keyed by (key, value) and used
+    through a MultiSortedIndex, whatever their IndexKind. BITMAP indexes are
+    the exception: they are kept in memory only and rebuilt on open.
+    """
+
+    BATCH_SIZE = 4096  # rows encoded, logged and written together by insert_many
+    COMPACT_STEP = 64  # pages copied per change during automatic compaction
+    COMPACT_MIN_PAGES = 16  # smaller tables are never compacted automatically
+
+    def __init__(
+        self,
+        schema: Schema,
+        file: HeapFile,
+        row_index: RowIndex,
+        wal: Optional[WriteAheadLog] = None,
+        compact_threshold: Optional[float] = None,
+        indexes: Optional[Dict[IndexDef, BTreeIndex]] = None,
+        pool: Optional[BufferPool] = None,
+        bitmaps: Sequence[IndexDef] = (),
+    ):
         self._schema = schema
         self._file = file
         self._row_index = row_index  # rowid -> offset. offset = None for deleted rows
+        self._wal = wal  # changes are logged here if set
+        self._compact_threshold = compact_threshold
+        self._compaction = None  # type: Optional[Compaction]
+        self._trees = {}  # type: Dict[IndexDef, BTreeIndex]
+        self._indexes = {}  # type: Dict[IndexDef, Index]
+        self._entry_fns = {}  # type: Dict[IndexDef, Tuple[Callable, Callable]]
+        for definition, tree in (indexes or {}).items():
+            self._add_index(definition, tree)
+        self._pool = pool or BufferPool()
+        for definition in bitmaps:
+            self._add_index(definition)
+            self._load_index(definition)
 
     @staticmethod
-    def open(schema: Schema, folder: str):
-        file = HeapFile.open(os.path.join(folder, schema.name + ".data"))
+    def open(
+        schema: Schema,
+        folder: str,
+        pool: Optional[BufferPool] = None,
+        use_mmap: bool = False,
+        compact_threshold: Optional[float] = None,
+        index_defs: Sequence[IndexDef] = (),
+    ):
+        """
+        compact_threshold: dead_space() at which the table starts compacting
+            itself, COMPACT_STEP pages per change. None disables it.
+        index_defs: indexes added by create_index()
+        """
+        pool = pool or BufferPool()
+        path = os.path.join(folder, schema.name + ".data")
+        file = HeapFile.open(path, pool, use_mmap, RowCodec(schema))
+        row_index = None  # type: Optional[RowIndex]
+        indexes = {}  # type: Dict[IndexDef, BTreeIndex]
         try:
-            row_index = []
-            for offset, _ in file.scan():
-                row_index.append(offset)
-            return DiskTable(schema, file, row_index)
+            path = os.path.join(folder, schema.name + ".rowidx")
+            row_index = RowIndex.open(path, file)
+            defs = [
+                IndexDef((col.name,), kind=IndexKind.SORTED, unique=True)
+                for col in schema.columns
+                if is_unique(col)
+            ]
+            bitmaps = [d for d in index_defs if d.kind == IndexKind.BITMAP]
+            for definition in defs + list(index_defs):
+                if definition.kind != IndexKind.BITMAP:
+                    path = DiskTable._index_path(folder, schema, definition)
+                    indexes[definition] = BTreeIndex.open(path, pool)
+            table = DiskTable(
+                schema, file, row_index, None, compact_threshold, indexes, pool, bitmaps
+            )
+            table._load_stale_indexes()
+            return table
         except:
+            for index in indexes.values():
+                index.close(flush=False)
+            if row_index:
+                row_index.close(flush=False)
             file.close()
             raise
 
     def close(self):
-        self._file.close()
+        if self._compaction is not None:
+            target, self._compaction = self._compaction.target, None
+            target.close()
+            os.remove(target.path)
+        # the heap must be on disk before the row index and indexes are
+        # marked clean
+        try:
+            self._file.close()
+        except:
+            self._row_index.close(flush=False)
+            for tree in self._trees.values():
+                tree.close(flush=False)
+            raise
+        self._row_index.close()
+        for tree in self._trees.values():
+            tree.close()
 
     def __enter__(self):
         return self
@@ -153,16 +881,157 @@ class DiskTable(ITable):
         return self._schema
 
     def insert(self, row: Tuple) -> Tuple[int, Tuple]:
-        offset = self._file.append(row)
-        self._row_index.append(offset)
-        return len(self._row_index) - 1, row
+        rowid = self._append([row])[0]
+        self._maybe_compact()
+        return rowid, row
+
+    def insert_many(self, rows: Sequence[Tuple]) -> Sequence[int]:
+        rowids = self._append(rows)
+        self._maybe_compact()
+        return rowids
+
+    def _append(self, rows: Sequence[Tuple]) -> range:
+        """all or nothing: rows are encoded and indexed before any is written"""
+        encoded = self._file.encode(rows)
+        start = len(self._row_index)
+        rowids = range(start, start + len(rows))
+        self._index(rows, rowids)
+        for i in range(0, len(rows), self.BATCH_SIZE):
+            batch = slice(i, i + self.BATCH_SIZE)
+            # logged first: new pages are written before this returns
+            if self._wal and len(rows) == 1:
+                self._wal.append(LogOp.INSERT, self._schema.name, start, rows[0])
+            elif self._wal:
+                self._wal.append(
+                    LogOp.INSERT_MANY, self._schema.name, start + i, rows=rows[batch]
+                )
+            offsets = self._file.append_encoded(encoded[batch], rowids[batch])
+            self._row_index.extend(offsets)
+        return rowids
+
+    def _index(self, rows: Sequence[Tuple], rowids: Sequence[int]):
+        """all or nothing"""
+        filled = []  # type: List[Tuple[List[Tuple], Index]]
+        try:
+            for definition, index in self._indexes.items():
+                items = list(self._entries(definition, zip(rowids, rows)))
+                index.insert_many(items)
+                filled.append((items, index))
+        except:
+            for items, index in filled:
+                for key, val in items:
+                    index.remove(key, val)
+            raise
+
+    def _entries(
+        self, definition: IndexDef, rows: Iterable[Tuple[int, Tuple]]
+    ) -> Iterator[Tuple[Any, Any]]:
+        """(key, value) of the rows definition indexes, from (rowid, row)"""
+        key_fn, val_fn = self._entry_fns[definition]
+        for rowid, row in rows:
+            key = key_fn(row)
+            if key is not None or definition.kind == IndexKind.BITMAP:
+                yield key, val_fn(rowid, row)
 
     def delete(self, rowid: int):
         offset = self._row_index[rowid]
         if offset is None:
             raise ValueError("rowid {} does not exist".format(rowid))
+        # logged first: the page may be written back before this returns
+        if self._wal:
+            self._wal.append(LogOp.DELETE, self._schema.name, rowid)
+        self._remove(rowid, offset)
+        self._maybe_compact()
+
+    def dead_space(self) -> float:
+        """fraction of the heap file taken up by deleted rows"""
+        return self._file.dead_space()
+
+    def compact(self, max_pages: Optional[int] = None) -> bool:
+        """
+        Rewrites the live rows into a new heap file and atomically swaps it
+        in, reclaiming the space of deleted rows. Rowids don't change.
+
+        With max_pages, copies at most that many pages per call and returns
+        False until the swap is done. The table can be used in between.
+        """
+        if self._compaction is None:
+            target = self._file.create_empty(self._file.path + ".compact")
+            self._compaction = Compaction(self._file, target)
+        if max_pages is not None and not self._compaction.step(max_pages):
+            return False
+        compaction, self._compaction = self._compaction, None
+        compaction.finish()
+        offsets = compaction.offsets
+        offsets.extend([RowIndex.REMOVED] * (len(self._row_index) - len(offsets)))
+        source, target = self._file, compaction.target
+        # A crash before the row index is flushed leaves it unclean, so it is
+        # rebuilt from whichever heap file ends up in place.
+        target.sync()
+        self._row_index.reset(target, offsets)
+        # closed before it's replaced, so none of its pages are left in the
+        # pool to be written back to the unlinked file
+        source.close()
+        target.rename(source.path)
+        self._file = target
+        self._row_index.flush()
+        return True
+
+    def _maybe_compact(self):
+        if self._compaction is None and (
+            self._compact_threshold is None
+            or self._file.num_pages() < self.COMPACT_MIN_PAGES
+            or self._file.dead_space() < self._compact_threshold
+        ):
+            return
+        self.compact(self.COMPACT_STEP)
+
+    def _remove(self, rowid: int, offset: int):
+        if self._indexes:
+            row = self._file.get(offset)
+            for definition, index in self._indexes.items():
+                for key, val in self._entries(definition, [(rowid, row)]):
+                    index.remove(key, val)
         self._file.remove(offset)
-        self._row_index[rowid] = None
+        self._row_index.remove(rowid)
+        if self._compaction is not None:
+            self._compaction.remove(rowid)
+
+    def log_to(self, wal: Optional[WriteAheadLog]):
+        self._wal = wal
+
+    def redo(self, record: LogRecord):
+        """reapply a logged change unless the table already reflects it"""
+        if record.op == LogOp.INSERT:
+            assert record.row is not None
+            self._redo_insert(record.rowid, record.row)
+        elif record.op == LogOp.INSERT_MANY:
+            assert record.rows is not None
+            for i, row in enumerate(record.rows):
+                self._redo_insert(record.rowid + i, row)
+        elif record.op == LogOp.DELETE and self._present(record.rowid):
+            offset = self._row_index[record.rowid]
+            assert offset is not None
+            self._remove(record.rowid, offset)
+
+    def _redo_insert(self, rowid: int, row: Tuple):
+        if not self._present(rowid):
+            for definition, index in self._indexes.items():
+                for key, val in self._entries(definition, [(rowid, row)]):
+                    index.update(key, val)
+            self._row_index.put(rowid, self._file.append(row, rowid))
+
+    def _present(self, rowid: int) -> bool:
+        return rowid < len(self._row_index) and self._row_index[rowid] is not None
+
+    def checkpoint(self):
+        """make every change so far durable without the log"""
+        # the heap must be on disk before the row index and indexes are
+        # marked clean
+        self._file.sync()
+        self._row_index.flush()
+        for tree in self._trees.values():
+            tree.flush()
 
     def get(self, rowid: int) -> Optional[Tuple]:
         offset = self._row_index[rowid]
@@ -170,42 +1039,350 @@ class DiskTable(ITable):
             return None
         return self._file.get(offset)
 
+    def count(self) -> int:
+        return self._row_index.live()
+
+    def bytes_read(self) -> int:
+        return self._file.bytes_read
+
+    def partitions(self, n: int) -> Optional[Sequence[ITable]]:
+        """the heap file's record pages split into up to n HeapRanges"""
+        self._file.flush()
+        pages = self._file.num_pages() - 1  # page 0 is the header
+        n = min(n, pages)
+        bounds = [1 + pages * i // n for i in range(n + 1)]
+        return [
+            HeapRange(self._schema, self._file.path, start, end)
+            for start, end in zip(bounds, bounds[1:])
+        ]
+
     def rows(self) -> Iterator[Tuple]:
         for offset, record in self._file.scan():
             yield record
 
-    def indexes(self, column: Optional[str] = None) -> Sequence[Index]:
-        return []
+    def index_defs(self) -> Sequence[Tuple[IndexDef, Index]]:
+        return list(self._indexes.items())
+
+    def create_index(self, definition: IndexDef) -> Index:
+        check_index_def(self._schema, definition)
+        if any(d.columns == definition.columns for d in self._indexes):
+            raise ValueError("{} already indexed".format(definition.columns))
+        if definition.kind == IndexKind.BITMAP:
+            index = self._add_index(definition)
+            self._load_index(definition)
+            return index
+        folder = os.path.dirname(self._file.path)
+        path = self._index_path(folder, self._schema, definition)
+        tree = BTreeIndex.open(path, self._pool)
+        index = self._add_index(definition, tree)
+        try:
+            self._load_index(definition)
+        except:
+            del self._trees[definition], self._indexes[definition]
+            tree.close(flush=False)
+            os.remove(path)
+            raise
+        return index
+
+    def _add_index(
+        self, definition: IndexDef, tree: Optional[BTreeIndex] = None
+    ) -> Index:
+        """a BITMAP index has no tree"""
+        if tree is None:
+            index = BitmapIndex()  # type: Index
+        elif definition.unique:
+            index = tree
+        else:
+            index = MultiSortedIndex(tree)
+        if tree is not None:
+            self._trees[definition] = tree
+        self._indexes[definition] = index
+        self._entry_fns[definition] = (
+            definition.key_fn(self._schema),
+            definition.val_fn(self._schema),
+        )
+        return index
+
+    @staticmethod
+    def _index_path(folder: str, schema: Schema, definition: IndexDef) -> str:
+        name = "{}.{}.btree".format(schema.name, ",".join(definition.columns))
+        return os.path.join(folder, name)
+
+    def _load_stale_indexes(self):
+        for definition, tree in self._trees.items():
+            if tree.stale:
+                self._load_index(definition)
+
+    def _load_index(self, definition: IndexDef):
+        """rebuild an index from the rows with one bulk load"""
+        entries = list(self._entries(definition, self._items()))
+        if definition in self._trees:
+            # stable, so values stay in order
+            entries.sort(key=lambda entry: entry[0])
+        self._indexes[definition].load(entries)  # type: ignore
+
+    def _items(self) -> Iterator[Tuple[int, Tuple]]:
+        """(rowid, row) in rowid order"""
+        for rowid in range(len(self._row_index)):
+            offset = self._row_index[rowid]
+            if offset is not None:
+                yield rowid, self._file.get(offset)
+
+
+class ReadWriteLock:
+    """
+    Shared by any number of readers or held by one writer. Waiting writers
+    go first, except that a thread already reading may read more, so its
+    cursors can't deadlock each other. A thread can't write while it reads.
+
+    - threadsafe
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = {}  # type: Dict[int, int]  # thread id -> reads
+        self._writing = False
+        self._waiting = 0  # writers
+
+    def acquire_read(self) -> Callable[[], None]:
+        """returns the function that releases this read"""
+        thread = threading.get_ident()
+        with self._cond:
+            while self._writing or (self._waiting and thread not in self._readers):
+                self._cond.wait()
+            self._readers[thread] = self._readers.get(thread, 0) + 1
+        return functools.partial(self._release_read, thread)
+
+    def _release_read(self, thread: int):
+        with self._cond:
+            self._readers[thread] -= 1
+            if not self._readers[thread]:
+                del self._readers[thread]
+                self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._cond:
+            if threading.get_ident() in self._readers:
+                raise ValueError("can't write while reading, close open cursors")
+            self._waiting += 1
+            try:
+                while self._writing or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class ReadCursor:
+    """
+    Rows read under a ReadWriteLock's read lock, which is released once they
+    have all been read, or the cursor is closed or dropped.
+    """
+
+    def __init__(self, rows: Iterable[Tuple], release: Callable[[], None]):
+        self._rows = rows
+        self._release = release  # type: Optional[Callable[[], None]]
+
+    def __iter__(self) -> Iterator[Tuple]:
+        try:
+            yield from self._rows
+        finally:
+            self.close()
+
+    def close(self):
+        release, self._release = self._release, None
+        self._rows = ()
+        if release is not None:
+            release()
+
+    def __del__(self):
+        self.close()
 
 
 # TODO: Factor out code shared with MemDatabase?
 class DiskDatabase(Database):
-    def __init__(self, folder: str, tables: Dict[str, ITable]):
+    """
+    Tables in a folder, described by a MANIFEST along with the indexes
+    created on them.
+
+    With a write-ahead log (the default), every insert and delete is logged
+    and exec() returns once its change is durable. Table files are only
+    brought up to date at checkpoints, which run when the log grows past
+    checkpoint_size and on close(). Opening a database replays the log.
+
+    Tables compact themselves a few pages at a time once deleted rows take
+    up compact_threshold of their file.
+
+    exec() is threadsafe. A Select returns a ReadCursor that streams its
+    rows under a read lock, and writers wait until every open cursor has
+    been read to the end, closed or dropped. A thread can't write while it
+    has a cursor open. exec() takes parallelism=n to scan tables, and
+    filter and aggregate their rows, in n worker processes. See ParallelScan.
+
+    Table statistics gathered by ANALYZE are kept in the MANIFEST, and
+    inserts keep them roughly current until the next ANALYZE.
+
+    Selects of the same shape share a cached plan, see pydb.prepared. The
+    cache is cleared when tables, indexes or statistics are created, and
+    queries are replanned once a table they read grows or shrinks 2x.
+    """
+
+    DEFAULT_CHECKPOINT_SIZE = 16 * 1024 * 1024  # bytes of log
+    DEFAULT_COMPACT_THRESHOLD = 0.5
+
+    def __init__(
+        self,
+        folder: str,
+        tables: Dict[str, DiskTable],
+        pool: BufferPool,
+        use_mmap: bool = False,
+        wal: Optional[WriteAheadLog] = None,
+        checkpoint_size: int = DEFAULT_CHECKPOINT_SIZE,
+        compact_threshold: Optional[float] = DEFAULT_COMPACT_THRESHOLD,
+        stats: Optional[Dict[str, TableStats]] = None,
+    ):
         self._folder = folder
         self._tables = tables
+        self._pool = pool
+        self._use_mmap = use_mmap
+        self._wal = wal
+        self._checkpoint_size = checkpoint_size
+        self._compact_threshold = compact_threshold
+        self._stats = stats if stats is not None else {}
+        self._plans = PlanCache()
+        self._plans_lock = threading.Lock()  # readers share the cache
+        self._lock = ReadWriteLock()
 
     def exec(self, query, **options):
         if isinstance(query, str):
             query = parse_query(query)
-        if isinstance(query, CreateTable):
-            return self._create_table(query)
         if isinstance(query, Select):
-            return self._select(query)
-        if isinstance(query, Insert):
-            return self._insert(query)
-        raise NotImplementedError("unsupported query type: {}".format(type(query)))
+            parallelism = options.get("parallelism", 1)
+            return self._read(lambda: self._select(query, parallelism))
+        with self._lock.write():
+            if isinstance(query, CreateTable):
+                return self._create_table(query)
+            if isinstance(query, CreateIndex):
+                return self._create_index(query)
+            if isinstance(query, Analyze):
+                return self._analyze(query)
+            if isinstance(query, Explain):
+                return self._explain(query, options.get("parallelism", 1))
+            if isinstance(query, Insert):
+                result = self._insert(query)
+            elif isinstance(query, InsertMany):
+                result = self._insert_many(query)
+            else:
+                raise NotImplementedError(
+                    "unsupported query type: {}".format(type(query))
+                )
+        self._commit()
+        return result
+
+    def prepare(self, query, **options):
+        """options: as for exec() of a Select"""
+        if isinstance(query, str):
+            query = parse_query(query)
+        if not isinstance(query, Select):
+            raise ValueError("only a Select can be prepared")
+        parallelism = options.get("parallelism", 1)
+
+        def run(statement: PreparedStatement, values: Tuple) -> Cursor:
+            return self._read(lambda: self._run(statement, values, parallelism))
+
+        return PreparedStatement(query, run)
 
     @classmethod
-    def open(cls, folder):
+    def open(
+        cls,
+        folder,
+        buffer_pool_size: int = BufferPool.DEFAULT_SIZE,
+        use_mmap: bool = False,
+        wal: bool = True,
+        commit_delay: float = 0.0,
+        checkpoint_size: int = DEFAULT_CHECKPOINT_SIZE,
+        compact_threshold: Optional[float] = DEFAULT_COMPACT_THRESHOLD,
+    ):
+        """
+        options:
+            buffer_pool_size: pages cached in memory, shared by all tables
+            use_mmap: map table files and read them through the OS page cache.
+                The OS writes mapped pages back on its own schedule, so after
+                an OS crash the tables may include changes that were never
+                committed.
+            wal: log changes and make each exec() durable
+            commit_delay: seconds a commit waits to share its fsync
+            checkpoint_size: log size that triggers a checkpoint
+            compact_threshold: fraction of a table file taken up by deleted
+                rows that triggers compaction. None disables it.
+        """
         folder = os.path.abspath(folder)
         cls._create_folder(folder)
         manifest = cls._load_manifest(folder)
-        tables = cls._open_tables(folder, manifest)
-        return DiskDatabase(folder, tables)
+        pool = BufferPool(buffer_pool_size)
+        tables = cls._open_tables(folder, manifest, pool, use_mmap, compact_threshold)
+        log = None
+        try:
+            if wal:
+                log = WriteAheadLog.open(os.path.join(folder, "WAL"), commit_delay)
+                pool.before_write = log.commit
+            db = DiskDatabase(
+                folder,
+                tables,
+                pool,
+                use_mmap,
+                log,
+                checkpoint_size,
+                compact_threshold,
+                manifest["stats"],
+            )
+            db._recover()
+            return db
+        except:
+            cls._close_all(tables)
+            if log:
+                log.close()
+            raise
+
+    def checkpoint(self):
+        with self._lock.write():
+            self._checkpoint()
+
+    def compact(self, table: str, max_pages: Optional[int] = None) -> bool:
+        """see DiskTable.compact()"""
+        with self._lock.write():
+            if table not in self._tables:
+                raise ValueError("unrecognized table {}".format(table))
+            return self._tables[table].compact(max_pages)
+
+    def delete(self):
+        """
+        Closes the database and removes its files, and its folder if that
+        leaves it empty
+        """
+        self.close()
+        tables = tuple(name + "." for name in self._tables)
+        for name in os.listdir(self._folder):
+            if name in ("MANIFEST", "WAL") or name.startswith(tables):
+                os.remove(os.path.join(self._folder, name))
+        if not os.listdir(self._folder):
+            os.rmdir(self._folder)
 
     # TODO: Clean up error handling
     def close(self):
         error = None
+        try:
+            if self._wal:
+                self._wal.commit()
+        except Exception as err:
+            error = err
         for table in self._tables.values():
             try:
                 table.close()
@@ -215,6 +1392,13 @@ class DiskDatabase(Database):
             self._save_manifest()
         except Exception as err:
             error = err
+        if self._wal:
+            try:
+                if not error:
+                    self._wal.truncate()
+                self._wal.close()
+            except Exception as err:
+                error = err
         if error:
             raise error
 
@@ -224,17 +1408,112 @@ class DiskDatabase(Database):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    def _recover(self):
+        if not self._wal:
+            return
+        replayed = False
+        for record in self._wal.records():
+            table = self._tables.get(record.table, None)
+            if not table:
+                raise ValueError("log refers to unknown table {}".format(record.table))
+            table.redo(record)
+            replayed = True
+        if replayed:
+            self._checkpoint()
+        for table in self._tables.values():
+            table.log_to(self._wal)
+
+    def _commit(self):
+        if not self._wal:
+            return
+        self._wal.commit()
+        if self._wal.size() >= self._checkpoint_size:
+            with self._lock.write():
+                if self._wal.size() >= self._checkpoint_size:
+                    self._checkpoint()
+
+    def _checkpoint(self):
+        if self._wal:
+            self._wal.commit()
+        for table in self._tables.values():
+            table.checkpoint()
+        self._save_manifest()
+        if self._wal:
+            self._wal.truncate()
+
     def _create_table(self, query: CreateTable) -> Cursor:
         check_schema(query.schema)
         if query.schema.name in self._tables:
             raise ValueError("{} already exists".format(query.schema.name))
-        self._tables[query.schema.name] = DiskTable.open(query.schema, self._folder)
+        table = DiskTable.open(
+            query.schema,
+            self._folder,
+            self._pool,
+            self._use_mmap,
+            self._compact_threshold,
+        )
+        table.log_to(self._wal)
+        self._tables[query.schema.name] = table
+        self._plans.clear()
+        self._save_manifest()
+        return tuple()
+
+    def _create_index(self, query: CreateIndex) -> Cursor:
+        table = self._tables.get(query.table, None)
+        if not table:
+            raise ValueError("unrecognized table {}".format(query.table))
+        table.create_index(query.definition())
+        self._plans.clear()
+        self._save_manifest()
         return tuple()
 
-    def _select(self, query: Select) -> Cursor:
-        planner = SimplePlanner(self._tables)
-        expr = planner.plan(query)
-        return expr.exec()
+    def _read(self, select: Callable[[], Cursor]) -> Cursor:
+        """select()'s rows, planned and read under the read lock"""
+        release = self._lock.acquire_read()
+        try:
+            rows = select()
+        except BaseException:
+            release()
+            raise
+        return ReadCursor(rows, release)
+
+    def _select(self, query: Select, parallelism: int) -> Cursor:
+        def run(statement: PreparedStatement, values: Tuple) -> Cursor:
+            return self._run(statement, values, parallelism)
+
+        statement = PreparedStatement(query, run)
+        if statement.params:
+            raise ValueError("query has parameters, prepare() it")
+        return statement.exec()
+
+    def _run(
+        self, statement: PreparedStatement, values: Tuple, parallelism: int
+    ) -> Cursor:
+        return unbatched(self._plan(statement, values, parallelism).exec_batches())
+
+    def _plan(
+        self, statement: PreparedStatement, values: Tuple, parallelism: int
+    ) -> Expr:
+        """the cached plan of statement, with values bound"""
+
+        def plan():
+            planner = CostBasedPlanner(self._tables, self._stats, parallelism)
+            return compile_pipeline(planner.plan(statement.shape))
+
+        key = plan_key(statement, self._tables, parallelism)
+        with self._plans_lock:
+            bind = self._plans.get(key, plan)
+        return bind(values)
+
+    def _explain(self, query: Explain, parallelism: int) -> Cursor:
+        def run(statement: PreparedStatement, values: Tuple) -> Cursor:
+            return self._run(statement, values, parallelism)
+
+        def plan(statement: PreparedStatement, values: Tuple) -> Expr:
+            return self._plan(statement, values, parallelism)
+
+        statement = PreparedStatement(query.query, run)
+        return explain_query(query, statement, plan, self._stats)
 
     def _insert(self, query: Insert) -> Cursor:
         if len(query.columns) != len(query.values):
@@ -246,8 +1525,32 @@ class DiskDatabase(Database):
             # TODO: Support auto-populated columns
             raise ValueError("columns don't match schema")
         rowid, row = table.insert(tuple(query.values))
+        if query.table in self._stats:
+            self._stats[query.table].add(table.schema(), [row])
         return (row,)
 
+    def _insert_many(self, query: InsertMany) -> Cursor:
+        table = self._tables.get(query.table, None)
+        if not table:
+            raise ValueError("unrecognized table {}".format(query.table))
+        if tuple(query.columns) != table.schema().column_names():
+            raise ValueError("columns don't match schema")
+        rows = [tuple(row) for row in query.rows]
+        table.insert_many(rows)
+        if query.table in self._stats:
+            self._stats[query.table].add(table.schema(), rows)
+        return rows
+
+    def _analyze(self, query: Analyze) -> Cursor:
+        names = list(self._tables) if query.table is None else [query.table]
+        for name in names:
+            if name not in self._tables:
+                raise ValueError("unrecognized table {}".format(name))
+            self._stats[name] = analyze(self._tables[name])
+        self._plans.clear()
+        self._save_manifest()
+        return tuple()
+
     @staticmethod
     def _create_folder(folder):
         assert os.path.isabs(folder)
@@ -261,32 +1564,53 @@ class DiskDatabase(Database):
     def _load_manifest(folder):
         manifest_path = os.path.join(folder, "MANIFEST")
         if not os.path.exists(manifest_path):
-            return {"table_schemas": []}
+            return {"table_schemas": [], "indexes": {}, "stats": {}}
         with open(manifest_path, "rb") as f:
             manifest = pickle.load(f)
         assert isinstance(manifest, dict)
         assert "table_schemas" in manifest
+        manifest.setdefault("indexes", {})  # table name -> [IndexDef]
+        manifest.setdefault("stats", {})  # table name -> TableStats
         return manifest
 
     def _save_manifest(self):
         manifest = {
-            "table_schemas": [table.schema() for table in self._tables.values()]
+            "table_schemas": [table.schema() for table in self._tables.values()],
+            "indexes": {
+                name: [d for d, _ in table.index_defs() if not d.unique]
+                for name, table in self._tables.items()
+            },
+            "stats": self._stats,
         }
         manifest_path = os.path.join(self._folder, "MANIFEST")
-        with open(manifest_path, "wb") as f:
+        with open(manifest_path + ".tmp", "wb") as f:
             pickle.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest_path + ".tmp", manifest_path)
 
     @staticmethod
-    def _open_tables(folder, manifest):
+    def _open_tables(folder, manifest, pool, use_mmap, compact_threshold):
         tables = {}
         try:
             for schema in manifest["table_schemas"]:
-                tables[schema.name] = DiskTable.open(schema, folder)
+                tables[schema.name] = DiskTable.open(
+                    schema,
+                    folder,
+                    pool,
+                    use_mmap,
+                    compact_threshold,
+                    manifest["indexes"].get(schema.name, ()),
+                )
         except:
-            for table in tables.values():
-                try:
-                    table.close()
-                except:
-                    pass
+            DiskDatabase._close_all(tables)
             raise
         return tables
+
+    @staticmethod
+    def _close_all(tables):
+        for table in tables.values():
+            try:
+                table.close()
+            except:
+                pass
@@ -0,0 +1,568 @@
+"""
+EXPLAIN and EXPLAIN ANALYZE.
+
+explain() describes a plan as a tree of dicts, one per operator, with the
+rows and cost the model of CostBasedPlanner estimates for each. analyze()
+runs a plan with every operator wrapped in an Instrumented node and adds
+what was measured. format_text() renders a tree one operator per line.
+
+Operators fused into a CompiledPipeline, or run in the workers of a
+ParallelScan, are described but only measured as a whole.
+"""
+
+from dataclasses import dataclass, fields, replace
+from enum import Enum
+import math
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .expr import (
+    BATCH_SIZE,
+    BitmapAnd,
+    BitmapExpr,
+    BitmapLookup,
+    BitmapNot,
+    BitmapOr,
+    BitmapScan,
+    ColumnComp,
+    ColumnProjection,
+    Condition,
+    Conjunction,
+    Disjunction,
+    Expr,
+    Filter,
+    FilteredScan,
+    FinalAggregate,
+    HashAggregate,
+    HashJoin,
+    IndexedJoin,
+    IndexedLookup,
+    IndexOnlyLookup,
+    IndexRangeScan,
+    Limit,
+    MergeJoin,
+    Negation,
+    Scan,
+    Sort,
+    StreamAggregate,
+    TableCount,
+    ValueComp,
+)
+from .index import Index
+from .parallel import ParallelScan
+from .pipeline import CompiledPipeline
+from .plan import CostBasedPlanner
+from .prepared import PreparedStatement
+from .query import Explain, ExplainFormat, Param
+from .stats import ColumnStats, TableStats
+from .table import IndexDef, ITable
+
+CPU_ROW = 0.1  # cost of passing a row through an operator, see CostBasedPlanner
+
+Column = Tuple[str, Optional[ColumnStats]]  # of the rows of an operator
+
+
+@dataclass
+class Instrumented(Expr):
+    """
+    Runs expr and measures it: the calls to it, the rows it yields, and the
+    time taken and heap bytes read while it works, its inputs included.
+    bytes_read counts the bytes read from the heaps of the plan's tables.
+    """
+
+    expr: Expr
+    bytes_read: Callable[[], int]
+    loops: int = 0
+    rows: int = 0
+    seconds: float = 0.0
+    heap_bytes: int = 0
+
+    def exec(self):
+        return self._measure(self.expr.exec, False)
+
+    def exec_batches(self, size=BATCH_SIZE):
+        return self._measure(lambda: self.expr.exec_batches(size), True)
+
+    def array_batches(self, size=BATCH_SIZE):
+        batches = self.expr.array_batches(size)
+        if batches is None:
+            return None
+        return self._measure(lambda: batches, True)
+
+    def _measure(self, start: Callable[[], Iterable], batches: bool):
+        self.loops += 1
+        began, read = time.perf_counter(), self.bytes_read()
+        try:
+            items = iter(start())
+        finally:
+            self._add(began, read)
+        while True:
+            began, read = time.perf_counter(), self.bytes_read()
+            try:
+                item = next(items, None)
+            finally:
+                self._add(began, read)
+            if item is None:
+                return
+            self.rows += len(item) if batches else 1
+            yield item
+
+    def _add(self, began: float, read: int):
+        self.seconds += time.perf_counter() - began
+        self.heap_bytes += self.bytes_read() - read
+
+
+def explain_query(
+    query: Explain,
+    statement: PreparedStatement,
+    plan: Callable[[PreparedStatement, Tuple], Expr],
+    stats: Dict[str, TableStats],
+) -> List[Tuple]:
+    """
+    The rows of an Explain: a line of text per operator, or the tree.
+    plan(statement, values) is the plan exec() runs, values bound. The
+    Params of query are left unbound, so it can only be analyzed without.
+    """
+    if query.analyze and statement.params:
+        raise ValueError("can't analyze a query with parameters")
+    unbound = [Param(i) for i in range(statement.params)]
+    expr = plan(statement, statement.bind(unbound))
+    tree = analyze(expr, stats) if query.analyze else explain(expr, stats)
+    if query.format == ExplainFormat.DICT:
+        return [(tree,)]
+    return [(line,) for line in format_text(tree)]
+
+
+def explain(expr: Expr, stats: Dict[str, TableStats]) -> Dict[str, Any]:
+    """
+    The tree of expr. A node has the operator's name, its details, its
+    estimated_rows and the estimated_cost of computing them, children
+    included, and its children.
+    """
+    return _Explainer(stats).describe(expr)[0]
+
+
+def analyze(expr: Expr, stats: Dict[str, TableStats]) -> Dict[str, Any]:
+    """
+    explain() of expr after running it, with the actual numbers of each
+    measured operator: loops (times it was run), rows yielded, rows_in
+    from its children, time_ms and self_ms (less its children's), and
+    index_probes and heap_bytes read by itself.
+    """
+    tables = list({id(table): table for table in _tables(expr)}.values())
+
+    def bytes_read() -> int:
+        return sum(table.bytes_read() for table in tables)
+
+    root = instrument(expr, bytes_read)
+    for _ in root.exec_batches():
+        pass
+    return _Explainer(stats).describe(root)[0]
+
+
+def instrument(expr: Expr, bytes_read: Callable[[], int]) -> Instrumented:
+    """
+    expr with itself and every operator below it Instrumented, but for the
+    inputs of those that run them as part of themselves, so the plan takes
+    the same code paths as it does unmeasured.
+    """
+    if not _runs_inputs(expr):
+        inputs = {
+            name: instrument(value, bytes_read) for name, value in _inputs(expr).items()
+        }
+        expr = replace(expr, **inputs)  # type: ignore
+    return Instrumented(expr, bytes_read)
+
+
+def format_text(node: Dict[str, Any], depth: int = 0) -> List[str]:
+    details = ", ".join("{}={}".format(k, v) for k, v in node["details"].items())
+    line = "{}{}{}  (cost={:.1f} rows={})".format(
+        "   " * (depth - 1) + "-> " if depth else "",
+        node["operator"],
+        " [{}]".format(details) if details else "",
+        node["estimated_cost"],
+        node["estimated_rows"],
+    )
+    actual = node.get("actual")
+    if actual:
+        line += "  (actual rows={} loops={} time={:.3f}ms self={:.3f}ms".format(
+            actual["rows"], actual["loops"], actual["time_ms"], actual["self_ms"]
+        )
+        for key in ("index_probes", "heap_bytes"):
+            if actual[key]:
+                line += " {}={}".format(key, actual[key])
+        line += ")"
+    elif "runner" in node:
+        line += "  (in {})".format(node["runner"])
+    lines = [line]
+    for child in node["children"]:
+        lines.extend(format_text(child, depth + 1))
+    return lines
+
+
+def _inputs(expr: Any) -> Dict[str, Expr]:
+    """the operators expr reads rows from, by field"""
+    return {
+        field.name: getattr(expr, field.name)
+        for field in fields(expr)
+        if isinstance(getattr(expr, field.name), Expr)
+    }
+
+
+def _runs_inputs(expr: Expr, arrays: bool = True) -> bool:
+    """
+    Whether expr runs its inputs as part of itself: compiled, in worker
+    processes or, with arrays, maybe by reading the column arrays of the
+    table its input scans.
+    """
+    if isinstance(expr, (CompiledPipeline, ParallelScan)):
+        return True
+    if not arrays:
+        return False
+    if isinstance(expr, ColumnProjection):
+        return bool(expr.columns) and isinstance(expr.expr, (Scan, FilteredScan))
+    if isinstance(expr, HashAggregate):
+        return not expr.columns and isinstance(expr.expr, (Scan, FilteredScan))
+    return False
+
+
+def _tables(expr: Any) -> Iterable[ITable]:
+    """the tables expr reads"""
+    for field in fields(expr):
+        value = getattr(expr, field.name)
+        if field.name == "table":
+            yield value
+        elif isinstance(value, Expr):
+            yield from _tables(value)
+
+
+class _Explainer:
+    def __init__(self, stats: Dict[str, TableStats]):
+        self.stats = stats
+
+    def describe(
+        self, expr: Expr, runner: Optional[str] = None
+    ) -> Tuple[Dict[str, Any], List[Column], float]:
+        """
+        The node of expr, its columns and its estimated rows. runner names
+        the operator that runs expr as part of itself, if any.
+        """
+        measured = None
+        if isinstance(expr, Instrumented):
+            measured, expr = expr, expr.expr
+        if isinstance(expr, CompiledPipeline):
+            inputs = [expr.plan]  # type: List[Expr]
+        else:
+            inputs = list(_inputs(expr).values())
+        inner = runner
+        if runner is None and _runs_inputs(expr, measured is not None):
+            inner = type(expr).__name__
+        children = [self.describe(child, inner) for child in inputs]
+        columns = [child[1] for child in children]
+        rows, cost = self._estimate(
+            expr, [child[2] for child in children], children, columns
+        )
+        node = {
+            "operator": type(expr).__name__,
+            "details": self._details(expr, columns),
+            "estimated_rows": round(rows),
+            "estimated_cost": round(cost, 1),
+            "children": [child[0] for child in children],
+        }  # type: Dict[str, Any]
+        if runner is not None:
+            node["runner"] = runner
+        if measured is not None:
+            below = [child for child in inputs if isinstance(child, Instrumented)]
+            node["actual"] = _actual(measured, below)
+        return node, self._columns(expr, columns), rows
+
+    def _table_columns(self, table: ITable) -> List[Column]:
+        stats = self.stats.get(table.name())
+        return [
+            (column.name, stats.columns.get(column.name) if stats else None)
+            for column in table.schema().columns
+        ]
+
+    def _columns(self, expr: Expr, inputs: List[List[Column]]) -> List[Column]:
+        if isinstance(expr, TableCount):
+            return [("COUNT(*)", None)]
+        if isinstance(expr, IndexOnlyLookup):
+            return [("#{}".format(col), None) for col in expr.columns]
+        if isinstance(expr, IndexedJoin):
+            return inputs[0] + self._table_columns(expr.table)
+        if isinstance(expr, (HashJoin, MergeJoin)):
+            return inputs[0] + inputs[1]
+        if isinstance(expr, ColumnProjection):
+            return [_column(inputs[0], col) for col in expr.columns]
+        if isinstance(expr, (HashAggregate, StreamAggregate)):
+            groups = [_column(inputs[0], col) for col in expr.columns]
+            return groups + [(_aggregate(agg, inputs[0]), None) for agg in expr.aggs]
+        if inputs:
+            return inputs[0]
+        table = getattr(expr, "table", None)
+        return self._table_columns(table) if table is not None else []
+
+    def _details(self, expr: Any, inputs: List[List[Column]]) -> Dict[str, Any]:
+        """the fields of expr that aren't inputs or defaults, readably"""
+        if inputs:
+            columns = inputs[0]
+        elif hasattr(expr, "table"):
+            columns = self._table_columns(expr.table)
+        else:
+            columns = []
+        details = {}  # type: Dict[str, Any]
+        for field in fields(expr):
+            value = getattr(expr, field.name)
+            if isinstance(value, Expr) or value == field.default:
+                continue
+            if isinstance(expr, CompiledPipeline) and field.name != "table":
+                continue
+            if field.name == "table":
+                value = value.name()
+            elif isinstance(value, Index):
+                value = _index_name(expr, value)
+            elif isinstance(value, BitmapExpr):
+                value = _bitmap_text(expr.table, value)
+            elif isinstance(value, (ValueComp, ColumnComp, Conjunction, Disjunction)):
+                value = _condition_text(value, columns)
+            elif isinstance(value, Negation):
+                value = _condition_text(value, columns)
+            elif isinstance(expr, FinalAggregate) and field.name == "aggs":
+                value = ", ".join(name for name, _ in columns[expr.ngroup :])
+            elif field.name == "aggs":
+                value = ", ".join(_aggregate(agg, columns) for agg in value)
+            elif field.name in ("col", "col1", "column", "columns"):
+                value = _names(columns, value)
+            elif field.name == "col2":
+                value = _names(inputs[1] if len(inputs) > 1 else [], value)
+            elif isinstance(value, Enum):
+                value = value.value
+            elif not isinstance(value, (int, float, str, bool, tuple)):
+                continue
+            details[field.name] = value
+        return details
+
+    def _estimate(
+        self,
+        expr: Expr,
+        rows: List[float],
+        children: List[Tuple[Dict[str, Any], List[Column], float]],
+        inputs: List[List[Column]],
+    ) -> Tuple[float, float]:
+        """(rows, cost) of expr, given those of its children"""
+        costs = CostBasedPlanner
+        cost = sum(child[0]["estimated_cost"] for child in children)
+        if isinstance(expr, TableCount):
+            return 1.0, 0.0
+        if isinstance(expr, (Scan, FilteredScan)):
+            count = expr.table.count()
+            selected = float(count)
+            if isinstance(expr, FilteredScan):
+                columns = self._table_columns(expr.table)
+                selected *= self._selectivity(expr.cond, columns)
+            return selected, count * costs.SCAN_ROW
+        if isinstance(expr, (IndexedLookup, IndexOnlyLookup, IndexRangeScan)):
+            found = self._index_rows(expr)
+            per_row = CPU_ROW if isinstance(expr, IndexOnlyLookup) else costs.FETCH_ROW
+            return found, costs.PROBE + found * per_row
+        if isinstance(expr, BitmapScan):
+            found = expr.table.count() * self._bitmap_selectivity(expr, expr.expr)
+            return found, costs.PROBE * _lookups(expr.expr) + found * costs.FETCH_ROW
+        if isinstance(expr, IndexedJoin):
+            stats = self._index_stats(expr.table, expr.index)
+            matches = 1.0
+            if stats is not None:
+                present = expr.table.count() * (1.0 - stats.null_frac)
+                matches = present / max(1.0, stats.distinct)
+            found = rows[0] * matches
+            return found, cost + rows[0] * costs.PROBE + found * costs.FETCH_ROW
+        if isinstance(expr, (HashJoin, MergeJoin)):
+            joined = [
+                _column(inputs[0], expr.col1)[1],
+                _column(inputs[1], expr.col2)[1],
+            ]
+            distinct = max([s.distinct for s in joined if s is not None], default=0.0)
+            if distinct:
+                found = rows[0] * rows[1] / distinct
+            else:
+                found = max(rows)
+            if isinstance(expr, MergeJoin):
+                return found, cost + (rows[0] + rows[1]) * CPU_ROW
+            build, probe = (rows[1], rows[0]) if expr.build_right else rows
+            return found, cost + build * costs.HASH_ROW + probe * CPU_ROW
+        if isinstance(expr, (HashAggregate, StreamAggregate)):
+            groups = 1.0
+            for col in expr.columns:
+                stats = _column(inputs[0], col)[1]
+                groups *= stats.distinct if stats else max(1.0, rows[0] / 10)
+            per_row = costs.HASH_ROW if isinstance(expr, HashAggregate) else CPU_ROW
+            return min(groups, max(1.0, rows[0])), cost + rows[0] * per_row
+        if isinstance(expr, Sort):
+            n = rows[0] if expr.limit is None else min(rows[0], expr.limit)
+            return n, cost + rows[0] * math.log2(max(2.0, rows[0])) * CPU_ROW
+        if isinstance(expr, Limit):
+            end = rows[0] if expr.limit is None else expr.offset + expr.limit
+            return max(0.0, min(rows[0], end) - expr.offset), cost
+        if isinstance(expr, Filter):
+            found = rows[0] * self._selectivity(expr.cond, inputs[0])
+            return found, cost + rows[0] * CPU_ROW
+        if isinstance(expr, ParallelScan):
+            return rows[0], cost / expr.workers
+        if isinstance(expr, (ColumnProjection, FinalAggregate)):
+            return rows[0], cost + rows[0] * CPU_ROW
+        return (rows[0] if rows else 0.0), cost
+
+    def _selectivity(self, cond: Condition, columns: List[Column]) -> float:
+        costs = CostBasedPlanner
+        if isinstance(cond, ValueComp):
+            stats = _column(columns, cond.col)[1]
+            if stats is None:
+                return costs.EQUAL if cond.op.value == "=" else costs.RANGE
+            return stats.selectivity(cond.op.value, cond.val)
+        if isinstance(cond, Conjunction):
+            return math.prod(self._selectivity(c, columns) for c in cond.conds)
+        if isinstance(cond, Disjunction):
+            missed = [1.0 - self._selectivity(c, columns) for c in cond.conds]
+            return 1.0 - math.prod(missed)
+        if isinstance(cond, Negation):
+            return 1.0 - self._selectivity(cond.cond, columns)
+        return costs.OTHER
+
+    def _index_rows(self, expr: Any) -> float:
+        """rows an index lookup or range scan finds"""
+        costs = CostBasedPlanner
+        table = getattr(expr, "table", None)
+        definition = _definition(table, expr.index) if table else None
+        if table is None or definition is None:
+            return 1.0
+        columns = dict(self._table_columns(table))
+        count = table.count()
+        if isinstance(expr, IndexRangeScan):
+            stats = columns[definition.columns[0]]
+            if expr.low is None and expr.high is None:
+                return float(count)
+            if stats is None:
+                return count * costs.RANGE
+            if isinstance(expr.low, Param) or isinstance(expr.high, Param):
+                return count * stats.selectivity("<", Param(0))  # unknown width
+            high = 1.0 - stats.null_frac
+            if expr.high is not None:
+                op = "<=" if expr.high_inclusive else "<"
+                high = stats.selectivity(op, expr.high)
+            low = 0.0
+            if expr.low is not None:
+                low = stats.selectivity("<" if expr.low_inclusive else "<=", expr.low)
+            return count * max(0.0, high - low)
+        key = expr.key
+        keys = key if len(definition.columns) > 1 else (key,)
+        found = float(count)
+        for name, value in zip(definition.columns, keys):
+            stats = columns[name]
+            found *= stats.selectivity("=", value) if stats else costs.EQUAL
+        return found
+
+    def _index_stats(self, table: ITable, index: Index) -> Optional[ColumnStats]:
+        """stats of the first column of index"""
+        definition = _definition(table, index)
+        if definition is None:
+            return None
+        return dict(self._table_columns(table))[definition.columns[0]]
+
+    def _bitmap_selectivity(self, scan: BitmapScan, expr: BitmapExpr) -> float:
+        if isinstance(expr, BitmapLookup):
+            stats = self._index_stats(scan.table, expr.index)
+            if stats is None:
+                return CostBasedPlanner.EQUAL
+            return stats.selectivity("=", expr.key)
+        if isinstance(expr, BitmapNot):
+            return 1.0 - self._bitmap_selectivity(scan, expr.expr)
+        parts = [self._bitmap_selectivity(scan, e) for e in expr.exprs]  # type: ignore
+        if isinstance(expr, BitmapAnd):
+            return math.prod(parts)
+        return 1.0 - math.prod(1.0 - part for part in parts)
+
+
+def _actual(measured: Instrumented, below: List[Instrumented]) -> Dict[str, Any]:
+    expr = measured.expr
+    rows_in = sum(child.rows for child in below)
+    probes = 0
+    if isinstance(expr, (IndexedLookup, IndexOnlyLookup, IndexRangeScan)):
+        probes = measured.loops
+    elif isinstance(expr, BitmapScan):
+        probes = measured.loops * _lookups(expr.expr)
+    elif isinstance(expr, IndexedJoin):
+        probes = rows_in
+    seconds = measured.seconds - sum(child.seconds for child in below)
+    return {
+        "loops": measured.loops,
+        "rows": measured.rows,
+        "rows_in": rows_in,
+        "time_ms": round(measured.seconds * 1e3, 3),
+        "self_ms": round(max(0.0, seconds) * 1e3, 3),
+        "index_probes": probes,
+        "heap_bytes": measured.heap_bytes - sum(child.heap_bytes for child in below),
+    }
+
+
+def _column(columns: List[Column], col: int) -> Column:
+    return columns[col] if col < len(columns) else ("#{}".format(col), None)
+
+
+def _names(columns: List[Column], value: Any) -> Any:
+    if isinstance(value, int):
+        return _column(columns, value)[0]
+    return "({})".format(", ".join(_column(columns, col)[0] for col in value))
+
+
+def _aggregate(agg: Any, columns: List[Column]) -> str:
+    column = "*" if agg.col is None else _column(columns, agg.col)[0]
+    return "{}({})".format(agg.func.value, column)
+
+
+def _condition_text(cond: Condition, columns: List[Column]) -> str:
+    if isinstance(cond, ValueComp):
+        name = _column(columns, cond.col)[0]
+        return "{} {} {!r}".format(name, cond.op.value, cond.val)
+    if isinstance(cond, ColumnComp):
+        names = _column(columns, cond.col1)[0], _column(columns, cond.col2)[0]
+        return "{} {} {}".format(names[0], cond.op.value, names[1])
+    if isinstance(cond, Negation):
+        return "NOT ({})".format(_condition_text(cond.cond, columns))
+    assert isinstance(cond, (Conjunction, Disjunction))
+    joiner = " AND " if isinstance(cond, Conjunction) else " OR "
+    parts = [_condition_text(c, columns) for c in cond.conds]
+    return "({})".format(joiner.join(parts)) if len(parts) > 1 else "".join(parts)
+
+
+def _bitmap_text(table: ITable, expr: BitmapExpr) -> str:
+    if isinstance(expr, BitmapLookup):
+        definition = _definition(table, expr.index)
+        name = definition.columns[0] if definition else "?"
+        return "{} = {!r}".format(name, expr.key)
+    if isinstance(expr, BitmapNot):
+        return "NOT ({})".format(_bitmap_text(table, expr.expr))
+    joiner = " AND " if isinstance(expr, BitmapAnd) else " OR "
+    parts = [_bitmap_text(table, e) for e in expr.exprs]  # type: ignore
+    return "({})".format(joiner.join(parts))
+
+
+def _lookups(expr: BitmapExpr) -> int:
+    """BitmapLookups in expr"""
+    if isinstance(expr, BitmapLookup):
+        return 1
+    if isinstance(expr, BitmapNot):
+        return _lookups(expr.expr)
+    assert isinstance(expr, (BitmapAnd, BitmapOr))
+    return sum(_lookups(e) for e in expr.exprs)
+
+
+def _definition(table: ITable, index: Index) -> Optional[IndexDef]:
+    return next((d for d, i in table.index_defs() if i is index), None)
+
+
+def _index_name(expr: Any, index: Index) -> str:
+    table = getattr(expr, "table", None)
+    definition = _definition(table, index) if table is not None else None
+    if definition is None:
+        return type(index).__name__
+    return "{}({})".format(type(index).__name__, ", ".join(definition.columns))
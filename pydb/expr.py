@@ -1,24 +1,57 @@
 from collections import defaultdict
 from dataclasses import dataclass
 from enum import Enum
+import functools
+import heapq
+import itertools
+import marshal
+import operator
+import sys
+import tempfile
 from typing import (
+    IO,
     Any,
     Callable,
+    Dict,
+    Iterable,
     Iterator,
+    List,
+    Optional,
     Tuple,
     Protocol,
     Sequence,
 )
 
-from .table import ITable
-from .index import Index
-from .table import ITable
+from .index import Bitmap, BitmapIndex, Index, SortedIndex
+from .table import ITable, batched
+from . import vector
+
+BATCH_SIZE = 1024  # rows per batch passed between operators by exec_batches()
+SORT_MEMORY = 64 * 1024 * 1024  # bytes of rows a Sort holds before spilling
+JOIN_MEMORY = 64 * 1024 * 1024  # bytes of rows a HashJoin builds on in memory
+SPILL_CHUNK = 1024  # rows per marshal record in spill files
 
 
 class Expr:
     def exec(self) -> Iterator[Tuple]:
         pass
 
+    def exec_batches(self, size: int = BATCH_SIZE) -> Iterator[List[Tuple]]:
+        """
+        exec() in lists of up to size rows. Operators that override it work
+        on a whole batch at a time, which saves per row interpreter overhead.
+        """
+        return batched(self.exec(), size)
+
+    def array_batches(self, size: int = BATCH_SIZE) -> Optional[Iterator[List[Tuple]]]:
+        """exec_batches() computed from column arrays, or None if they don't apply"""
+        return None
+
+
+def unbatched(batches: Iterable[List[Tuple]]) -> Iterator[Tuple]:
+    """rows of exec_batches(), one at a time"""
+    return itertools.chain.from_iterable(batches)
+
 
 @dataclass
 class Scan(Expr):
@@ -27,29 +60,214 @@ class Scan(Expr):
     def exec(self) -> Iterator[Tuple]:
         return self.table.rows()
 
+    def exec_batches(self, size=BATCH_SIZE):
+        return self.table.row_batches(size)
+
+
+def index_entries(index: Index, key: Any, prefix: bool = False) -> Iterator[Tuple]:
+    """
+    (key, value) of the entries with key. With prefix, key is a tuple of the
+    leading values of composite keys and index must be a SortedIndex.
+    """
+    if not prefix:
+        return ((key, val) for val in index.find_all(key))
+    assert isinstance(index, SortedIndex)
+    n = len(key)
+    return itertools.takewhile(lambda entry: entry[0][:n] == key, index.items(key))
+
 
 @dataclass
 class IndexedLookup(Expr):
+    """
+    Rows whose key is key, or starts with it with prefix. A covering index
+    has (rowid, *included values) values.
+    """
+
     table: ITable
     index: Index[Any, int]
     key: Any
+    prefix: bool = False
+    covering: bool = False
+
+    def exec(self):
+        return [self.table.get(rowid) for rowid in self.rowids()]
+
+    def rowids(self) -> Iterator[int]:
+        for _, val in index_entries(self.index, self.key, self.prefix):
+            yield val[0] if self.covering else val
+
+
+@dataclass
+class IndexOnlyLookup(Expr):
+    """
+    Like IndexedLookup, but rows are built from the index entries alone,
+    without reading the table. The fields of an entry are the key columns
+    followed by the included columns; columns picks the output columns.
+    """
+
+    index: Index
+    key: Any
+    columns: Sequence[int]
+    composite: bool = False
+    prefix: bool = False
+    covering: bool = False
 
     def exec(self):
-        rowid = self.index.find(self.key)
-        if not rowid:
-            return ()
-        return (self.table.get(rowid),)
+        columns = self.columns
+        for key, val in index_entries(self.index, self.key, self.prefix):
+            fields = key if self.composite else (key,)
+            if self.covering:
+                fields += val[1:]
+            yield tuple(fields[col] for col in columns)
+
+
+@dataclass
+class IndexRangeScan(Expr):
+    """
+    Rows with keys between low and high, in key order or reverse key order.
+    A bound of None is open.
+    """
+
+    table: ITable
+    index: SortedIndex
+    low: Any = None
+    high: Any = None
+    low_inclusive: bool = True
+    high_inclusive: bool = True
+    reverse: bool = False
+    covering: bool = False
+
+    def exec(self):
+        for rowid in self.rowids():
+            yield self.table.get(rowid)
+
+    def rowids(self) -> Iterator[int]:
+        if self.covering:
+            return (val[0] for val in self._vals())
+        return self._vals()
+
+    def _vals(self) -> Iterator[Any]:
+        if self.reverse:
+            for key, rowid in self.index.ritems(self.high):
+                if self.low is not None and (
+                    key < self.low or key == self.low and not self.low_inclusive
+                ):
+                    return
+                if key != self.high or self.high_inclusive:
+                    yield rowid
+        else:
+            for key, rowid in self.index.items(self.low):
+                if self.high is not None and (
+                    key > self.high or key == self.high and not self.high_inclusive
+                ):
+                    return
+                if key != self.low or self.low_inclusive:
+                    yield rowid
+
+
+class BitmapExpr:
+    def bitmap(self) -> Bitmap:
+        pass
+
+
+@dataclass
+class BitmapLookup(BitmapExpr):
+    index: BitmapIndex
+    key: Any
+
+    def bitmap(self):
+        return self.index.bitmap(self.key)
+
+
+@dataclass
+class BitmapAnd(BitmapExpr):
+    exprs: Sequence[BitmapExpr]
+
+    def bitmap(self):
+        bitmaps = iter(self.exprs)
+        result = next(bitmaps).bitmap()
+        for expr in bitmaps:
+            if not result:
+                break
+            result = result & expr.bitmap()
+        return result
+
+
+@dataclass
+class BitmapOr(BitmapExpr):
+    exprs: Sequence[BitmapExpr]
+
+    def bitmap(self):
+        result = Bitmap()
+        for expr in self.exprs:
+            result = result | expr.bitmap()
+        return result
+
+
+@dataclass
+class BitmapNot(BitmapExpr):
+    """rows of index, which holds every row, that aren't in expr"""
+
+    index: BitmapIndex
+    expr: BitmapExpr
+
+    def bitmap(self):
+        return self.index.all() - self.expr.bitmap()
+
+
+@dataclass
+class BitmapScan(Expr):
+    """Rows whose rowids are in a bitmap, in rowid order"""
+
+    table: ITable
+    expr: BitmapExpr
+
+    def exec(self):
+        for rowid in self.expr.bitmap():
+            yield self.table.get(rowid)
 
 
 class Condition(Protocol):
     def test(self, row: Tuple) -> bool:
         pass
 
+    def mask(self, rows: Sequence[Tuple]) -> Iterator[bool]:
+        """test() of each row"""
+        return map(self.test, rows)
+
+    def select(self, rows: Sequence[Tuple]) -> List[Tuple]:
+        """the rows that pass test()"""
+        return list(itertools.compress(rows, self.mask(rows)))
+
+    def array_mask(self, column: Callable[[int], Optional[Any]]) -> Optional[Any]:
+        """
+        test() of every row as a boolean array, computed from the arrays
+        column(col) returns. None if the condition can't run on arrays.
+        """
+        return None
+
+
+_COMPARISONS = {
+    "=": operator.eq,
+    "<": operator.lt,
+    ">": operator.gt,
+    "<=": operator.le,
+    ">=": operator.ge,
+}  # type: Dict[str, Callable[[Any, Any], bool]]
+
 
 class BinOp(Enum):
-    EQ = lambda x, y: x == y
-    LT = lambda x, y: x < y
-    GT = lambda x, y: x > y
+    EQ = "="
+    LT = "<"
+    GT = ">"
+    LE = "<="
+    GE = ">="
+
+    def __init__(self, symbol: str):
+        self.fn = _COMPARISONS[symbol]
+
+    def __call__(self, x, y) -> bool:
+        return self.fn(x, y)
 
 
 @dataclass
@@ -59,7 +277,17 @@ class ValueComp(Condition):
     val: Any
 
     def test(self, row):
-        return self.op(row[self.col], self.val)
+        return self.op.fn(row[self.col], self.val)
+
+    def mask(self, rows):
+        vals = map(operator.itemgetter(self.col), rows)
+        return map(self.op.fn, vals, itertools.repeat(self.val))
+
+    def array_mask(self, column):
+        array = column(self.col)
+        if array is None or type(self.val) is not int:
+            return None
+        return self.op.fn(array, self.val)
 
 
 @dataclass
@@ -69,7 +297,80 @@ class ColumnComp(Condition):
     col2: int
 
     def test(self, row):
-        return self.op(row[self.col1], row[self.col2])
+        return self.op.fn(row[self.col1], row[self.col2])
+
+    def mask(self, rows):
+        vals1 = map(operator.itemgetter(self.col1), rows)
+        vals2 = map(operator.itemgetter(self.col2), rows)
+        return map(self.op.fn, vals1, vals2)
+
+    def array_mask(self, column):
+        array1, array2 = column(self.col1), column(self.col2)
+        if array1 is None or array2 is None:
+            return None
+        return self.op.fn(array1, array2)
+
+
+def _array_masks(
+    conds: Sequence[Condition], column: Callable[[int], Optional[Any]]
+) -> Optional[List[Any]]:
+    if not conds:
+        return None
+    masks = []
+    for cond in conds:
+        mask = cond.array_mask(column)
+        if mask is None:
+            return None
+        masks.append(mask)
+    return masks
+
+
+@dataclass
+class Conjunction(Condition):
+    conds: Sequence[Condition]
+
+    def test(self, row):
+        return all(cond.test(row) for cond in self.conds)
+
+    def select(self, rows):
+        # each condition only sees the rows the previous ones let through,
+        # as with test()
+        for cond in self.conds:
+            if not rows:
+                break
+            rows = cond.select(rows)
+        return rows
+
+    def array_mask(self, column):
+        masks = _array_masks(self.conds, column)
+        return None if masks is None else vector.all_of(masks)
+
+
+@dataclass
+class Disjunction(Condition):
+    conds: Sequence[Condition]
+
+    def test(self, row):
+        return any(cond.test(row) for cond in self.conds)
+
+    def array_mask(self, column):
+        masks = _array_masks(self.conds, column)
+        return None if masks is None else vector.any_of(masks)
+
+
+@dataclass
+class Negation(Condition):
+    cond: Condition
+
+    def test(self, row):
+        return not self.cond.test(row)
+
+    def mask(self, rows):
+        return map(operator.not_, self.cond.mask(rows))
+
+    def array_mask(self, column):
+        mask = self.cond.array_mask(column)
+        return None if mask is None else vector.negate(mask)
 
 
 @dataclass
@@ -80,6 +381,46 @@ class FilteredScan(Expr):
     def exec(self):
         return (row for row in self.table.rows() if self.cond.test(row))
 
+    def exec_batches(self, size=BATCH_SIZE):
+        batches = self.array_batches(size)
+        return self._select_batches(size) if batches is None else batches
+
+    def _select_batches(self, size):
+        for batch in self.table.row_batches(size):
+            batch = self.cond.select(batch)
+            if batch:
+                yield batch
+
+    def array_batches(self, size=BATCH_SIZE):
+        rowids = self.selection()
+        if rowids is None:
+            return None
+        return (
+            self.table.get_many(rowids[start : start + size].tolist())
+            for start in range(0, len(rowids), size)
+        )
+
+    def selection(self) -> Optional[Any]:
+        """rowids of the matching rows as an array, if the table's column
+        arrays can answer cond"""
+        mask = self.cond.array_mask(self.table.column_array)
+        return None if mask is None else vector.nonzero(mask)
+
+
+@dataclass
+class Filter(Expr):
+    expr: Expr
+    cond: Condition
+
+    def exec(self):
+        return (row for row in self.expr.exec() if self.cond.test(row))
+
+    def exec_batches(self, size=BATCH_SIZE):
+        for batch in self.expr.exec_batches(size):
+            batch = self.cond.select(batch)
+            if batch:
+                yield batch
+
 
 @dataclass
 class IndexedJoin(Expr):
@@ -87,56 +428,310 @@ class IndexedJoin(Expr):
     column: int
     index: Index[Any, int]
     table: ITable
+    covering: bool = False
 
     def exec(self):
         for row1 in self.expr.exec():
-            rowid = self.index.find(row1[self.column])
-            if rowid:
-                row2 = self.table.get(rowid)
+            key = row1[self.column]
+            if key is None:
+                continue  # null keys never match, as in HashJoin
+            for val in self.index.find_all(key):
+                row2 = self.table.get(val[0] if self.covering else val)
                 assert row2 is not None
                 yield (*row1, *row2)
 
 
 @dataclass
 class HashJoin(Expr):
+    """
+    Joins rows with equal values of col1 and col2. Null keys never match.
+    The rows of exp1, or of exp2 if build_right, are hashed on their join
+    column and probed by those of the other side, and the joined rows are
+    always (*exp1 row, *exp2 row).
+
+    When the build side outgrows about memory bytes, both sides are split
+    into PARTITIONS temp files by the hash of their key and joined one pair
+    of partitions at a time (a Grace hash join). Partitions that are still
+    too large are split again, up to MAX_DEPTH times.
+    """
+
     exp1: Expr
     exp2: Expr
     col1: int
     col2: int
+    build_right: bool = False
+    memory: int = JOIN_MEMORY
+
+    PARTITIONS = 16
+    MAX_DEPTH = 4  # then a partition is joined in memory whatever its size
 
     def exec(self):
-        index = defaultdict(list)
-        for row1 in self.exp1.exec():
-            index[row1[self.col1]].append(row1)
-        for row2 in self.exp2.exec():
-            for row1 in index[row2[self.col2]]:
-                yield (*row1, *row2)
+        return unbatched(self.exec_batches())
 
+    def exec_batches(self, size=BATCH_SIZE):
+        build, probe = self.exp1, self.exp2
+        if self.build_right:
+            build, probe = probe, build
+        return self._join(build.exec_batches(size), probe.exec_batches(size), size, 0)
 
-class MergeJoin(Expr):
-    def __init__(self, exp1, keyfn1, exp2, keyfn2):
-        self.exp1
-        self.keyfn1 = keyfn1
-        self.exp2 = exp2
-        self.keyfn2 = keyfn2
-
-    def exec(self):
-        sentinel = object()
-        it1 = self.exp1.exec()
-        it2 = self.exp2.exec()
-        a = next(it1, sentinel)
-        b = next(it2, sentinel)
-        while sentinel not in (a, b):
-            k1 = self.keyfn1(a)
-            k2 = self.keyfn2(b)
-            if k1 == k2:
-                yield (a, b)
-                a = next(it1, sentinel)
-                b = next(it2, sentinel)
-            elif k1 < k2:
-                a = next(it1, sentinel)
+    def _join(
+        self,
+        build: Iterable[List[Tuple]],
+        probe: Iterable[List[Tuple]],
+        size: int,
+        depth: int,
+    ) -> Iterator[List[Tuple]]:
+        build_col, probe_col = self.col1, self.col2
+        if self.build_right:
+            build_col, probe_col = probe_col, build_col
+        index = defaultdict(list)  # type: Dict[Any, List[Tuple]]
+        limit, held = None, 0  # rows
+        build = iter(build)
+        for batch in build:
+            if limit is None:
+                limit = max(1, self.memory // row_size(batch))
+            for key, row in zip(map(operator.itemgetter(build_col), batch), batch):
+                if key is not None:
+                    index[key].append(row)
+            held += len(batch)
+            if held > limit and depth < self.MAX_DEPTH:
+                rows = [row for run in index.values() for row in run]
+                index.clear()
+                build = itertools.chain([rows], build)
+                yield from self._partitioned(build, probe, size, depth)
+                return
+        empty = ()  # type: Sequence[Tuple]
+        for batch in probe:
+            keys = map(operator.itemgetter(probe_col), batch)
+            if self.build_right:
+                joined = [
+                    (*row1, *row2)
+                    for key, row1 in zip(keys, batch)
+                    for row2 in index.get(key, empty)
+                ]
             else:
-                b = next(it2, sentinel)
+                joined = [
+                    (*row1, *row2)
+                    for key, row2 in zip(keys, batch)
+                    for row1 in index.get(key, empty)
+                ]
+            for start in range(0, len(joined), size):
+                yield joined[start : start + size]
+
+    def _partitioned(
+        self,
+        build: Iterable[List[Tuple]],
+        probe: Iterable[List[Tuple]],
+        size: int,
+        depth: int,
+    ) -> Iterator[List[Tuple]]:
+        build_col, probe_col = self.col1, self.col2
+        if self.build_right:
+            build_col, probe_col = probe_col, build_col
+        files = []  # type: List[IO[bytes]]
+        try:
+            build_parts = self._partition(build, build_col, depth, files)
+            probe_parts = self._partition(probe, probe_col, depth, files)
+            for build_part, probe_part in zip(build_parts, probe_parts):
+                if build_part is None or probe_part is None:
+                    continue
+                yield from self._join(
+                    batched(_read_spilled(build_part), size),
+                    batched(_read_spilled(probe_part), size),
+                    size,
+                    depth + 1,
+                )
+        finally:
+            for file in files:
+                file.close()
+
+    def _partition(
+        self, batches: Iterable[List[Tuple]], col: int, depth: int, files: List
+    ) -> List[Optional[IO[bytes]]]:
+        """
+        rows with non-null keys written to PARTITIONS temp files, added to
+        files, by the hash of their key salted with depth. None for empty
+        partitions.
+        """
+        parts = [None] * self.PARTITIONS  # type: List[Optional[IO[bytes]]]
+        chunks = [[] for _ in parts]  # type: List[List[Tuple]]
+
+        def flush(i: int):
+            part = parts[i]
+            if part is None:
+                part = parts[i] = tempfile.TemporaryFile()
+                files.append(part)
+            marshal.dump(chunks[i], part)
+            chunks[i] = []
+
+        for batch in batches:
+            for row in batch:
+                key = row[col]
+                if key is not None:
+                    i = hash((depth, key)) % self.PARTITIONS
+                    chunks[i].append(row)
+                    if len(chunks[i]) >= SPILL_CHUNK:
+                        flush(i)
+        for i, chunk in enumerate(chunks):
+            if chunk:
+                flush(i)
+        for part in parts:
+            if part is not None:
+                part.seek(0)
+        return parts
+
+
+@dataclass
+class MergeJoin(Expr):
+    """
+    Joins inputs that are both in ascending order of their join column.
+    Only the current run of exp2 rows with equal keys is held in memory.
+    Null keys never match.
+    """
+
+    exp1: Expr
+    exp2: Expr
+    col1: int
+    col2: int
+
+    def exec(self):
+        col1, col2 = self.col1, self.col2
+        rows2 = iter(self.exp2.exec())
+        row2 = next(rows2, None)
+        run, run_key = [], None  # type: List[Tuple], Any
+        for row1 in self.exp1.exec():
+            key = row1[col1]
+            if key is None:
+                continue
+            if not run or key != run_key:
+                while row2 is not None and (row2[col2] is None or row2[col2] < key):
+                    row2 = next(rows2, None)
+                run, run_key = [], key
+                while row2 is not None and row2[col2] == key:
+                    run.append(row2)
+                    row2 = next(rows2, None)
+            for match in run:
+                yield (*row1, *match)
+
+
+@dataclass
+class Limit(Expr):
+    """
+    At most limit rows of expr, all of them if limit is None, after
+    skipping offset rows. Batches are requested from expr no larger than
+    the rows still wanted, so the scans and joins below stop reading once
+    there are enough rows.
+    """
+
+    expr: Expr
+    limit: Optional[int]
+    offset: int = 0
+
+    def exec(self):
+        return unbatched(self.exec_batches())
+
+    def exec_batches(self, size=BATCH_SIZE):
+        skip, left = self.offset, self.limit
+        if left is not None:
+            if not left:
+                return
+            size = min(size, skip + left)
+        for batch in self.expr.exec_batches(size):
+            if skip:
+                if skip >= len(batch):
+                    skip -= len(batch)
+                    continue
+                batch, skip = batch[skip:], 0
+            if left is not None:
+                batch = batch[:left]
+                left -= len(batch)
+            yield batch
+            if left == 0:
+                return
+
+
+def sort_key(columns: Sequence[int]) -> Callable[[Tuple], Any]:
+    """orders rows by columns, with nulls before other values"""
+    if len(columns) == 1:
+        (col,) = columns
+        return lambda row: (row[col] is not None, row[col])
+    return lambda row: tuple((row[col] is not None, row[col]) for col in columns)
+
+
+@dataclass
+class Sort(Expr):
+    """
+    Rows of expr ordered by columns, nulls first. Sorts in memory up to
+    about memory bytes of rows; beyond that, sorted runs of that size are
+    spilled to temp files with marshal and merged. With limit, only the
+    first limit rows are kept, in a bounded heap.
+    """
+
+    expr: Expr
+    columns: Sequence[int]
+    reverse: bool = False
+    limit: Optional[int] = None
+    memory: int = SORT_MEMORY
+
+    def exec(self):
+        key = sort_key(self.columns)
+        if self.limit is not None:
+            rows = unbatched(self.expr.exec_batches())
+            top = heapq.nlargest if self.reverse else heapq.nsmallest
+            return iter(top(self.limit, rows, key=key))
+        return self._sorted(key)
+
+    def _sorted(self, key: Callable[[Tuple], Any]) -> Iterator[Tuple]:
+        run = []  # type: List[Tuple]
+        run_size = 0  # rows
+        runs = []  # type: List[IO[bytes]]
+        try:
+            for batch in self.expr.exec_batches():
+                if not run_size:
+                    run_size = max(1, self.memory // row_size(batch))
+                run.extend(batch)
+                if len(run) >= run_size:
+                    run.sort(key=key, reverse=self.reverse)
+                    runs.append(_spill(run))
+                    run = []
+            run.sort(key=key, reverse=self.reverse)
+            if not runs:
+                yield from run
+                return
+            merge = [_read_spilled(file) for file in runs] + [iter(run)]
+            yield from heapq.merge(*merge, key=key, reverse=self.reverse)
+        finally:
+            for file in runs:
+                file.close()
+
+
+def _spill(rows: List[Tuple]) -> IO[bytes]:
+    """rows written to a temp file, in chunks, ready to be read back"""
+    file = tempfile.TemporaryFile()
+    try:
+        for start in range(0, len(rows), SPILL_CHUNK):
+            marshal.dump(rows[start : start + SPILL_CHUNK], file)
+        file.seek(0)
+    except:
+        file.close()
+        raise
+    return file
+
+
+def _read_spilled(file: IO[bytes]) -> Iterator[Tuple]:
+    """rows of a spill file, a chunk at a time"""
+    while True:
+        try:
+            chunk = marshal.load(file)
+        except EOFError:
+            return
+        yield from chunk
+
+
+def row_size(rows: Sequence[Tuple]) -> int:
+    """estimated bytes taken up by one of rows"""
+    size = sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row)) for row in rows)
+    return max(1, size // max(1, len(rows)))
 
 
 @dataclass
@@ -149,3 +744,299 @@ class ColumnProjection(Expr):
 
     def _project(self, row):
         return tuple(row[col] for col in self.columns)
+
+    def exec_batches(self, size=BATCH_SIZE):
+        batches = self.array_batches(size)
+        return self._project_batches(size) if batches is None else batches
+
+    def _project_batches(self, size):
+        if len(self.columns) == 1:
+            (col,) = self.columns
+            for batch in self.expr.exec_batches(size):
+                yield [(row[col],) for row in batch]
+        else:
+            project = operator.itemgetter(*self.columns)
+            for batch in self.expr.exec_batches(size):
+                yield list(map(project, batch))
+
+    def array_batches(self, size=BATCH_SIZE):
+        """
+        When the rows come from a scan, maybe filtered, they are projected
+        straight from the table's column arrays
+        """
+        if not isinstance(self.expr, (Scan, FilteredScan)) or not self.columns:
+            return None
+        arrays = [self.expr.table.column_array(col) for col in self.columns]
+        if any(array is None for array in arrays):
+            return None
+        if isinstance(self.expr, Scan):
+            starts = range(0, len(arrays[0]), size)
+            index = [slice(start, start + size) for start in starts]
+        else:
+            rowids = self.expr.selection()
+            if rowids is None:
+                return None
+            starts = range(0, len(rowids), size)
+            index = [rowids[start : start + size] for start in starts]
+        return (vector.take(arrays, i) for i in index)
+
+
+class AggFunc(Enum):
+    COUNT = "COUNT"
+    SUM = "SUM"
+    MIN = "MIN"
+    MAX = "MAX"
+    AVG = "AVG"
+
+
+@dataclass
+class Aggregation:
+    """func of column col, ignoring nulls, or the number of rows if col is None"""
+
+    func: AggFunc
+    col: Optional[int] = None
+
+
+class Accumulator:
+    """
+    Computes aggregations over groups of rows. The state of a group is a
+    list with a slot per aggregation, two for AVG: its sum and count. States
+    of parts of a group merge into the state of the whole.
+    """
+
+    _INITIAL = {
+        AggFunc.COUNT: (0,),
+        AggFunc.SUM: (None,),
+        AggFunc.MIN: (None,),
+        AggFunc.MAX: (None,),
+        AggFunc.AVG: (0, 0),
+    }
+    _MERGES = {
+        AggFunc.COUNT: (operator.add,),
+        AggFunc.SUM: (operator.add,),
+        AggFunc.MIN: (min,),
+        AggFunc.MAX: (max,),
+        AggFunc.AVG: (operator.add, operator.add),
+    }  # type: Dict[AggFunc, Tuple[Callable[[Any, Any], Any], ...]]
+
+    def __init__(self, aggs: Sequence[Aggregation]):
+        for agg in aggs:
+            if agg.col is None and agg.func != AggFunc.COUNT:
+                raise ValueError("{} needs a column".format(agg.func.value))
+        self.aggs = aggs
+        self._initial = [val for agg in aggs for val in self._INITIAL[agg.func]]
+        self._merges = [merge for agg in aggs for merge in self._MERGES[agg.func]]
+
+    def initial(self) -> List[Any]:
+        """the state of an empty group"""
+        return list(self._initial)
+
+    def updater(
+        self, columns: Sequence[int]
+    ) -> Callable[[Iterable[Tuple], Dict[Tuple, List[Any]]], None]:
+        """
+        A function that adds rows to the states of their groups, keyed by
+        group_key(columns). It is generated for the aggregations, so each
+        row costs a single pass of straight-line code.
+        """
+        key = "".join("row[{}], ".format(col) for col in columns)
+        lines = [
+            "def update(rows, states):",
+            "    for row in rows:",
+            "        key = ({})".format(key),
+            "        state = states.get(key)",
+            "        if state is None:",
+            "            state = states[key] = {!r}".format(self._initial),
+        ]
+        i = 0
+        for agg in self.aggs:
+            if agg.col is None:
+                lines.append("        state[{}] += 1".format(i))
+                i += 1
+                continue
+            lines.append("        value = row[{}]".format(agg.col))
+            lines.append("        if value is not None:")
+            update = _UPDATES[agg.func].format(i=i, j=i + 1)
+            lines.extend("            " + line for line in update.split("\n"))
+            i += len(self._INITIAL[agg.func])
+        return _compile_update("\n".join(lines) + "\n")
+
+    def merge(self, state: List[Any], other: Sequence[Any]):
+        """merge other into state"""
+        for i, (merge, value) in enumerate(zip(self._merges, other)):
+            if value is not None:
+                state[i] = value if state[i] is None else merge(state[i], value)
+
+    def final(self, state: Sequence[Any]) -> Tuple:
+        """the values of the aggregations"""
+        values, i = [], 0
+        for agg in self.aggs:
+            if agg.func == AggFunc.AVG:
+                total, count = state[i : i + 2]
+                values.append(total / count if count else None)
+                i += 2
+            else:
+                values.append(state[i])
+                i += 1
+        return tuple(values)
+
+
+# code that adds a value to slot i, and j, of a state
+_UPDATES = {
+    AggFunc.COUNT: "state[{i}] += 1",
+    AggFunc.SUM: "state[{i}] = value if state[{i}] is None else state[{i}] + value",
+    AggFunc.MIN: "if state[{i}] is None or value < state[{i}]:\n    state[{i}] = value",
+    AggFunc.MAX: "if state[{i}] is None or value > state[{i}]:\n    state[{i}] = value",
+    AggFunc.AVG: "state[{i}] += value\nstate[{j}] += 1",
+}
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_update(source: str) -> Callable:
+    scope = {}  # type: dict
+    exec(compile(source, "<aggregate>", "exec"), scope)
+    return scope["update"]
+
+
+def group_key(columns: Sequence[int]) -> Callable[[Tuple], Tuple]:
+    """the values of columns in a row, as a tuple"""
+    if not columns:
+        return lambda row: ()
+    if len(columns) == 1:
+        (col,) = columns
+        return lambda row: (row[col],)
+    return operator.itemgetter(*columns)
+
+
+@dataclass
+class HashAggregate(Expr):
+    """
+    Rows of expr grouped on the values of columns, nulls included. Each
+    group yields the values of columns followed by those of aggs, and only
+    its Accumulator state is kept while expr is read. Without columns there
+    is one group, even when expr has no rows.
+
+    With partial, groups yield their states instead of aggregated values,
+    for a FinalAggregate to merge, e.g. across partitions of the input.
+    """
+
+    expr: Expr
+    columns: Sequence[int]
+    aggs: Sequence[Aggregation]
+    partial: bool = False
+
+    def exec(self):
+        acc = Accumulator(self.aggs)
+        states = {}  # type: Dict[Tuple, List[Any]]
+        state = self._array_state()
+        if state is not None:
+            states[()] = state
+        else:
+            update = acc.updater(self.columns)
+            for batch in self.expr.exec_batches():
+                update(batch, states)
+        if not self.columns and not states:
+            states[()] = acc.initial()
+        if self.partial:
+            return (group + tuple(state) for group, state in states.items())
+        return (group + acc.final(state) for group, state in states.items())
+
+    def _array_state(self) -> Optional[List[Any]]:
+        """
+        Without group columns, the state of the one group reduced from the
+        column arrays of the table expr scans, if it has them for every
+        aggregated column and the condition of a FilteredScan.
+        """
+        expr = self.expr
+        if self.columns or not isinstance(expr, (Scan, FilteredScan)):
+            return None
+        cols = {agg.col for agg in self.aggs if agg.col is not None}
+        arrays = {}  # type: Dict[int, Any]
+        for col in cols:
+            array = expr.table.column_array(col)
+            if array is None:
+                return None
+            arrays[col] = array
+        if isinstance(expr, FilteredScan):
+            rowids = expr.selection()
+            if rowids is None:
+                return None
+            arrays = {col: array[rowids] for col, array in arrays.items()}
+            count = len(rowids)
+        elif arrays:
+            count = len(next(iter(arrays.values())))
+        else:
+            return None  # COUNT(*) only, see TableCount
+        state = []  # type: List[Any]
+        for agg in self.aggs:
+            if agg.col is None or agg.func == AggFunc.COUNT:
+                state.append(count)  # arrays hold no nulls
+            elif agg.func == AggFunc.AVG:
+                state.extend((vector.reduce("SUM", arrays[agg.col]) or 0, count))
+            else:
+                state.append(vector.reduce(agg.func.value, arrays[agg.col]))
+        return state
+
+
+@dataclass
+class FinalAggregate(Expr):
+    """
+    Merges the rows of partial HashAggregates, in expr, that group on
+    ngroup columns and compute aggs. Yields what a single HashAggregate
+    over all of their input would.
+    """
+
+    expr: Expr
+    ngroup: int
+    aggs: Sequence[Aggregation]
+
+    def exec(self):
+        acc = Accumulator(self.aggs)
+        n = self.ngroup
+        states = {}  # type: Dict[Tuple, List[Any]]
+        for row in self.expr.exec():
+            group, other = row[:n], row[n:]
+            state = states.get(group)
+            if state is None:
+                states[group] = list(other)
+            else:
+                acc.merge(state, other)
+        if not n and not states:
+            states[()] = acc.initial()
+        return (group + acc.final(state) for group, state in states.items())
+
+
+@dataclass
+class StreamAggregate(Expr):
+    """
+    HashAggregate for expr whose rows are already ordered on columns, so
+    that each group is a run of rows. Groups are yielded as they end and
+    only the current one is held in memory.
+    """
+
+    expr: Expr
+    columns: Sequence[int]
+    aggs: Sequence[Aggregation]
+
+    def exec(self):
+        acc = Accumulator(self.aggs)
+        update = acc.updater(())  # rows of a run all belong to its group
+        rows = unbatched(self.expr.exec_batches())
+        empty = True
+        for group, run in itertools.groupby(rows, group_key(self.columns)):
+            empty = False
+            states = {}  # type: Dict[Tuple, List[Any]]
+            update(run, states)
+            yield group + acc.final(states[()])
+        if empty and not self.columns:
+            yield acc.final(acc.initial())
+
+
+@dataclass
+class TableCount(Expr):
+    """COUNT(*) of a whole table, from its row count"""
+
+    table: ITable
+
+    def exec(self):
+        return iter([(self.table.count(),)])
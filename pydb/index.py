@@ -1,32 +1,79 @@
 import bisect
-from typing import Dict, Generic, Iterator, Optional, TypeVar
+import itertools
+import os
+import pickle
+import struct
+from enum import Enum
+from typing import (
+    Any,
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from .buffer import BufferPool
 
 K = TypeVar("K")
 V = TypeVar("V")
 
 
+class IndexKind(Enum):
+    HASH = "HASH"
+    SORTED = "SORTED"
+    BITMAP = "BITMAP"
+
+
 class Index(Generic[K, V]):
+    unique = True  # at most one value per key
+
     def find(self, key: K) -> Optional[V]:
         pass
 
+    def find_all(self, key: K) -> Iterator[V]:
+        """values of every entry with key"""
+        val = self.find(key)
+        return iter(()) if val is None else iter((val,))
+
     def insert(self, key: K, val: V):
         pass
 
-    def update(self, key: K, val, V) -> Optional[V]:
+    def insert_many(self, items: Iterable[Tuple[K, V]]):
+        for key, val in items:
+            self.insert(key, val)
+
+    def update(self, key: K, val: V) -> Optional[V]:
         pass
 
-    def remove(self, key: K) -> Optional[V]:
+    def remove(self, key: K, val: Optional[V] = None) -> Optional[V]:
+        """with val, only the entry of key with that value is removed"""
         pass
 
 
 class SortedIndex(Index):
     def find(self, key):
-        return next(self.scan(key), None)
+        for found, val in self.items(key):
+            return val if found == key else None
+        return None
 
     def scan(self, start: K = None) -> Iterator[V]:
-        pass
+        """values of keys >= start in key order"""
+        return (val for _, val in self.items(start))
 
     def rscan(self, start: K = None) -> Iterator[V]:
+        """values of keys <= start in reverse key order"""
+        return (val for _, val in self.ritems(start))
+
+    def items(self, start: K = None) -> Iterator[Tuple[K, V]]:
+        """(key, value) for keys >= start in key order"""
+        pass
+
+    def ritems(self, start: K = None) -> Iterator[Tuple[K, V]]:
+        """(key, value) for keys <= start in reverse key order"""
         pass
 
 
@@ -42,50 +89,947 @@ class HashIndex(Index):
             raise ValueError("duplicate key {}".format(key))
         self._index[key] = val
 
+    def insert_many(self, items):
+        """all or nothing"""
+        items = list(items)
+        batch = dict(items)
+        if len(batch) != len(items) or not self._index.keys().isdisjoint(batch):
+            seen = set(self._index)
+            for key, _ in items:
+                if key in seen:
+                    raise ValueError("duplicate key {}".format(key))
+                seen.add(key)
+        self._index.update(batch)
+
     def update(self, key, val):
         old = self._index.get(key, None)
         self._index[key] = val
         return old
 
-    def remove(self, key):
-        val = self._index.get(key)
-        if val:
+    def remove(self, key, val=None):
+        found = self._index.get(key, None)
+        if found is None or (val is not None and found != val):
+            return None
+        del self._index[key]
+        return found
+
+
+class MultiHashIndex(Index):
+    """
+    Hash index of keys that may repeat: each key maps to the list of its
+    values in insertion order. None keys aren't indexed.
+    """
+
+    unique = False
+
+    def __init__(self, index: Dict[K, List[V]] = None):
+        self._index = index or {}
+
+    @classmethod
+    def from_items(cls, items: Iterable[Tuple[Any, Any]]) -> "MultiHashIndex":
+        """build an index in one pass over items"""
+        index = {}  # type: Dict[Any, List]
+        for key, val in items:
+            if key is None:
+                continue
+            vals = index.get(key, None)
+            if vals is None:
+                index[key] = [val]
+            else:
+                vals.append(val)
+        return cls(index)
+
+    def __len__(self):
+        return sum(map(len, self._index.values()))
+
+    def find(self, key):
+        vals = self._index.get(key, None)
+        return vals[0] if vals else None
+
+    def find_all(self, key):
+        return iter(tuple(self._index.get(key, ())))
+
+    def insert(self, key, val):
+        if key is None:
+            return
+        vals = self._index.get(key, None)
+        if vals is None:
+            self._index[key] = [val]
+        else:
+            vals.append(val)
+
+    def update(self, key, val):
+        """adds val to key unless it is there already"""
+        if key is None:
+            return None
+        vals = self._index.setdefault(key, [])
+        if val in vals:
+            return val
+        vals.append(val)
+        return None
+
+    def remove(self, key, val=None):
+        vals = self._index.get(key, None)
+        if not vals or (val is not None and val not in vals):
+            return None
+        if val is None:
+            val = vals.pop()
+        else:
+            vals.remove(val)
+        if not vals:
             del self._index[key]
         return val
 
+
 class SortedListIndex(SortedIndex):
+    """
+    Sorted keys and values split into chunks of at most 2 * CHUNK_SIZE
+    entries, with the largest key of each chunk kept in _maxes. Finding a
+    key is two binary searches, and inserts and removes only shift entries
+    within one chunk. Duplicate keys are allowed.
+
+    Scans iterate the chunks in place. Changing the index while a scan is
+    in progress may make the scan skip or repeat entries.
+    """
+
+    CHUNK_SIZE = 512
+
     def __init__(self):
-        self._keys = []
-        self._vals = []
+        self._keys = []  # type: List[List]
+        self._vals = []  # type: List[List]
+        self._maxes = []  # type: List
+        self._len = 0
+
+    @classmethod
+    def from_sorted(cls, items: Iterable[Tuple[Any, Any]]) -> "SortedListIndex":
+        """build an index from items sorted by key"""
+        index = cls()
+        keys, vals = [], []  # type: Tuple[List, List]
+        for key, val in items:
+            if keys and key < keys[-1]:
+                raise ValueError("unsorted key {}".format(key))
+            keys.append(key)
+            vals.append(val)
+        for start in range(0, len(keys), cls.CHUNK_SIZE):
+            index._keys.append(keys[start : start + cls.CHUNK_SIZE])
+            index._vals.append(vals[start : start + cls.CHUNK_SIZE])
+            index._maxes.append(index._keys[-1][-1])
+        index._len = len(keys)
+        return index
+
+    def __len__(self):
+        return self._len
+
+    def find(self, key):
+        i = bisect.bisect_left(self._maxes, key)
+        if i < len(self._maxes):
+            keys = self._keys[i]
+            j = bisect.bisect_left(keys, key)  # < len(keys) as keys[-1] >= key
+            if keys[j] == key:
+                return self._vals[i][j]
+        return None
 
     def insert(self, key, val):
-        idx = bisect.bisect_left(self._keys, key)
-        self._keys.insert(idx, key)
-        self._vals.insert(idx, val)
+        if not self._maxes:
+            self._keys.append([key])
+            self._vals.append([val])
+            self._maxes.append(key)
+            self._len = 1
+            return
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._maxes[i] = key
+        keys, vals = self._keys[i], self._vals[i]
+        j = bisect.bisect_left(keys, key)
+        keys.insert(j, key)
+        vals.insert(j, val)
+        self._len += 1
+        if len(keys) > 2 * self.CHUNK_SIZE:
+            half = self.CHUNK_SIZE
+            self._keys[i : i + 1] = [keys[:half], keys[half:]]
+            self._vals[i : i + 1] = [vals[:half], vals[half:]]
+            self._maxes.insert(i, keys[half - 1])
 
     def update(self, key, val):
-        idx = bisect.bisect_left(self._keys, key)
-        if idx < len(self._keys) and self._keys[idx] == key:
-            old = self._vals[idx]
-            self._vals[idx] = val
+        i, j = self._bisect(key, bisect.bisect_left)
+        if i < len(self._keys) and j < len(self._keys[i]) and self._keys[i][j] == key:
+            old = self._vals[i][j]
+            self._vals[i][j] = val
             return old
         return None
 
-    def scan(self, key = None):
+    def scan(self, key=None):
+        if key is None:
+            i, j = 0, 0
+        else:
+            i, j = self._bisect(key, bisect.bisect_left)
+        if i < len(self._vals):
+            yield from itertools.islice(self._vals[i], j, None)
+        for vals in itertools.islice(self._vals, i + 1, None):
+            yield from vals
+
+    def rscan(self, key=None):
+        if not self._vals:
+            return
+        if key is None:
+            i = len(self._vals) - 1
+            j = len(self._vals[i])
+        else:
+            i, j = self._bisect(key, bisect.bisect_right)
+        vals = self._vals[i]
+        for k in range(j - 1, -1, -1):
+            yield vals[k]
+        for k in range(i - 1, -1, -1):
+            yield from reversed(self._vals[k])
+
+    def items(self, key=None):
+        if key is None:
+            i, j = 0, 0
+        else:
+            i, j = self._bisect(key, bisect.bisect_left)
+        if i < len(self._vals):
+            yield from zip(
+                itertools.islice(self._keys[i], j, None),
+                itertools.islice(self._vals[i], j, None),
+            )
+        for keys, vals in zip(
+            itertools.islice(self._keys, i + 1, None),
+            itertools.islice(self._vals, i + 1, None),
+        ):
+            yield from zip(keys, vals)
+
+    def ritems(self, key=None):
+        if not self._vals:
+            return
+        if key is None:
+            i = len(self._vals) - 1
+            j = len(self._vals[i])
+        else:
+            i, j = self._bisect(key, bisect.bisect_right)
+        keys, vals = self._keys[i], self._vals[i]
+        for k in range(j - 1, -1, -1):
+            yield keys[k], vals[k]
+        for k in range(i - 1, -1, -1):
+            yield from zip(reversed(self._keys[k]), reversed(self._vals[k]))
+
+    def remove(self, key, val=None):
+        i, j = self._bisect(key, bisect.bisect_left)
+        while True:
+            if i < len(self._keys) and j == len(self._keys[i]):
+                i, j = i + 1, 0
+            if i == len(self._keys) or self._keys[i][j] != key:
+                return None
+            if val is None or self._vals[i][j] == val:
+                break
+            j += 1
+        keys, vals = self._keys[i], self._vals[i]
+        keys.pop(j)
+        val = vals.pop(j)
+        self._len -= 1
+        if not keys:
+            del self._keys[i], self._vals[i], self._maxes[i]
+        else:
+            self._maxes[i] = keys[-1]
+        return val
+
+    def _bisect(self, key, bisect_fn) -> Tuple[int, int]:
+        """(chunk, position) bisect_fn would return for key in the full list"""
+        i = bisect_fn(self._maxes, key)
+        if i == len(self._maxes):
+            return (i - 1, len(self._keys[i - 1])) if i else (0, 0)
+        return i, bisect_fn(self._keys[i], key)
+
+
+# bit positions set in each byte value
+_BYTE_BITS = [tuple(i for i in range(8) if byte >> i & 1) for byte in range(256)]
+
+
+class Bitmap:
+    """
+    Set of non-negative ints, split roaring style into chunks of
+    2 ** CHUNK_BITS values by their high bits. Each chunk is a Python int
+    used as a bitset and empty chunks aren't stored, so sparse sets stay
+    small and set operations run chunk by chunk on whole ints.
+
+    Iterates in increasing order.
+    """
+
+    CHUNK_BITS = 16
+    MASK = (1 << CHUNK_BITS) - 1
+
+    __slots__ = ("_chunks",)
+
+    def __init__(self, chunks: Optional[Dict[int, int]] = None):
+        self._chunks = chunks if chunks is not None else {}  # high bits -> bits
+
+    @classmethod
+    def from_iterable(cls, vals: Iterable[int]) -> "Bitmap":
+        lows = {}  # type: Dict[int, List[int]]
+        for val in vals:
+            chunk = lows.get(val >> cls.CHUNK_BITS, None)
+            if chunk is None:
+                lows[val >> cls.CHUNK_BITS] = [val & cls.MASK]
+            else:
+                chunk.append(val & cls.MASK)
+        chunks = {}
+        for high, chunk in lows.items():
+            bits = bytearray((cls.MASK >> 3) + 1)
+            for low in chunk:
+                bits[low >> 3] |= 1 << (low & 7)
+            chunks[high] = int.from_bytes(bits, "little")
+        return cls(chunks)
+
+    def __len__(self):
+        return sum(bin(bits).count("1") for bits in self._chunks.values())
+
+    def __bool__(self):
+        return bool(self._chunks)
+
+    def __contains__(self, val: int):
+        bits = self._chunks.get(val >> self.CHUNK_BITS, 0)
+        return bits >> (val & self.MASK) & 1 == 1
+
+    def __eq__(self, other):
+        return isinstance(other, Bitmap) and self._chunks == other._chunks
+
+    def __iter__(self) -> Iterator[int]:
+        for high in sorted(self._chunks):
+            bits = self._chunks[high]
+            base = high << self.CHUNK_BITS
+            data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+            for i, byte in enumerate(data):
+                if byte:
+                    for bit in _BYTE_BITS[byte]:
+                        yield base + i * 8 + bit
+
+    def __repr__(self):
+        return "Bitmap({})".format(list(self))
+
+    def add(self, val: int):
+        high = val >> self.CHUNK_BITS
+        self._chunks[high] = self._chunks.get(high, 0) | 1 << (val & self.MASK)
+
+    def discard(self, val: int):
+        high = val >> self.CHUNK_BITS
+        bits = self._chunks.get(high, 0) & ~(1 << (val & self.MASK))
+        if bits:
+            self._chunks[high] = bits
+        else:
+            self._chunks.pop(high, None)
+
+    def copy(self) -> "Bitmap":
+        return Bitmap(dict(self._chunks))
+
+    def __and__(self, other: "Bitmap") -> "Bitmap":
+        small, large = sorted((self._chunks, other._chunks), key=len)
+        chunks = {}
+        for high, bits in small.items():
+            bits &= large.get(high, 0)
+            if bits:
+                chunks[high] = bits
+        return Bitmap(chunks)
+
+    def __or__(self, other: "Bitmap") -> "Bitmap":
+        chunks = dict(self._chunks)
+        for high, bits in other._chunks.items():
+            chunks[high] = chunks.get(high, 0) | bits
+        return Bitmap(chunks)
+
+    def __sub__(self, other: "Bitmap") -> "Bitmap":
+        chunks = {}
+        for high, bits in self._chunks.items():
+            bits &= ~other._chunks.get(high, 0)
+            if bits:
+                chunks[high] = bits
+        return Bitmap(chunks)
+
+
+class BitmapIndex(Index):
+    """
+    A Bitmap of rowids per distinct key, for columns with few distinct
+    values. Lookups on several columns combine with bitmap AND/OR/NOT
+    before any row is read.
+
+    Unlike other indexes that may repeat keys, None is indexed like any
+    other key, so all() is every indexed row. Values must be rowids.
+    Bitmaps returned by bitmap() must not be modified.
+    """
+
+    unique = False
+
+    def __init__(self):
+        self._bitmaps = {}  # type: Dict[Any, Bitmap]
+
+    @classmethod
+    def from_items(cls, items: Iterable[Tuple[Any, int]]) -> "BitmapIndex":
+        """build an index in one pass over items"""
+        index = cls()
+        index.load(items)
+        return index
+
+    def load(self, items: Iterable[Tuple[Any, int]]):
+        """replace the contents with items"""
+        rowids = {}  # type: Dict[Any, List[int]]
+        for key, rowid in items:
+            vals = rowids.get(key, None)
+            if vals is None:
+                rowids[key] = [rowid]
+            else:
+                vals.append(rowid)
+        self._bitmaps = {
+            key: Bitmap.from_iterable(vals) for key, vals in rowids.items()
+        }
+
+    def __len__(self):
+        return sum(map(len, self._bitmaps.values()))
+
+    def keys(self) -> Iterable[Any]:
+        return self._bitmaps.keys()
+
+    def bitmap(self, key: Any) -> Bitmap:
+        return self._bitmaps.get(key, None) or Bitmap()
+
+    def all(self) -> Bitmap:
+        result = Bitmap()
+        for bitmap in self._bitmaps.values():
+            result = result | bitmap
+        return result
+
+    def find(self, key):
+        return next(self.find_all(key), None)
+
+    def find_all(self, key):
+        return iter(self.bitmap(key))
+
+    def insert(self, key, val):
+        bitmap = self._bitmaps.get(key, None)
+        if bitmap is None:
+            bitmap = self._bitmaps[key] = Bitmap()
+        bitmap.add(val)
+
+    def update(self, key, val):
+        """adds val to key unless it is there already"""
+        if val in self.bitmap(key):
+            return val
+        self.insert(key, val)
+        return None
+
+    def remove(self, key, val=None):
+        bitmap = self._bitmaps.get(key, None)
+        if bitmap is None:
+            return None
+        if val is None:
+            val = next(iter(bitmap))
+        elif val not in bitmap:
+            return None
+        bitmap.discard(val)
+        if not bitmap:
+            del self._bitmaps[key]
+        return val
+
+
+class _Top:
+    """compares greater than everything else"""
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return other is self
+
+    def __gt__(self, other):
+        return other is not self
+
+    def __ge__(self, other):
+        return True
+
+
+class MultiSortedIndex(SortedIndex):
+    """
+    Sorted index of keys that may repeat, on top of a SortedIndex of unique
+    (key, value) keys. Entries with equal keys are in value order. None
+    keys aren't indexed.
+
+    The underlying index only stores True as the value, so large values
+    don't count twice against the size of a BTreeIndex entry.
+    """
+
+    unique = False
+    TOP = _Top()
+
+    def __init__(self, index: Optional[SortedIndex] = None):
+        self._index = index if index is not None else SortedListIndex()
+
+    @classmethod
+    def from_sorted(cls, items: Iterable[Tuple[Any, Any]]) -> "MultiSortedIndex":
+        """build an index from items sorted by key, then value"""
+        return cls(SortedListIndex.from_sorted(cls._entries(items)))
+
+    def load(self, items: Iterable[Tuple[Any, Any]]):
+        """replace the contents of an underlying index that supports load()"""
+        self._index.load(self._entries(items))  # type: ignore
+
+    def __len__(self):
+        return len(self._index)
+
+    def find(self, key):
+        return next(self.find_all(key), None)
+
+    def find_all(self, key):
         if key is None:
-            return iter(self._vals)
-        idx = bisect.bisect_left(self._keys, key)
-        return iter(self._vals[idx:])
+            return  # None keys aren't indexed
+        for (found, val), _ in self._index.items((key,)):
+            if found != key:
+                return
+            yield val
+
+    def insert(self, key, val):
+        if key is not None:
+            self._index.insert((key, val), True)
 
-    def rscan(self, key = None):
+    def insert_many(self, items):
+        self._index.insert_many(self._entries(items))
+
+    def update(self, key, val):
+        """adds val to key unless it is there already"""
         if key is None:
-            return reversed(self._vals)
-        idx = bisect.bisect_right(self._keys, key)
-        return reversed(self._vals[:idx])
-
-    def remove(self, key):
-        idx = bisect.bisect_left(self._keys, key)
-        if idx < len(self._keys) and self._keys[idx] == key:
-            self._keys.pop(idx)
-            return self._vals.pop(idx)
+            return None
+        return val if self._index.update((key, val), True) else None
+
+    def remove(self, key, val=None):
+        if val is None:
+            val = self.find(key)
+            if val is None:
+                return None
+        return val if self._index.remove((key, val)) else None
+
+    def items(self, start=None):
+        entries = self._index.items(None if start is None else (start,))
+        return (entry for entry, _ in entries)
+
+    def ritems(self, start=None):
+        entries = self._index.ritems(None if start is None else (start, self.TOP))
+        return (entry for entry, _ in entries)
+
+    @staticmethod
+    def _entries(items):
+        return (((key, val), True) for key, val in items if key is not None)
+
+
+class _Node:
+    """
+    B+tree node. Leaves hold sorted keys and their values and are linked
+    both ways. Inner nodes hold n keys and n + 1 children: keys under
+    children[i] are >= keys[i - 1] and < keys[i].
+    """
+
+    __slots__ = ("leaf", "keys", "vals", "prev", "next", "size")
+
+    def __init__(self, leaf: bool, keys: List, vals: List, prev=0, next=0, size=0):
+        self.leaf = leaf
+        self.keys = keys
+        self.vals = vals  # values in leaves, child page numbers otherwise
+        self.prev = prev  # leaf links. page 0 is the meta page, so 0 is none
+        self.next = next
+        self.size = size  # upper bound on the encoded size of the entries
+
+
+class BTreeIndex(SortedIndex):
+    """
+    B+tree of unique keys stored in fixed size pages of a file.
+
+    [meta][node]..[node]
+
+    Nodes are read and written through a BufferPool, which caches them
+    decoded, and are pickled on disk. They split when their entries no
+    longer fit a page. Removal doesn't merge underfull nodes.
+
+    The meta page holds the root, the number of pages and keys and a clean
+    flag. Like RowIndex, it is marked unclean on disk before the first
+    change after a flush, so a tree that missed changes is detected on open:
+    it is reset to empty and stale is set until its owner load()s it again.
+
+    - not threadsafe
+    """
+
+    MAGIK = b"btmagik1"
+    META = struct.Struct("<8sQQQ?")  # magik, root, num pages, num keys, clean
+    NODE = struct.Struct("<L")  # size of the pickled node
+    PAGE_SIZE = 8192
+    CAPACITY = PAGE_SIZE - NODE.size - 64  # room for pickle and link overhead
+    MAX_KEY_SIZE = CAPACITY // 4
+    VAL_SIZE = 10  # largest pickled int64, as a value or a key
+    FILL = 0.9  # of CAPACITY, for leaves built by load()
+
+    def __init__(self, fd: int, pool: BufferPool, meta: Optional[Tuple] = None):
+        self._fd = fd
+        self._pool = pool
+        self.stale = meta is None
+        if meta is None:
+            os.ftruncate(self._fd, 0)
+            self._reset()
+            self._write_meta(False)
+        else:
+            self._root, self._num_pages, self._count = meta
+            self._clean = True
+
+    @classmethod
+    def open(cls, path: str, pool: Optional[BufferPool] = None) -> "BTreeIndex":
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            meta = None  # type: Optional[Tuple]
+            data = os.pread(fd, cls.META.size, 0)
+            if len(data) == cls.META.size:
+                magik, root, num_pages, count, clean = cls.META.unpack(data)
+                size = os.fstat(fd).st_size
+                if magik == cls.MAGIK and clean and size == num_pages * cls.PAGE_SIZE:
+                    meta = (root, num_pages, count)
+            return cls(fd, pool or BufferPool(), meta)
+        except:
+            os.close(fd)
+            raise
+
+    def flush(self):
+        if self._clean:
+            return
+        self._pool.flush(self)
+        os.ftruncate(self._fd, self._num_pages * self.PAGE_SIZE)
+        os.fsync(self._fd)
+        self._write_meta(True)
+        os.fsync(self._fd)
+
+    def close(self, flush: bool = True):
+        try:
+            if flush:
+                self.flush()
+        finally:
+            self._pool.discard(self)
+            os.close(self._fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read_page(self, page_no: int) -> _Node:
+        data = os.pread(self._fd, self.PAGE_SIZE, page_no * self.PAGE_SIZE)
+        (size,) = self.NODE.unpack_from(data, 0)
+        return _Node(*pickle.loads(data[self.NODE.size : self.NODE.size + size]))
+
+    def write_pages(self, page_no: int, pages: List[_Node]):
+        data = bytearray(len(pages) * self.PAGE_SIZE)
+        for i, node in enumerate(pages):
+            state = (node.leaf, node.keys, node.vals, node.prev, node.next, node.size)
+            encoded = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+            assert self.NODE.size + len(encoded) <= self.PAGE_SIZE
+            self.NODE.pack_into(data, i * self.PAGE_SIZE, len(encoded))
+            start = i * self.PAGE_SIZE + self.NODE.size
+            data[start : start + len(encoded)] = encoded
+        os.pwrite(self._fd, data, page_no * self.PAGE_SIZE)
+
+    def __len__(self):
+        return self._count
+
+    def find(self, key):
+        leaf = self._node(self._find_leaf(key)[0][-1][0])
+        idx = bisect.bisect_left(leaf.keys, key)
+        if idx < len(leaf.keys) and leaf.keys[idx] == key:
+            return leaf.vals[idx]
         return None
+
+    def insert(self, key, val):
+        self._put(key, val, False)
+
+    def insert_many(self, items):
+        """all or nothing. Keys going to the same leaf share one descent."""
+        items = sorted(items, key=lambda item: item[0])
+        sizes = [self._check_key(key) for key, _ in items]
+        leaf, upper = None, None  # type: Optional[_Node], Any
+        for i, (key, _) in enumerate(items):
+            if leaf is None or (upper is not None and key >= upper):
+                path, upper = self._find_leaf(key)
+                leaf = self._node(path[-1][0])
+            idx = bisect.bisect_left(leaf.keys, key)
+            if (i and items[i - 1][0] == key) or (
+                idx < len(leaf.keys) and leaf.keys[idx] == key
+            ):
+                raise ValueError("duplicate key {}".format(key))
+        if items:
+            self._changed()
+        leaf = None
+        for (key, val), size in zip(items, sizes):
+            if leaf is None or (upper is not None and key >= upper):
+                if leaf is not None:
+                    self._pool.put(self, path[-1][0], leaf)
+                path, upper = self._find_leaf(key)
+                leaf = self._node(path[-1][0])
+            idx = bisect.bisect_left(leaf.keys, key)
+            leaf.keys.insert(idx, key)
+            leaf.vals.insert(idx, val)
+            leaf.size += size
+            self._count += 1
+            if leaf.size > self.CAPACITY:
+                self._pool.put(self, path[-1][0], leaf)
+                self._split(path)
+                leaf = None
+        if leaf is not None:
+            self._pool.put(self, path[-1][0], leaf)
+
+    def update(self, key, val):
+        return self._put(key, val, True)
+
+    def remove(self, key, val=None):
+        page_no = self._find_leaf(key)[0][-1][0]
+        leaf = self._node(page_no)
+        idx = bisect.bisect_left(leaf.keys, key)
+        if idx == len(leaf.keys) or leaf.keys[idx] != key:
+            return None
+        if val is not None and leaf.vals[idx] != val:
+            return None
+        self._changed()
+        leaf.keys.pop(idx)
+        leaf.size -= self._entry_size(key)
+        val = leaf.vals.pop(idx)
+        self._count -= 1
+        self._pool.put(self, page_no, leaf)
+        return val
+
+    def items(self, start=None):
+        path = self._find_leaf(start)[0] if start is not None else self._edge(0)
+        leaf = self._node(path[-1][0])
+        idx = bisect.bisect_left(leaf.keys, start) if start is not None else 0
+        while True:
+            while idx < len(leaf.vals):
+                yield leaf.keys[idx], leaf.vals[idx]
+                idx += 1
+            if not leaf.next:
+                return
+            leaf, idx = self._node(leaf.next), 0
+
+    def ritems(self, start=None):
+        path = self._find_leaf(start)[0] if start is not None else self._edge(-1)
+        leaf = self._node(path[-1][0])
+        if start is None:
+            idx = len(leaf.keys) - 1
+        else:
+            idx = bisect.bisect_right(leaf.keys, start) - 1
+        while True:
+            while 0 <= idx < len(leaf.vals):
+                yield leaf.keys[idx], leaf.vals[idx]
+                idx -= 1
+            if not leaf.prev:
+                return
+            leaf = self._node(leaf.prev)
+            idx = len(leaf.keys) - 1
+
+    def load(self, items: Iterable[Tuple[Any, Any]]):
+        """
+        Replace the contents with items, which must be sorted by key. Nodes
+        are built bottom up and packed, instead of inserted one at a time.
+        On error, the tree is left empty.
+        """
+        self._changed()
+        self._pool.discard(self)
+        self._num_pages, self._count = 1, 0
+        try:
+            self._load(items)
+        except:
+            self._reset()
+            raise
+        self.stale = False
+
+    def _load(self, items):
+        level = []  # type: List[Tuple[Any, int]]  # (first key, page_no)
+        leaves = []  # type: List[_Node]
+        leaf = _Node(True, [], [])
+        for key, val in items:
+            self._check_key(key)
+            if leaf.keys and key <= leaf.keys[-1]:
+                raise ValueError("duplicate or unsorted key {}".format(key))
+            size = self._entry_size(key)
+            if leaf.keys and leaf.size + size > self.CAPACITY * self.FILL:
+                leaves.append(leaf)
+                leaf = _Node(True, [], [])
+            leaf.keys.append(key)
+            leaf.vals.append(val)
+            leaf.size += size
+            self._count += 1
+            if len(leaves) == 256:
+                self._write_level(leaves, level)
+                leaves = []
+        leaves.append(leaf)
+        self._write_level(leaves, level)
+        while len(level) > 1:
+            nodes = []  # type: List[_Node]
+            node = None  # type: Optional[_Node]
+            firsts = []
+            for key, page_no in level:
+                size = self._entry_size(key)
+                if node is None or node.size + size > self.CAPACITY * self.FILL:
+                    node = _Node(False, [], [page_no])
+                    nodes.append(node)
+                    firsts.append(key)
+                else:
+                    node.keys.append(key)
+                    node.vals.append(page_no)
+                    node.size += size
+            level = []
+            self._write_level(nodes, level, firsts)
+        self._root = level[0][1]
+
+    def _reset(self):
+        self._pool.discard(self)
+        self._root, self._num_pages, self._count = 1, 2, 0
+        self._pool.put(self, self._root, _Node(True, [], []))
+
+    def _write_level(self, nodes, level, firsts=None):
+        """allocate consecutive pages for nodes, write them and add them to level"""
+        first_page = self._num_pages
+        for i, node in enumerate(nodes):
+            if node.leaf:
+                node.prev = first_page + i - 1 if i else (level[-1][1] if level else 0)
+                node.next = first_page + i + 1 if i + 1 < len(nodes) else 0
+                key = node.keys[0] if node.keys else None
+            else:
+                key = firsts[i]
+            level.append((key, first_page + i))
+        if nodes and nodes[0].leaf and nodes[0].prev:
+            prev = self._node(nodes[0].prev)
+            prev.next = first_page
+            self._pool.put(self, nodes[0].prev, prev)
+        self._num_pages += len(nodes)
+        self._pool.write_through(self, first_page, nodes)
+
+    def _put(self, key, val, replace: bool) -> Any:
+        path, _ = self._find_leaf(key)
+        page_no = path[-1][0]
+        leaf = self._node(page_no)
+        idx = bisect.bisect_left(leaf.keys, key)
+        if idx < len(leaf.keys) and leaf.keys[idx] == key:
+            if not replace:
+                raise ValueError("duplicate key {}".format(key))
+            self._changed()
+            old = leaf.vals[idx]
+            leaf.vals[idx] = val
+            self._pool.put(self, page_no, leaf)
+            return old
+        size = self._check_key(key)
+        self._changed()
+        leaf.keys.insert(idx, key)
+        leaf.vals.insert(idx, val)
+        leaf.size += size
+        self._count += 1
+        self._pool.put(self, page_no, leaf)
+        self._split(path)
+        return None
+
+    def _split(self, path: List[Tuple[int, int]]):
+        """split overfull nodes from the leaf of path up"""
+        for depth in range(len(path) - 1, -1, -1):
+            page_no = path[depth][0]
+            node = self._node(page_no)
+            if node.size <= self.CAPACITY:
+                return
+            # split by size rather than count so both halves fit
+            sizes = [self._entry_size(key) for key in node.keys]
+            mid, half = 1, sizes[0]
+            while mid < len(sizes) - 1 and half < node.size // 2:
+                half += sizes[mid]
+                mid += 1
+            sep = node.keys[mid]
+            right_no = self._num_pages
+            self._num_pages += 1
+            if node.leaf:
+                right = _Node(
+                    True, node.keys[mid:], node.vals[mid:], page_no, node.next
+                )
+                right.size = node.size - half
+                node.keys, node.vals = node.keys[:mid], node.vals[:mid]
+                node.next, after_no = right_no, node.next
+            else:
+                right = _Node(False, node.keys[mid + 1 :], node.vals[mid + 1 :])
+                right.size = node.size - half - sizes[mid]
+                node.keys, node.vals = node.keys[:mid], node.vals[: mid + 1]
+                after_no = 0
+            node.size = half
+            self._pool.put(self, page_no, node)
+            self._pool.put(self, right_no, right)
+            if after_no:
+                after = self._node(after_no)
+                after.prev = right_no
+                self._pool.put(self, after_no, after)
+            if depth == 0:
+                root = _Node(False, [sep], [page_no, right_no])
+                root.size = self._entry_size(sep)
+                self._root = self._num_pages
+                self._num_pages += 1
+                self._pool.put(self, self._root, root)
+                return
+            parent_no, idx = path[depth - 1]
+            parent = self._node(parent_no)
+            parent.keys.insert(idx, sep)
+            parent.vals.insert(idx + 1, right_no)
+            parent.size += self._entry_size(sep)
+            self._pool.put(self, parent_no, parent)
+
+    def _find_leaf(self, key) -> Tuple[List[Tuple[int, int]], Any]:
+        """
+        ([(page_no, child idx)] from the root down to the leaf for key, the
+        smallest key that belongs to a later leaf or None)
+        """
+        path = []
+        upper = None
+        page_no = self._root
+        node = self._node(page_no)
+        while not node.leaf:
+            idx = bisect.bisect_right(node.keys, key)
+            if idx < len(node.keys):
+                upper = node.keys[idx]
+            path.append((page_no, idx))
+            page_no = node.vals[idx]
+            node = self._node(page_no)
+        path.append((page_no, -1))
+        return path, upper
+
+    def _edge(self, idx: int) -> List[Tuple[int, int]]:
+        """path to the first (idx=0) or last (idx=-1) leaf"""
+        path = []
+        page_no = self._root
+        node = self._node(page_no)
+        while not node.leaf:
+            path.append((page_no, idx))
+            page_no = node.vals[idx]
+            node = self._node(page_no)
+        path.append((page_no, -1))
+        return path
+
+    def _node(self, page_no: int) -> _Node:
+        return self._pool.get(self, page_no)
+
+    def _check_key(self, key) -> int:
+        """returns the entry size"""
+        if key is None:
+            raise ValueError("can't index None")
+        size = self._entry_size(key)
+        if size > self.MAX_KEY_SIZE:
+            raise ValueError("key too large for index")
+        return size
+
+    def _entry_size(self, key) -> int:
+        if type(key) is int and -(2**63) <= key < 2**63:
+            return 2 * self.VAL_SIZE  # skip pickling the common case
+        return len(pickle.dumps(key, pickle.HIGHEST_PROTOCOL)) + self.VAL_SIZE
+
+    def _changed(self):
+        if self._clean:
+            self._write_meta(False)
+            os.fsync(self._fd)
+
+    def _write_meta(self, clean: bool):
+        meta = self.META.pack(
+            self.MAGIK, self._root, self._num_pages, self._count, clean
+        )
+        os.pwrite(self._fd, meta, 0)
+        self._clean = clean
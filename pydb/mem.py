@@ -1,29 +1,61 @@
-from typing import Iterable, List, Tuple
+from operator import itemgetter
+from typing import Any, Callable, Iterable, List, Optional, Tuple
 
 from .core import Cursor, Database
-from .index import HashIndex, Index
+from .explain import explain_query
+from .expr import Expr, unbatched
+from .index import (
+    BitmapIndex,
+    HashIndex,
+    Index,
+    IndexKind,
+    MultiHashIndex,
+    MultiSortedIndex,
+)
 from .parse import parse_query
-from .plan import SimplePlanner
-from .query import CreateTable, Insert, Select
-from .table import Column, ColumnAttr, Dict, ITable, Schema, check_schema
+from .pipeline import compile_pipeline
+from .plan import CostBasedPlanner
+from .prepared import PlanCache, PreparedStatement, plan_key
+from .query import (
+    Analyze,
+    CreateIndex,
+    CreateTable,
+    Explain,
+    Insert,
+    InsertMany,
+    Select,
+)
+from .stats import TableStats, analyze
+from .table import (
+    DataType,
+    Dict,
+    IndexDef,
+    ITable,
+    Schema,
+    check_index_def,
+    check_schema,
+    is_unique,
+)
+from . import vector
 
 
 class MemTable(ITable):
     def __init__(self, schema):
         self._schema = schema
         self._rows = []  # type: List[Tuple]
-        self._indexes = self._init_indexes(schema)
-
-    # TODO: Consider indexing indexes by column id, not name
-    # TODO: Consider supporting > 1 index per column
-    def _init_indexes(self, schema: Schema) -> Dict[str, Index]:
-        return {
-            col.name: HashIndex() for col in schema.columns if self._should_index(col)
-        }
-
-    def _should_index(self, col: Column) -> bool:
-        return any(
-            col.hasattr(attr) for attr in (ColumnAttr.PRIMARY_KEY, ColumnAttr.UNIQUE)
+        self._indexes = {}  # type: Dict[IndexDef, Index]
+        self._entry_fns = {}  # type: Dict[IndexDef, Tuple[Callable, Callable]]
+        # column -> (rows covered, vector.int_array() of them or None)
+        self._arrays = {}  # type: Dict[int, Tuple[int, Optional[Any]]]
+        for col in schema.columns:
+            if is_unique(col):
+                self._add_index(IndexDef((col.name,), unique=True), HashIndex())
+
+    def _add_index(self, definition: IndexDef, index: Index):
+        self._indexes[definition] = index
+        self._entry_fns[definition] = (
+            definition.key_fn(self._schema),
+            definition.val_fn(self._schema),
         )
 
     # TODO: Validate row dtypes and constraints
@@ -32,23 +64,72 @@ class MemTable(ITable):
     def insert(self, row: Tuple) -> Tuple[int, Tuple]:
         assert len(row) == len(self._schema.columns)
         rowid = len(self._rows)
-        for column, index in self._indexes.items():
-            val = row[self._schema.columnid(column)]
-            index.insert(val, rowid)
+        for definition, index in self._indexes.items():
+            key_fn, val_fn = self._entry_fns[definition]
+            index.insert(key_fn(row), val_fn(rowid, row))
         self._rows.append(row)
         return (rowid, row)
 
+    def insert_many(self, rows):
+        ncols = len(self._schema.columns)
+        if any(len(row) != ncols for row in rows):
+            raise ValueError("rows don't match schema")
+        rowids = range(len(self._rows), len(self._rows) + len(rows))
+        filled = []  # type: List[Tuple[List[Tuple], Index]]
+        try:
+            for definition, index in self._indexes.items():
+                key_fn, val_fn = self._entry_fns[definition]
+                items = [(key_fn(row), val_fn(i, row)) for row, i in zip(rows, rowids)]
+                index.insert_many(items)
+                filled.append((items, index))
+        except:
+            for items, index in filled:
+                for key, val in items:
+                    index.remove(key, val)
+            raise
+        self._rows.extend(rows)
+        return rowids
+
     def delete(self, rowid):
         raise NotImplementedError()
 
     def get(self, rowid):
         return self._rows[rowid] if rowid in range(len(self._rows)) else None
 
-    def indexes(self, column=None):
-        if not column:
-            return list(self._indexes.values())
-        index = self._indexes.get(column, None)
-        return (index,) if index else ()
+    def get_many(self, rowids):
+        return list(map(self._rows.__getitem__, rowids))
+
+    def column_array(self, col):
+        """built on first use and extended with rows inserted since"""
+        if not vector.ENABLED or self._schema.columns[col].dtype != DataType.INT:
+            return None
+        covered, array = self._arrays.get(col, (0, vector.int_array([])))
+        if array is not None and covered < len(self._rows):
+            rows = self._rows[covered:]
+            array = vector.extend(array, list(map(itemgetter(col), rows)))
+            self._arrays[col] = (covered + len(rows), array)
+        return array
+
+    def index_defs(self):
+        return list(self._indexes.items())
+
+    def create_index(self, definition):
+        check_index_def(self._schema, definition)
+        if any(d.columns == definition.columns for d in self._indexes):
+            raise ValueError("{} already indexed".format(definition.columns))
+        key_fn = definition.key_fn(self._schema)
+        val_fn = definition.val_fn(self._schema)
+        items = [(key_fn(row), val_fn(i, row)) for i, row in enumerate(self._rows)]
+        if definition.kind == IndexKind.SORTED:
+            items = [item for item in items if item[0] is not None]
+            items.sort(key=itemgetter(0))  # stable, so rowids stay in order
+            index = MultiSortedIndex.from_sorted(items)  # type: Index
+        elif definition.kind == IndexKind.BITMAP:
+            index = BitmapIndex.from_items(items)
+        else:
+            index = MultiHashIndex.from_items(items)
+        self._add_index(definition, index)
+        return index
 
     def schema(self):
         return self._schema
@@ -56,34 +137,87 @@ class MemTable(ITable):
     def rows(self):
         return iter(self._rows)
 
+    def count(self):
+        return len(self._rows)
+
+    def row_batches(self, size):
+        if size < 1:
+            raise ValueError("batch size must be positive")
+        for start in range(0, len(self._rows), size):
+            yield self._rows[start : start + size]
+
 
 class MemDatabase(Database):
     def __init__(self, name):
         self._name = name
         self._tables = {}  # type: Dict[str, ITable]
+        self._stats = {}  # type: Dict[str, TableStats]
+        self._plans = PlanCache()
 
     def exec(self, query, **options):
         if isinstance(query, str):
             query = parse_query(query)
         if isinstance(query, CreateTable):
             return self._create_table(query)
+        if isinstance(query, CreateIndex):
+            return self._create_index(query)
         if isinstance(query, Select):
             return self._select(query)
         if isinstance(query, Insert):
             return self._insert(query)
+        if isinstance(query, InsertMany):
+            return self._insert_many(query)
+        if isinstance(query, Analyze):
+            return self._analyze(query)
+        if isinstance(query, Explain):
+            return self._explain(query)
         raise NotImplementedError("unsupported query type: {}".format(type(query)))
 
+    def prepare(self, query, **options):
+        if isinstance(query, str):
+            query = parse_query(query)
+        if not isinstance(query, Select):
+            raise ValueError("only a Select can be prepared")
+        return PreparedStatement(query, self._run)
+
     def _create_table(self, query: CreateTable) -> Cursor:
         check_schema(query.schema)
         if query.schema.name in self._tables:
             raise ValueError("{} already exists".format(query.schema.name))
         self._tables[query.schema.name] = MemTable(query.schema)
+        self._plans.clear()
+        return tuple()
+
+    def _create_index(self, query: CreateIndex) -> Cursor:
+        table = self._tables.get(query.table, None)
+        if not table:
+            raise ValueError("unrecognized table {}".format(query.table))
+        table.create_index(query.definition())
+        self._plans.clear()
         return tuple()
 
     def _select(self, query: Select) -> Cursor:
-        planner = SimplePlanner(self._tables)
-        expr = planner.plan(query)
-        return expr.exec()
+        statement = PreparedStatement(query, self._run)
+        if statement.params:
+            raise ValueError("query has parameters, prepare() it")
+        return statement.exec()
+
+    def _run(self, statement: PreparedStatement, values: Tuple) -> Cursor:
+        return unbatched(self._plan(statement, values).exec_batches())
+
+    def _plan(self, statement: PreparedStatement, values: Tuple) -> Expr:
+        """the cached plan of statement, with values bound"""
+
+        def plan():
+            planner = CostBasedPlanner(self._tables, self._stats)
+            return compile_pipeline(planner.plan(statement.shape))
+
+        key = plan_key(statement, self._tables)
+        return self._plans.get(key, plan)(values)
+
+    def _explain(self, query: Explain) -> Cursor:
+        statement = PreparedStatement(query.query, self._run)
+        return explain_query(query, statement, self._plan, self._stats)
 
     def _insert(self, query: Insert) -> Cursor:
         if len(query.columns) != len(query.values):
@@ -95,4 +229,27 @@ class MemDatabase(Database):
             # TODO: Support auto-populated columns
             raise ValueError("columns don't match schema")
         rowid, row = table.insert(tuple(query.values))
+        if query.table in self._stats:
+            self._stats[query.table].add(table.schema(), [row])
         return (row,)
+
+    def _insert_many(self, query: InsertMany) -> Cursor:
+        table = self._tables.get(query.table, None)
+        if not table:
+            raise ValueError("unrecognized table {}".format(query.table))
+        if tuple(query.columns) != table.schema().column_names():
+            raise ValueError("columns don't match schema")
+        rows = [tuple(row) for row in query.rows]
+        table.insert_many(rows)
+        if query.table in self._stats:
+            self._stats[query.table].add(table.schema(), rows)
+        return rows
+
+    def _analyze(self, query: Analyze) -> Cursor:
+        names = list(self._tables) if query.table is None else [query.table]
+        for name in names:
+            if name not in self._tables:
+                raise ValueError("unrecognized table {}".format(name))
+            self._stats[name] = analyze(self._tables[name])
+        self._plans.clear()
+        return tuple()
@@ -0,0 +1,89 @@
+"""
+Parallel execution in worker processes.
+
+A ParallelScan runs a plan fragment, a scan with the filters, projection
+and partial aggregation above it, once per partition of a table in a
+ProcessPoolExecutor. Workers return their rows marshal-encoded, so only
+compact bytes cross process boundaries.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+import marshal
+from typing import Iterator, List, Optional, Tuple
+
+from .expr import (
+    BATCH_SIZE,
+    ColumnProjection,
+    Expr,
+    Filter,
+    FilteredScan,
+    HashAggregate,
+    Scan,
+    unbatched,
+)
+from .pipeline import compile_pipeline
+from .table import ITable, batched
+
+
+@dataclass
+class ParallelScan(Expr):
+    """
+    The rows of fragment, computed over up to workers * SPLIT partitions of
+    the table it scans in workers processes, and yielded in table order.
+    fragment must be a Scan or FilteredScan under any Filters, a
+    ColumnProjection and a HashAggregate, which should be partial. Tables
+    that can't be partitioned are scanned in this process.
+    """
+
+    fragment: Expr
+    workers: int
+
+    SPLIT = 4  # partitions per worker, to even out their load
+
+    def exec(self):
+        return unbatched(self.exec_batches())
+
+    def exec_batches(self, size=BATCH_SIZE):
+        table = scanned_table(self.fragment)
+        assert table is not None, "unsupported fragment"
+        parts = table.partitions(self.workers * self.SPLIT)
+        if parts is None or len(parts) < 2 or self.workers < 2:
+            yield from compile_pipeline(self.fragment).exec_batches(size)
+            return
+        fragments = [_retarget(self.fragment, part) for part in parts]
+        pool = ProcessPoolExecutor(min(self.workers, len(parts)))
+        try:
+            for data in pool.map(_run, fragments):
+                yield from batched(marshal.loads(data), size)
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+
+def scanned_table(fragment: Expr) -> Optional[ITable]:
+    """the table fragment scans, if it has the shape ParallelScan runs"""
+    if isinstance(fragment, HashAggregate):
+        fragment = fragment.expr
+    if isinstance(fragment, ColumnProjection):
+        fragment = fragment.expr
+    while isinstance(fragment, Filter):
+        fragment = fragment.expr
+    if isinstance(fragment, (Scan, FilteredScan)):
+        return fragment.table
+    return None
+
+
+def _retarget(fragment: Expr, table: ITable) -> Expr:
+    """fragment scanning table instead"""
+    if isinstance(fragment, (Scan, FilteredScan)):
+        return replace(fragment, table=table)
+    assert isinstance(fragment, (Filter, ColumnProjection, HashAggregate))
+    return replace(fragment, expr=_retarget(fragment.expr, table))
+
+
+def _run(fragment: Expr) -> bytes:
+    """runs in a worker"""
+    rows = []  # type: List[Tuple]
+    for batch in compile_pipeline(fragment).exec_batches():
+        rows.extend(batch)
+    return marshal.dumps(rows)
@@ -0,0 +1,228 @@
+from collections import defaultdict
+from dataclasses import dataclass, replace
+import functools
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .expr import (
+    BATCH_SIZE,
+    JOIN_MEMORY,
+    ColumnComp,
+    ColumnProjection,
+    Condition,
+    Conjunction,
+    Disjunction,
+    Expr,
+    Filter,
+    FilteredScan,
+    HashJoin,
+    Limit,
+    Negation,
+    Scan,
+    ValueComp,
+    row_size,
+    unbatched,
+)
+from .table import ITable
+
+_OPERATORS = {"=": "=="}  # BinOp values that aren't python operators
+
+
+@dataclass
+class CompiledPipeline(Expr):
+    """
+    A plan compiled by compile_pipeline(). fn turns a batch of table rows
+    into a batch of results in one list comprehension, with the constants of
+    the plan passed in as args. The rows of build, if set, are hashed on
+    build_col first and handed to fn, which probes them. If they take up
+    more than build_memory bytes, the uncompiled plan runs instead, and its
+    HashJoin partitions them.
+    """
+
+    plan: Expr
+    table: ITable
+    fn: Callable[..., List[Tuple]]
+    args: Tuple
+    build: Optional[Expr] = None
+    build_col: int = 0
+    build_memory: int = JOIN_MEMORY
+
+    def exec(self):
+        return unbatched(self.exec_batches())
+
+    def exec_batches(self, size=BATCH_SIZE):
+        batches = self.plan.array_batches(size)
+        if batches is not None:
+            yield from batches
+            return
+        index = None
+        if self.build is not None:
+            index = self._index(size)
+            if index is None:
+                yield from self.plan.exec_batches(size)
+                return
+        for batch in self.table.row_batches(size):
+            rows = self.fn(batch, index, *self.args)
+            for start in range(0, len(rows), size):
+                yield rows[start : start + size]
+
+    def _index(self, size: int) -> Optional[Dict[Any, List[Tuple]]]:
+        """the build rows by key, or None if they don't fit in build_memory"""
+        assert self.build is not None
+        index = defaultdict(list)  # type: Dict[Any, List[Tuple]]
+        limit, held = None, 0  # rows
+        for batch in self.build.exec_batches(size):
+            if limit is None:
+                limit = max(1, self.build_memory // row_size(batch))
+            held += len(batch)
+            if held > limit:
+                return None
+            for row in batch:
+                key = row[self.build_col]
+                if key is not None:
+                    index[key].append(row)
+        return index
+
+
+def compile_pipeline(plan: Expr) -> Expr:
+    """
+    plan as a CompiledPipeline if it is a Scan or FilteredScan, maybe
+    probing a HashJoin, under any Filters and a ColumnProjection. Other
+    plans, and a bare Scan that has nothing to fuse, are returned as they
+    are, except that the plan under a Limit is compiled.
+    """
+    if isinstance(plan, Scan):
+        return plan
+    if isinstance(plan, Limit):
+        return replace(plan, expr=compile_pipeline(plan.expr))
+    compiler = _Compiler()
+    try:
+        source = compiler.source(plan)
+    except _Unsupported:
+        return plan
+    assert compiler.table is not None  # every supported plan reads a table
+    return CompiledPipeline(
+        plan,
+        compiler.table,
+        _compile(source),
+        tuple(compiler.args),
+        compiler.build,
+        compiler.build_col,
+        compiler.build_memory,
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(source: str) -> Callable[..., List[Tuple]]:
+    """plans of the same shape share source, and so the compiled function"""
+    scope = {}  # type: dict
+    exec(compile(source, "<pipeline>", "exec"), scope)
+    return scope["pipeline"]
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _Rows:
+    """a row of a pipeline stage: the code of each column and of the tuple"""
+
+    def __init__(self, column: Callable[[int], str], whole: str, clauses: List[str]):
+        self.column = column
+        self.whole = whole
+        self.clauses = clauses  # of the list comprehension
+
+
+class _Compiler:
+    def __init__(self):
+        self.table = None  # type: Optional[ITable]
+        self.args = []  # type: List[Any]
+        self.build = None  # type: Optional[Expr]
+        self.build_col = 0
+        self.build_memory = JOIN_MEMORY
+
+    def source(self, plan: Expr) -> str:
+        if isinstance(plan, ColumnProjection):
+            if not plan.columns:
+                raise _Unsupported()
+            rows = self._rows(plan.expr)
+            result = "({},)".format(", ".join(map(rows.column, plan.columns)))
+        else:
+            rows = self._rows(plan)
+            result = rows.whole
+        params = "".join(", v{}".format(i) for i in range(len(self.args)))
+        return "def pipeline(rows, index{}):\n    return [{} {}]\n".format(
+            params, result, " ".join(rows.clauses)
+        )
+
+    def _rows(self, expr: Expr) -> _Rows:
+        if isinstance(expr, (Scan, FilteredScan)):
+            if self.table is not None:
+                raise _Unsupported()
+            self.table = expr.table
+            rows = _Rows("row[{}]".format, "row", ["for row in rows"])
+            if isinstance(expr, FilteredScan):
+                rows.clauses.append("if " + self._cond(expr.cond, rows.column))
+            return rows
+        if isinstance(expr, Filter):
+            rows = self._rows(expr.expr)
+            rows.clauses.append("if " + self._cond(expr.cond, rows.column))
+            return rows
+        if isinstance(expr, HashJoin):
+            width = _width(expr.exp1)
+            if self.build is not None or width is None:
+                raise _Unsupported()
+            right = expr.build_right
+            self.build = compile_pipeline(expr.exp2 if right else expr.exp1)
+            self.build_col = expr.col2 if right else expr.col1
+            self.build_memory = expr.memory
+            probe = self._rows(expr.exp1 if right else expr.exp2)
+            key = probe.column(expr.col1 if right else expr.col2)
+            clause = "for match in index.get({}, ())".format(key)
+
+            def column(col: int) -> str:
+                if col < width:
+                    return probe.column(col) if right else "match[{}]".format(col)
+                col -= width
+                return "match[{}]".format(col) if right else probe.column(col)
+
+            whole = "(*{}, *match)" if right else "(*match, *{})"
+            return _Rows(column, whole.format(probe.whole), probe.clauses + [clause])
+        raise _Unsupported()
+
+    def _cond(self, cond: Condition, column: Callable[[int], str]) -> str:
+        if isinstance(cond, ValueComp):
+            self.args.append(cond.val)
+            return "{} {} v{}".format(
+                column(cond.col), _operator(cond), len(self.args) - 1
+            )
+        if isinstance(cond, ColumnComp):
+            return "{} {} {}".format(
+                column(cond.col1), _operator(cond), column(cond.col2)
+            )
+        if isinstance(cond, Conjunction):
+            conds = [self._cond(c, column) for c in cond.conds]
+            return "({})".format(" and ".join(conds)) if conds else "True"
+        if isinstance(cond, Disjunction):
+            conds = [self._cond(c, column) for c in cond.conds]
+            return "({})".format(" or ".join(conds)) if conds else "False"
+        if isinstance(cond, Negation):
+            return "(not {})".format(self._cond(cond.cond, column))
+        raise _Unsupported()
+
+
+def _operator(cond: Any) -> str:
+    return _OPERATORS.get(cond.op.value, cond.op.value)
+
+
+def _width(expr: Expr) -> Optional[int]:
+    """columns in the rows of expr, if known"""
+    if isinstance(expr, (Scan, FilteredScan)):
+        return len(expr.table.schema().columns)
+    if isinstance(expr, Filter):
+        return _width(expr.expr)
+    if isinstance(expr, ColumnProjection):
+        return len(expr.columns)
+    if isinstance(expr, HashJoin):
+        width1, width2 = _width(expr.exp1), _width(expr.exp2)
+        return None if width1 is None or width2 is None else width1 + width2
+    return None
@@ -1,33 +1,63 @@
-from typing import Dict, Optional, Tuple
+from dataclasses import replace
+import functools
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 from .expr import (
+    AggFunc,
+    Aggregation,
     BinOp,
+    BitmapAnd,
+    BitmapExpr,
+    BitmapLookup,
+    BitmapNot,
+    BitmapOr,
+    BitmapScan,
     ColumnComp,
     ColumnProjection,
     Condition,
+    Conjunction,
+    Disjunction,
     Expr,
+    Filter,
     FilteredScan,
+    FinalAggregate,
     HashJoin,
     IndexedJoin,
     IndexedLookup,
-    IndexedLookup,
+    IndexOnlyLookup,
+    IndexRangeScan,
+    HashAggregate,
+    Limit,
+    MergeJoin,
+    Negation,
+    Sort,
     Scan,
+    StreamAggregate,
+    TableCount,
     ValueComp,
 )
 import typing
 from .query import (
+    Aggregate,
     BinExpr,
     Const,
     Delete,
     Join,
     JoinKind,
+    Not,
     On,
     Operand,
+    OrderBy,
+    Param,
     Query,
+    QueryExpr,
     Select,
     Symbol,
     Where,
 )
-from .table import ITable, Column
+from .index import BitmapIndex, IndexKind, SortedIndex
+from .parallel import ParallelScan, scanned_table
+from .stats import TableStats
+from .table import Column, IndexDef, ITable
 
 
 class Planner:
@@ -40,28 +70,97 @@ class SimplePlanner:
         "=": BinOp.EQ,
         "<": BinOp.LT,
         ">": BinOp.GT,
+        "<=": BinOp.LE,
+        ">=": BinOp.GE,
     }
+    # op after swapping operands: 1 < x is x > 1
+    FLIPPED = {"<": ">", ">": "<", "<=": ">=", ">=": "<="}
+    # operands that compare a column with a value
+    VALUES = (Const, Param)
 
-    def __init__(self, tables: Dict[str, ITable]):
+    def __init__(self, tables: Dict[str, ITable], parallelism: int = 1):
+        """parallelism: processes that scan a table, see ParallelScan"""
+        if parallelism < 1:
+            raise ValueError("parallelism must be positive")
         self._tables = tables
+        self._parallelism = parallelism
 
     def plan(self, query: Query) -> Expr:
         if isinstance(query, Select):
-            return self._plan_select(query)
+            expr = self._plan_select(query)
+            return self._parallelize(expr) if self._parallelism > 1 else expr
         else:
             raise NotImplementedError("unsupported query type {}".format(query))
 
+    def _parallelize(self, expr: Expr) -> Expr:
+        """
+        expr with its table scans, and the filters, projections and hash
+        aggregations right above them, run by ParallelScans. Aggregations
+        are split into partial ones per partition and a FinalAggregate.
+        """
+        if isinstance(expr, HashAggregate) and scanned_table(expr) is not None:
+            fragment = replace(expr, partial=True)
+            scan = ParallelScan(fragment, self._parallelism)
+            return FinalAggregate(scan, len(expr.columns), expr.aggs)
+        if scanned_table(expr) is not None:
+            return ParallelScan(expr, self._parallelism)
+        if isinstance(expr, (ColumnProjection, Filter, HashAggregate, Limit, Sort)):
+            return replace(expr, expr=self._parallelize(expr.expr))
+        if isinstance(expr, HashJoin):
+            exp1, exp2 = self._parallelize(expr.exp1), self._parallelize(expr.exp2)
+            return replace(expr, exp1=exp1, exp2=exp2)
+        return expr
+
     def _plan_select(self, query: Select) -> Expr:
+        if query.limit is None and not query.offset:
+            return self._plan_rows(query)
+        if query.limit is not None and query.limit < 0 or query.offset < 0:
+            raise ValueError("limit and offset can't be negative")
+        expr = self._plan_rows(query)
+        if query.limit is not None:
+            expr = self._top(expr, query.offset + query.limit)
+        return Limit(expr, query.limit, query.offset)
+
+    def _top(self, expr: Expr, n: int) -> Expr:
+        """expr with its final Sort, if any, keeping only the first n rows"""
+        if isinstance(expr, Sort):
+            return replace(expr, limit=n)
+        if isinstance(expr, ColumnProjection):
+            return replace(expr, expr=self._top(expr.expr, n))
+        return expr
+
+    def _plan_rows(self, query: Select) -> Expr:
+        """the rows of query, before limit and offset"""
+        grouped = bool(query.group_by) or any(
+            isinstance(name, Aggregate) for name in query.exprs
+        )
         if isinstance(query.from_clause.table, Join):
             assert not query.where_clause, "TODO: support where"
-            expr = self._plan_join(query.from_clause.table)  # type: Expr
+            join = query.from_clause.table
+            expr = self._plan_join(join)  # type: Expr
+            if grouped:
+                columnids = functools.partial(self._join_columnids, join)
+                return self._plan_aggregate(expr, query, columnids)
+            if query.order_by:
+                order = self._join_columnids(join, query.order_by.columns)
+                expr = Sort(expr, order, query.order_by.descending)
             return self._plan_join_projection(expr, query)
         else:
             table = self._tables[query.from_clause.table]
+            if grouped:
+                return self._plan_table_aggregate(table, query)
             if query.where_clause:
+                if not query.order_by:
+                    lookup = self._index_only_lookup(
+                        table, query.where_clause, self._names(query)
+                    )
+                    if lookup:
+                        return lookup
                 expr = self._plan_where(table, query.where_clause)
             else:
                 expr = Scan(table)
+            if query.order_by:
+                expr = self._plan_order_by(table, expr, query.order_by)
             columns = table.schema().columnids(*query.exprs)
             if columns != table.schema().columnids():
                 expr = ColumnProjection(expr, columns)
@@ -70,7 +169,10 @@ class SimplePlanner:
     def _plan_delete(self, query: Delete) -> Expr:
         pass
 
-    def _plan_join(self, clause: Join):
+    def _plan_join(self, clause: Join) -> Expr:
+        return self._join_plans(*self._join_columns(clause))[0]
+
+    def _join_columns(self, clause: Join) -> Tuple[ITable, Column, ITable, Column]:
         if len(clause.tables) != 2:
             raise ValueError("join: expected two tables")
 
@@ -94,28 +196,89 @@ class SimplePlanner:
 
         table1, col1 = self._find_join_column(condition.left.val)
         table2, col2 = self._find_join_column(condition.right.val)
+        return table1, col1, table2, col2
 
-        if any(table2.indexes(col2.name)):
-            return IndexedJoin(
-                Scan(table1),
-                table1.schema().columnid(col1.name),
-                table2.indexes(col2.name)[0],
-                table2,
+    def _join_plans(
+        self, table1: ITable, col1: Column, table2: ITable, col2: Column
+    ) -> List[Expr]:
+        """
+        The ways to join the tables on the columns, best first: a MergeJoin
+        if both sides can be read in join column order, an IndexedJoin if
+        table2 has a hash or sorted index on col2 (bitmap indexes match null
+        keys), and a HashJoin that builds the smaller side.
+        """
+        plans = []  # type: List[Expr]
+        id1 = table1.schema().columnid(col1.name)
+        id2 = table2.schema().columnid(col2.name)
+        sorted1 = self._sorted_index(table1, col1.name)
+        sorted2 = self._sorted_index(table2, col2.name)
+        if sorted1 and sorted2:
+            plans.append(
+                MergeJoin(
+                    IndexRangeScan(
+                        table1, sorted1[1], covering=bool(sorted1[0].include)
+                    ),
+                    IndexRangeScan(
+                        table2, sorted2[1], covering=bool(sorted2[0].include)
+                    ),
+                    id1,
+                    id2,
+                )
             )
-        else:
-            return HashJoin(
+
+        found = next(
+            (
+                (definition, index)
+                for definition, index in table2.index_defs()
+                if definition.columns == (col2.name,)
+                and definition.kind != IndexKind.BITMAP  # which indexes nulls
+            ),
+            None,
+        )
+        if found:
+            definition, index = found
+            plans.append(
+                IndexedJoin(Scan(table1), id1, index, table2, bool(definition.include))
+            )
+        plans.append(
+            HashJoin(
                 Scan(table1),
                 Scan(table2),
-                table1.schema().columnid(col1.name),
-                table2.schema().columnid(col2.name),
+                id1,
+                id2,
+                build_right=table2.count() < table1.count(),
             )
+        )
+        return plans
+
+    def _sorted_index(
+        self, table: ITable, column: str
+    ) -> Optional[Tuple[IndexDef, SortedIndex]]:
+        """an index that scans table in column order, if there is one"""
+        for definition, index in table.index_defs():
+            if definition.columns == (column,) and isinstance(index, SortedIndex):
+                return definition, index
+        return None
 
     def _plan_join_projection(self, join_expr: Expr, query: Select) -> Expr:
         assert isinstance(query.from_clause.table, Join)
+        return ColumnProjection(
+            join_expr,
+            self._join_columnids(query.from_clause.table, self._names(query)),
+        )
+
+    @staticmethod
+    def _names(query: Select) -> Sequence[str]:
+        """the column names query selects, when it has no Aggregates"""
+        assert all(isinstance(name, str) for name in query.exprs)
+        return typing.cast(Sequence[str], query.exprs)
+
+    def _join_columnids(self, join: Join, colnames: Sequence[str]) -> Tuple[int, ...]:
+        """positions of table.column names in the joined rows"""
         column_indexes = []
-        join_table_names = list(query.from_clause.table.tables)
+        join_table_names = list(join.tables)
         join_tables = [self._tables[name] for name in join_table_names]
-        for colname in query.exprs:
+        for colname in colnames:
             table, column = self._find_join_column(colname)
             if table.name() not in join_table_names:
                 raise ValueError("unrecognized column {}".format(colname))
@@ -125,67 +288,358 @@ class SimplePlanner:
                 len(table.schema().columns) for table in join_tables[:table_idx]
             ) + join_tables[table_idx].schema().columnid(column.name)
             column_indexes.append(col_idx)
-        return ColumnProjection(
-            join_expr,
-            tuple(column_indexes),
+        return tuple(column_indexes)
+
+    def _plan_order_by(self, table: ITable, expr: Expr, order_by: OrderBy) -> Expr:
+        columns = self._columnids(table, order_by.columns)
+        scan = self._index_order(table, expr, order_by.columns)
+        if scan is not None:
+            scan.reverse = order_by.descending
+            return expr
+        return Sort(expr, columns, order_by.descending)
+
+    def _index_order(
+        self, table: ITable, expr: Expr, names: Sequence[str]
+    ) -> Optional[IndexRangeScan]:
+        """
+        The range scan of expr, maybe filtered, if it reads an index on the
+        single column of names and so yields rows in order of it
+        """
+        scan = expr.expr if isinstance(expr, Filter) else expr
+        if not isinstance(scan, IndexRangeScan) or len(names) != 1:
+            return None
+        definition = next(d for d, i in table.index_defs() if i is scan.index)
+        return scan if definition.columns == tuple(names) else None
+
+    def _columnids(self, table: ITable, names: Sequence[str]) -> Tuple[int, ...]:
+        known = table.schema().column_names()
+        for name in names:
+            if name not in known:
+                raise ValueError("unrecognized column {}".format(name))
+        return tuple(known.index(name) for name in names)
+
+    def _plan_table_aggregate(self, table: ITable, query: Select) -> Expr:
+        """COUNT(*) of a whole table is answered by its row count"""
+        if (
+            not query.where_clause
+            and not query.group_by
+            and all(self._counts_rows(name) for name in query.exprs)
+        ):
+            expr = TableCount(table)  # type: Expr
+            if len(query.exprs) == 1:
+                return expr
+            return ColumnProjection(expr, (0,) * len(query.exprs))
+        if query.where_clause:
+            expr = self._plan_where(table, query.where_clause)
+        else:
+            expr = Scan(table)
+        columnids = functools.partial(self._columnids, table)
+        in_order = self._index_order(table, expr, query.group_by) is not None
+        return self._plan_aggregate(expr, query, columnids, in_order)
+
+    def _counts_rows(self, name: Any) -> bool:
+        """whether name is COUNT(*)"""
+        return (
+            isinstance(name, Aggregate)
+            and name.func.upper() == "COUNT"
+            and name.column is None
         )
 
-    def _plan_where(self, table: ITable, clause: Where):
+    def _plan_aggregate(
+        self,
+        expr: Expr,
+        query: Select,
+        columnids: Callable[[Sequence[str]], Tuple[int, ...]],
+        in_order: bool = False,
+    ) -> Expr:
+        """
+        Groups the rows of expr with a HashAggregate, or a StreamAggregate
+        if they are in_order of the group_by columns, and orders and
+        projects the groups. columnids finds the columns of names in expr.
+        """
+        group_by = list(query.group_by)
+        aggs, positions = [], []
+        for name in query.exprs:
+            if isinstance(name, Aggregate):
+                aggs.append(self._aggregation(name, columnids))
+                positions.append(len(group_by) + len(aggs) - 1)
+            elif name in group_by:
+                positions.append(group_by.index(name))
+            else:
+                raise ValueError("{} is neither grouped nor aggregated".format(name))
+        columns = columnids(group_by)
+        if in_order:
+            expr = StreamAggregate(expr, columns, aggs)
+        else:
+            expr = HashAggregate(expr, columns, aggs)
+        if query.order_by:
+            for name in query.order_by.columns:
+                if name not in group_by:
+                    raise ValueError("can't order groups by {}".format(name))
+            order = tuple(group_by.index(name) for name in query.order_by.columns)
+            expr = Sort(expr, order, query.order_by.descending)
+        if positions != list(range(len(group_by) + len(aggs))):
+            expr = ColumnProjection(expr, tuple(positions))
+        return expr
+
+    def _aggregation(
+        self, agg: Aggregate, columnids: Callable[[Sequence[str]], Tuple[int, ...]]
+    ) -> Aggregation:
+        funcs = {func.value: func for func in AggFunc}
+        func = funcs.get(agg.func.upper())
+        if func is None:
+            raise ValueError("unsupported aggregate: {}".format(agg.func))
+        if agg.column is None:
+            if func != AggFunc.COUNT:
+                raise ValueError("{} needs a column".format(agg.func))
+            return Aggregation(func)
+        return Aggregation(func, columnids([agg.column])[0])
+
+    def _plan_where(self, table: ITable, clause: Where) -> Expr:
         assert clause.condition
-        lookup = self._indexed_lookup(table, clause)
-        if lookup:
-            return lookup
-        return FilteredScan(table, self._where_filter(table, clause))
-
-    def _indexed_lookup(self, table: ITable, clause: Where) -> Optional[Expr]:
-        column, key = self._extract_key_col(clause)
-        index = next(iter(table.indexes(column)), None)
-        if not index:
+        preds = self._conjuncts(clause.condition)
+        for plan in (self._indexed_lookup, self._bitmap_scan, self._index_range_scan):
+            found = plan(table, preds)
+            if found:
+                expr, rest = found
+                return Filter(expr, self._condition(table, rest)) if rest else expr
+        return FilteredScan(table, self._condition(table, preds))
+
+    def _conjuncts(self, cond: QueryExpr) -> List[QueryExpr]:
+        """the predicates ANDed together in cond"""
+        if isinstance(cond, BinExpr) and cond.op == "AND":
+            assert isinstance(cond.left, QueryExpr)
+            assert isinstance(cond.right, QueryExpr)
+            return self._conjuncts(cond.left) + self._conjuncts(cond.right)
+        return [cond]
+
+    def _indexed_lookup(
+        self, table: ITable, preds: List[QueryExpr]
+    ) -> Optional[Tuple[Expr, List[QueryExpr]]]:
+        match = self._match_index(table, preds)
+        if match is None:
             return None
-        return IndexedLookup(table, index, key)
+        definition, index, key, prefix, rest = match
+        covering = bool(definition.include)
+        return IndexedLookup(table, index, key, prefix, covering), rest
 
-    def _extract_key_col(self, clause: Where) -> Tuple[Optional[str], Optional[str]]:
-        cond = clause.condition
+    def _index_only_lookup(
+        self, table: ITable, clause: Where, names: Sequence[str]
+    ) -> Optional[Expr]:
+        """a lookup answered by an index alone, if one covers the query"""
+        match = self._match_index(table, self._conjuncts(clause.condition))
+        if match is None:
+            return None
+        definition, index, key, prefix, rest = match
+        fields = definition.columns + definition.include
+        if rest or any(name not in fields for name in names):
+            return None
+        return IndexOnlyLookup(
+            index,
+            key,
+            tuple(fields.index(name) for name in names),
+            len(definition.columns) > 1,
+            prefix,
+            bool(definition.include),
+        )
+
+    def _match_index(self, table: ITable, preds: List[QueryExpr]) -> Optional[Tuple]:
+        """
+        The index whose key is matched best by equality predicates: a whole
+        key beats a prefix of one, which needs a SortedIndex, and longer
+        prefixes beat shorter ones. Returns (definition, index, key, prefix,
+        unmatched predicates) or None.
+        """
+        equal = {}  # type: Dict[str, Tuple[Any, QueryExpr]]
+        for pred in preds:
+            column, key = self._extract_key_col(pred)
+            if column is not None and column not in equal:
+                equal[column] = (key, pred)
+        best, best_rank = None, None  # type: Optional[Tuple], Any
+        for definition, index in table.index_defs():
+            if definition.kind == IndexKind.BITMAP:
+                continue  # see _bitmap_scan
+            n = 0
+            while n < len(definition.columns) and definition.columns[n] in equal:
+                n += 1
+            full = n == len(definition.columns)
+            if n == 0 or not (full or isinstance(index, SortedIndex)):
+                continue
+            if best is None or (full, n) > best_rank:
+                best, best_rank = (definition, index, n), (full, n)
+        if best is None:
+            return None
+        definition, index, n = best
+        matched = [equal[column] for column in definition.columns[:n]]
+        if len(definition.columns) == 1:
+            key = matched[0][0]
+        else:
+            key = tuple(key for key, _ in matched)
+        used = [pred for _, pred in matched]
+        rest = [pred for pred in preds if all(pred is not p for p in used)]
+        return definition, index, key, n < len(definition.columns), rest
+
+    def _bitmap_scan(
+        self, table: ITable, preds: List[QueryExpr]
+    ) -> Optional[Tuple[Expr, List[QueryExpr]]]:
+        """
+        A scan of the rows in the bitmap computed from the predicates that
+        bitmap indexes can answer, ANDed together.
+        """
+        indexes = {
+            definition.columns[0]: index
+            for definition, index in table.index_defs()
+            if isinstance(index, BitmapIndex) and len(definition.columns) == 1
+        }
+        if not indexes:
+            return None
+        bitmaps, rest = [], []
+        for pred in preds:
+            bitmap = self._bitmap(indexes, pred)
+            if bitmap is None:
+                rest.append(pred)
+            else:
+                bitmaps.append(bitmap)
+        if not bitmaps:
+            return None
+        expr = bitmaps[0] if len(bitmaps) == 1 else BitmapAnd(bitmaps)
+        return BitmapScan(table, expr), rest
+
+    def _bitmap(
+        self, indexes: Dict[str, BitmapIndex], cond: QueryExpr
+    ) -> Optional[BitmapExpr]:
+        if isinstance(cond, Not):
+            expr = self._bitmap(indexes, cond.expr)
+            return BitmapNot(next(iter(indexes.values())), expr) if expr else None
         if not isinstance(cond, BinExpr):
+            return None
+        if cond.op in ("AND", "OR"):
+            assert isinstance(cond.left, QueryExpr)
+            assert isinstance(cond.right, QueryExpr)
+            left = self._bitmap(indexes, cond.left)
+            right = self._bitmap(indexes, cond.right)
+            if left is None or right is None:
+                return None
+            return (BitmapAnd if cond.op == "AND" else BitmapOr)([left, right])
+        column, key = self._extract_key_col(cond)
+        if column not in indexes:
+            return None
+        return BitmapLookup(indexes[column], key)
+
+    def _index_range_scan(
+        self, table: ITable, preds: List[QueryExpr]
+    ) -> Optional[Tuple[Expr, List[QueryExpr]]]:
+        """
+        A scan of a sorted single column index between the tightest bounds
+        the predicates put on its column.
+        """
+        bounds = [self._range_bound(pred) for pred in preds]
+        for bound in bounds:
+            if bound is None:
+                continue
+            column = bound[0]
+            found = next(
+                (
+                    (definition, index)
+                    for definition, index in table.index_defs()
+                    if definition.columns == (column,)
+                    and isinstance(index, SortedIndex)
+                ),
+                None,
+            )
+            if found is not None:
+                break
+        else:
+            return None
+        definition, index = found
+        low = high = None  # type: Optional[Tuple[Any, bool]]  # (value, inclusive)
+        rest = []
+        for pred, bound in zip(preds, bounds):
+            if bound is None or bound[0] != column:
+                rest.append(pred)
+                continue
+            _, op, val = bound
+            inclusive = op in ("<=", ">=")
+            current = high if op in ("<", "<=") else low
+            if current is not None and Param in (type(val), type(current[0])):
+                rest.append(pred)  # can't tell which is tighter until bound
+                continue
+            if op in ("<", "<="):
+                if high is None or val < high[0] or val == high[0] and not inclusive:
+                    high = (val, inclusive)
+            elif low is None or val > low[0] or val == low[0] and not inclusive:
+                low = (val, inclusive)
+        scan = IndexRangeScan(
+            table,
+            index,
+            low=low[0] if low else None,
+            high=high[0] if high else None,
+            low_inclusive=low[1] if low else True,
+            high_inclusive=high[1] if high else True,
+            covering=bool(definition.include),
+        )
+        return scan, rest
+
+    def _range_bound(self, cond: QueryExpr) -> Optional[Tuple[str, str, Any]]:
+        """(column, op, value) of column < value and the like, with column first"""
+        if not isinstance(cond, BinExpr) or cond.op not in self.FLIPPED:
+            return None
+        if isinstance(cond.left, Symbol) and isinstance(cond.right, self.VALUES):
+            return cond.left.val, cond.op, self._value(cond.right)
+        if isinstance(cond.left, self.VALUES) and isinstance(cond.right, Symbol):
+            return cond.right.val, self.FLIPPED[cond.op], self._value(cond.left)
+        return None
+
+    def _extract_key_col(self, cond: QueryExpr) -> Tuple[Optional[str], Any]:
+        if not isinstance(cond, BinExpr) or cond.op != "=":
             return (None, None)
-        if cond.op != "=":
-            return (None, None)
-        shape = (type(cond.left), type(cond.right))
-        if shape == (Symbol, Const):
-            assert isinstance(cond.left, Symbol)
-            assert isinstance(cond.right, Const)
-            return (cond.left.val, cond.right.val)
-        if shape == (Const, Symbol):
-            assert isinstance(cond.left, Const)
-            assert isinstance(cond.right, Symbol)
-            return (cond.right.val, cond.left.val)
+        if isinstance(cond.left, Symbol) and isinstance(cond.right, self.VALUES):
+            return (cond.left.val, self._value(cond.right))
+        if isinstance(cond.left, self.VALUES) and isinstance(cond.right, Symbol):
+            return (cond.right.val, self._value(cond.left))
         return (None, None)
 
+    @staticmethod
+    def _value(operand: Operand) -> Any:
+        """the value of a Const, or a Param itself, to be bound after planning"""
+        return operand.val if isinstance(operand, Const) else operand
+
+    def _condition(self, table: ITable, preds: List[QueryExpr]) -> Condition:
+        conds = [self._filter(table, pred) for pred in preds]
+        return conds[0] if len(conds) == 1 else Conjunction(conds)
+
     @typing.no_type_check
-    def _where_filter(self, table: ITable, clause: Where) -> Condition:
-        cond = clause.condition
-        if isinstance(cond, BinExpr):
-            op = self.BINOPS[cond.op]
-            types = (type(cond.left), type(cond.right))
-            schema = table.schema()
-            if types == (Symbol, Symbol):
-                col1 = schema.columnid(cond.left.val)
-                col2 = schema.columnid(cond.right.val)
-                return ColumnComp(op, col1, col2)
-            elif types == (Symbol, Const):
-                col = schema.columnid(cond.left.val)
-                val = cond.right.val
-                return ValueComp(op, col, val)
-            elif types == (Const, Symbol):
-                val = cond.left.val
-                col = schema.columnid(cond.right.val)
-                return ValueComp(op, col, val)
-            else:
-                raise ValueError(
-                    "unsupported expression types in where: {}".format(clause)
-                )
+    def _filter(self, table: ITable, cond: QueryExpr) -> Condition:
+        if isinstance(cond, Not):
+            return Negation(self._filter(table, cond.expr))
+        if not isinstance(cond, BinExpr):
+            raise ValueError("unsupported expression in where: {}".format(cond))
+        if cond.op in ("AND", "OR"):
+            conds = [self._filter(table, cond.left), self._filter(table, cond.right)]
+            return Conjunction(conds) if cond.op == "AND" else Disjunction(conds)
+        op = self.BINOPS.get(cond.op, None)
+        types = tuple(
+            Const if isinstance(side, self.VALUES) else type(side)
+            for side in (cond.left, cond.right)
+        )
+        schema = table.schema()
+        if op is None:
+            raise ValueError("unsupported operator in where: {}".format(cond.op))
+        if types == (Symbol, Symbol):
+            col1 = schema.columnid(cond.left.val)
+            col2 = schema.columnid(cond.right.val)
+            return ColumnComp(op, col1, col2)
+        elif types == (Symbol, Const):
+            col = schema.columnid(cond.left.val)
+            val = self._value(cond.right)
+            return ValueComp(op, col, val)
+        elif types == (Const, Symbol):
+            op = self.BINOPS[self.FLIPPED.get(cond.op, cond.op)]
+            val = self._value(cond.left)
+            col = schema.columnid(cond.right.val)
+            return ValueComp(op, col, val)
         else:
-            raise NotImplementedError()
+            raise ValueError("unsupported expression types in where: {}".format(cond))
 
     def _find_join_column(self, colname: str) -> Tuple[ITable, Column]:
         parts = colname.split(".")
@@ -195,3 +649,110 @@ class SimplePlanner:
         table = self._tables[table_name]
         column = table.schema().column(col_name)
         return table, column
+
+
+class CostBasedPlanner(SimplePlanner):
+    """
+    A SimplePlanner that uses the TableStats of tables that have them, see
+    ANALYZE: it estimates the cost of scanning a table and of each index
+    that could answer a where clause and of each way to join two tables,
+    and picks the cheapest. Filters test the most selective predicates
+    first. Tables without stats are planned as SimplePlanner does.
+    """
+
+    # relative costs
+    SCAN_ROW = 1.0  # reading a row in a scan
+    FETCH_ROW = 3.0  # reading a row by rowid, found through an index
+    PROBE = 2.0  # looking up a key in an index
+    HASH_ROW = 2.0  # adding a row to a hash table
+
+    # selectivity of predicates on columns without stats
+    EQUAL = 0.005
+    RANGE = 1 / 3
+    OTHER = 0.5
+
+    def __init__(
+        self,
+        tables: Dict[str, ITable],
+        stats: Dict[str, TableStats],
+        parallelism: int = 1,
+    ):
+        super().__init__(tables, parallelism)
+        self._stats = stats
+
+    def _plan_where(self, table: ITable, clause: Where) -> Expr:
+        if table.name() not in self._stats:
+            return super()._plan_where(table, clause)
+        assert clause.condition
+        preds = self._conjuncts(clause.condition)
+        rows = table.count()
+        best = FilteredScan(table, self._condition(table, preds))  # type: Expr
+        best_cost = rows * self.SCAN_ROW
+        for plan in (self._indexed_lookup, self._bitmap_scan, self._index_range_scan):
+            found = plan(table, preds)
+            if not found:
+                continue
+            expr, rest = found
+            used = [pred for pred in preds if all(pred is not p for p in rest)]
+            cost = self.PROBE + rows * self._selectivity(table, used) * self.FETCH_ROW
+            if cost < best_cost:
+                best = Filter(expr, self._condition(table, rest)) if rest else expr
+                best_cost = cost
+        return best
+
+    def _condition(self, table: ITable, preds: List[QueryExpr]) -> Condition:
+        if table.name() in self._stats:
+            preds = sorted(preds, key=lambda pred: self._selectivity(table, [pred]))
+        return super()._condition(table, preds)
+
+    def _join_plans(
+        self, table1: ITable, col1: Column, table2: ITable, col2: Column
+    ) -> List[Expr]:
+        plans = super()._join_plans(table1, col1, table2, col2)
+        stats = self._stats.get(table2.name())
+        if table1.name() not in self._stats or stats is None:
+            return plans
+        rows1, rows2 = table1.count(), table2.count()
+        column = stats.columns.get(col2.name)
+        matches = 1.0  # rows of table2 per row of table1
+        if column is not None:
+            matches = rows2 * (1.0 - column.null_frac) / max(1.0, column.distinct)
+
+        def cost(plan: Expr) -> float:
+            if isinstance(plan, MergeJoin):
+                return (rows1 + rows2) * self.FETCH_ROW
+            if isinstance(plan, IndexedJoin):
+                per_row = self.SCAN_ROW + self.PROBE
+                return rows1 * (per_row + matches * self.FETCH_ROW)
+            build = min(rows1, rows2) * self.HASH_ROW
+            return (rows1 + rows2) * self.SCAN_ROW + build
+
+        return sorted(plans, key=cost)
+
+    def _selectivity(self, table: ITable, preds: List[QueryExpr]) -> float:
+        """estimated fraction of the rows of table the predicates all hold for"""
+        result = 1.0
+        for pred in preds:
+            result *= self._estimate(self._stats[table.name()], pred)
+        return result
+
+    def _estimate(self, stats: TableStats, cond: QueryExpr) -> float:
+        if isinstance(cond, Not):
+            return 1.0 - self._estimate(stats, cond.expr)
+        if isinstance(cond, BinExpr) and cond.op in ("AND", "OR"):
+            assert isinstance(cond.left, QueryExpr)
+            assert isinstance(cond.right, QueryExpr)
+            left = self._estimate(stats, cond.left)
+            right = self._estimate(stats, cond.right)
+            return left * right if cond.op == "AND" else left + right - left * right
+        column, value = self._extract_key_col(cond)
+        if column is not None:
+            bound = (column, "=", value)  # type: Optional[Tuple[str, str, Any]]
+        else:
+            bound = self._range_bound(cond)
+        if bound is None:
+            return self.OTHER
+        column, op, value = bound
+        if column not in stats.columns:
+            return self.EQUAL if op == "=" else self.RANGE
+        return stats.columns[column].selectivity(op, value)
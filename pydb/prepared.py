@@ -0,0 +1,209 @@
+"""
+Prepared statements and the plan cache.
+
+A Select is planned for its shape: the query with the values it compares
+columns to for equality replaced by Params. Queries of the same shape,
+say lookups of different ids, share a plan from the PlanCache, and each
+runs it with its own values bound. Range bounds stay in the shape, since
+the best plan for age < 20 may not be the best for age < 90. So do the
+orders of magnitude of the tables' row counts, see plan_key().
+"""
+
+from collections import OrderedDict
+import dataclasses
+from typing import (
+    Any,
+    Callable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from .core import Cursor
+from .expr import Expr
+from .query import (
+    BinExpr,
+    Const,
+    Join,
+    Not,
+    Operand,
+    Param,
+    QueryExpr,
+    Select,
+    Symbol,
+    Where,
+)
+from .table import ITable
+
+
+def parameterize(query: Select) -> Tuple[Select, List[Any], int]:
+    """
+    (shape, values, params): the shape of query, the values of the Params
+    it added and how many Params query had to begin with. The added Params
+    are numbered after those, so the values are bound after theirs.
+    """
+    if query.where_clause is None:
+        return query, [], 0
+    cond = query.where_clause.condition
+    params = max((param.index + 1 for param in _params(cond)), default=0)
+    values = []  # type: List[Any]
+    cond = _parameterize(cond, params, values)
+    shape = dataclasses.replace(query, where_clause=Where(cond))
+    return shape, values, params
+
+
+def _params(cond: Union[Operand, QueryExpr]) -> List[Param]:
+    if isinstance(cond, Not):
+        return _params(cond.expr)
+    if isinstance(cond, BinExpr):
+        return _params(cond.left) + _params(cond.right)
+    return [cond] if isinstance(cond, Param) else []
+
+
+def _parameterize(cond: QueryExpr, params: int, values: List[Any]) -> QueryExpr:
+    if isinstance(cond, Not):
+        return Not(_parameterize(cond.expr, params, values))
+    if not isinstance(cond, BinExpr):
+        return cond
+    if cond.op in ("AND", "OR"):
+        assert isinstance(cond.left, QueryExpr)
+        assert isinstance(cond.right, QueryExpr)
+        left = _parameterize(cond.left, params, values)
+        right = _parameterize(cond.right, params, values)
+        return BinExpr(cond.op, left, right)
+    if cond.op != "=":
+        return cond
+    sides = [cond.left, cond.right]
+    for i, side in enumerate(sides):
+        if isinstance(side, Const) and isinstance(sides[1 - i], Symbol):
+            sides[i] = Param(params + len(values))
+            values.append(side.val)
+    return BinExpr(cond.op, *sides)
+
+
+Binder = Callable[[Sequence[Any]], Expr]
+
+
+def binder(plan: Expr) -> Binder:
+    """
+    a function of values that returns plan with each Param replaced by its
+    value. Only the nodes on the way to a Param are copied.
+    """
+    bind = _binder(plan)
+    return (lambda values: plan) if bind is None else bind
+
+
+def _binder(node: Any) -> Optional[Callable[[Sequence[Any]], Any]]:
+    """binds the Params in node, None if it has none"""
+    if isinstance(node, Param):
+        index = node.index
+        return lambda values: values[index]
+    if isinstance(node, (tuple, list)):
+        items = [(item, _binder(item)) for item in node]
+        if all(bind is None for _, bind in items):
+            return None
+        kind = type(node)
+        return lambda values: kind(
+            item if bind is None else bind(values) for item, bind in items
+        )
+    if dataclasses.is_dataclass(node) and not isinstance(node, type):
+        fields = [
+            (field.name, _binder(getattr(node, field.name)))
+            for field in dataclasses.fields(node)
+        ]
+        binds = [(name, bind) for name, bind in fields if bind is not None]
+        if not binds:
+            return None
+        return lambda values: dataclasses.replace(
+            node, **{name: bind(values) for name, bind in binds}
+        )
+    return None
+
+
+def plan_key(
+    statement: "PreparedStatement", tables: Mapping[str, ITable], *options: Any
+) -> Tuple:
+    """
+    The key of the plan of statement, planned with options: its shape, and
+    the order of magnitude of the row count of each table it reads. Plans
+    depend on row counts, a hash join builds on its smaller side for one,
+    so a table that grows or shrinks about 2x gets its queries replanned.
+    """
+    sizes = tuple(
+        tables[name].count().bit_length() for name in statement.tables if name in tables
+    )
+    return statement.key, options, sizes
+
+
+class PlanCache:
+    """
+    Bounded LRU cache of plans by query shape, as binders. Plans hold
+    tables and their indexes, so clear() it when they or the table stats
+    change.
+    """
+
+    DEFAULT_SIZE = 256  # plans
+
+    def __init__(self, size: int = DEFAULT_SIZE):
+        if size < 1:
+            raise ValueError("plan cache size must be positive")
+        self._size = size
+        self._plans = OrderedDict()  # type: OrderedDict[Any, Binder]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any, make: Callable[[], Expr]) -> Binder:
+        """the binder of the plan cached for key, or of make()'s, cached"""
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+            self.hits += 1
+            return plan
+        self.misses += 1
+        plan = binder(make())
+        self._plans[key] = plan
+        if len(self._plans) > self._size:
+            self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        self._plans.clear()
+
+    def __len__(self):
+        return len(self._plans)
+
+
+class PreparedStatement:
+    """
+    A Select with Params, run by exec() with a value for each of them:
+    Param(i) is bound to values[i]. Its plan comes from the database's
+    PlanCache, so it's planned again only once that's cleared.
+    """
+
+    def __init__(
+        self,
+        query: Select,
+        run: Callable[["PreparedStatement", Tuple], Cursor],
+    ):
+        """run: runs the statement's shape with all its values bound"""
+        self.query = query
+        self.shape, values, self.params = parameterize(query)
+        self.key = repr(self.shape)
+        table = query.from_clause.table
+        self.tables = tuple(table.tables) if isinstance(table, Join) else (table,)
+        self._values = tuple(values)
+        self._run = run
+
+    def exec(self, *values) -> Cursor:
+        return self._run(self, self.bind(values))
+
+    def bind(self, values: Sequence[Any]) -> Tuple:
+        """the values of all the Params of the shape, given the statement's"""
+        if len(values) != self.params:
+            raise ValueError(
+                "expected {} parameter values, got {}".format(self.params, len(values))
+            )
+        return tuple(values) + self._values
@@ -2,7 +2,8 @@ from dataclasses import dataclass
 from enum import Enum
 from typing import Any, Optional, Sequence, Union
 
-from .table import Schema
+from .index import IndexKind
+from .table import IndexDef, Schema
 
 
 class Query:
@@ -27,11 +28,25 @@ class Const(Operand):
     val: Any
 
 
+@dataclass
+class Param(Operand):
+    """Placeholder for the index-th value given to a prepared statement"""
+
+    index: int
+
+
 @dataclass
 class BinExpr(QueryExpr):
+    """A comparison of operands, or AND / OR of two QueryExprs"""
+
     op: str
-    left: Operand
-    right: Operand
+    left: Union[Operand, QueryExpr]
+    right: Union[Operand, QueryExpr]
+
+
+@dataclass
+class Not(QueryExpr):
+    expr: QueryExpr
 
 
 @dataclass
@@ -39,6 +54,23 @@ class CreateTable(Query):
     schema: Schema
 
 
+@dataclass
+class CreateIndex(Query):
+    """
+    Secondary index on columns of an existing table. Values may repeat.
+    Several columns make a composite key, matched by its leading columns.
+    The values of include are stored in the index to cover queries.
+    """
+
+    table: str
+    columns: Sequence[str]
+    kind: IndexKind = IndexKind.HASH
+    include: Sequence[str] = ()
+
+    def definition(self) -> IndexDef:
+        return IndexDef(tuple(self.columns), tuple(self.include), self.kind)
+
+
 @dataclass
 class Insert(Query):
     table: str
@@ -46,6 +78,15 @@ class Insert(Query):
     values: Sequence[Any]
 
 
+@dataclass
+class InsertMany(Query):
+    """Bulk insert. Columns are checked once for all rows."""
+
+    table: str
+    columns: Sequence[str]
+    rows: Sequence[Sequence[Any]]
+
+
 @dataclass
 class On:
     expr: QueryExpr
@@ -75,14 +116,65 @@ class Where:
     condition: QueryExpr
 
 
+@dataclass
+class OrderBy:
+    """Nulls sort first, so last when descending"""
+
+    columns: Sequence[str]
+    descending: bool = False
+
+
+@dataclass
+class Aggregate:
+    """func of column: COUNT, SUM, MIN, MAX or AVG. COUNT(*) has no column."""
+
+    func: str
+    column: Optional[str] = None
+
+
 @dataclass
 class Select(Query):
-    exprs: Sequence[str]  # TODO: support select exprs
+    """
+    With group_by or an Aggregate in exprs, rows are grouped and exprs may
+    only name grouped columns besides Aggregates, as may order_by. limit
+    and offset apply last.
+    """
+
+    exprs: Sequence[Union[str, Aggregate]]  # TODO: support other select exprs
     from_clause: From
     where_clause: Optional[Where] = None
+    order_by: Optional[OrderBy] = None
+    group_by: Sequence[str] = ()
+    limit: Optional[int] = None
+    offset: int = 0
 
 
 @dataclass
 class Delete(Query):
     table: From
     condition: Optional[Where] = None
+
+
+@dataclass
+class Analyze(Query):
+    """Gathers the statistics of table, or of every table, for planning"""
+
+    table: Optional[str] = None
+
+
+class ExplainFormat(Enum):
+    TEXT = "text"
+    DICT = "dict"
+
+
+@dataclass
+class Explain(Query):
+    """
+    The plan of query with estimated rows and costs, or with analyze, the
+    plan after running query, with what each operator did. TEXT yields a
+    row per operator, DICT a single row holding the tree of operators.
+    """
+
+    query: Select
+    analyze: bool = False
+    format: ExplainFormat = ExplainFormat.TEXT
@@ -0,0 +1,180 @@
+"""
+Table statistics gathered by ANALYZE, for CostBasedPlanner.
+
+Per column: an estimate of its distinct values, the fraction of nulls and
+an equi-depth histogram of the rest. Tables larger than SAMPLE_SIZE rows
+are estimated from a uniform sample. Inserts keep the statistics roughly
+current without rescanning, see TableStats.add().
+"""
+
+import bisect
+from collections import Counter
+from dataclasses import dataclass
+import itertools
+import math
+import random
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+from .query import Param
+from .table import ITable, Schema
+
+BUCKETS = 32  # histogram buckets
+SAMPLE_SIZE = 30000  # rows analyze() reads at most into memory
+RANGE = 1 / 3  # selectivity of a range bounded by a Param, of unknown value
+
+
+@dataclass
+class ColumnStats:
+    """
+    distinct: estimated number of distinct non-null values
+    null_frac: fraction of rows that are null
+    bounds: equi-depth histogram, up to BUCKETS + 1 values that split the
+        non-null values into buckets of about as many each. The first and
+        last are the smallest and largest values. Empty if all are null.
+    """
+
+    distinct: float
+    null_frac: float
+    bounds: List[Any]
+
+    def selectivity(self, op: str, value: Any) -> float:
+        """
+        estimated fraction of rows where column op value holds. A Param
+        stands for any value: an average one for equality.
+        """
+        if value is None or not self.bounds:
+            return 0.0
+        present = 1.0 - self.null_frac
+        equal = 1.0 / max(1.0, self.distinct)
+        if isinstance(value, Param):
+            return present * (equal if op == "=" else RANGE)
+        try:
+            if op == "=":
+                inside = self.bounds[0] <= value <= self.bounds[-1]
+                return present * equal if inside else 0.0
+            below = self._below(value)
+        except TypeError:  # value isn't comparable with the column's
+            return 0.0
+        fractions = {
+            "<": below,
+            "<=": below + equal,
+            ">": 1.0 - below - equal,
+            ">=": 1.0 - below,
+        }
+        return present * min(1.0, max(0.0, fractions[op]))
+
+    def _below(self, value: Any) -> float:
+        """estimated fraction of the non-null values less than value"""
+        bounds = self.bounds
+        if value <= bounds[0]:
+            return 0.0
+        if value > bounds[-1]:
+            return 1.0
+        i = bisect.bisect_left(bounds, value) - 1  # bounds[i] < value
+        low, high = bounds[i], bounds[i + 1]
+        within = 0.5
+        if _is_number(low) and _is_number(high) and _is_number(value):
+            within = (value - low) / (high - low) if high > low else 1.0
+        return (i + within) / (len(bounds) - 1)
+
+
+@dataclass
+class TableStats:
+    rows: int
+    columns: Dict[str, ColumnStats]
+
+    def add(self, schema: Schema, rows: Sequence[Tuple]):
+        """
+        Account for inserted rows: row count, null fractions and the ends
+        of the histograms are updated, and distinct estimates grow at the
+        rate seen so far. Bucket boundaries only change on ANALYZE.
+        """
+        if not rows:
+            return
+        total = self.rows + len(rows)
+        for col, column in enumerate(schema.columns):
+            stats = self.columns[column.name]
+            values = [row[col] for row in rows if row[col] is not None]
+            present = self.rows * (1.0 - stats.null_frac)
+            nulls = self.rows * stats.null_frac + len(rows) - len(values)
+            stats.null_frac = nulls / total
+            if not values:
+                continue
+            try:
+                low, high = min(values), max(values)
+                if stats.bounds:
+                    stats.bounds[0] = min(stats.bounds[0], low)
+                    stats.bounds[-1] = max(stats.bounds[-1], high)
+                else:
+                    stats.bounds = [low, high]
+            except TypeError:
+                pass
+            rate = stats.distinct / present if present else 1.0
+            stats.distinct += len(values) * rate
+        self.rows = total
+
+
+def analyze(table: ITable, sample_size: int = SAMPLE_SIZE) -> TableStats:
+    """statistics of every column of table, from a sample of its rows"""
+    rows = table.count()
+    sample = _sample(table.rows(), sample_size)
+    columns = {}
+    for col, column in enumerate(table.schema().columns):
+        values = [row[col] for row in sample]
+        columns[column.name] = _column_stats(values, rows)
+    return TableStats(rows, columns)
+
+
+def _sample(rows: Iterable[Tuple], size: int) -> List[Tuple]:
+    """
+    a uniform sample of up to size rows, by reservoir sampling with
+    Algorithm L, which skips ahead rather than drawing for every row
+    """
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, size))
+    if len(sample) < size or size < 1:
+        return sample
+    rand = random.Random(0)
+    weight = math.exp(math.log(rand.random()) / size)
+    while True:
+        skip = int(math.log(rand.random()) / math.log(1.0 - weight))
+        row = next(itertools.islice(rows, skip, None), None)
+        if row is None:
+            return sample
+        sample[rand.randrange(size)] = row
+        weight *= math.exp(math.log(rand.random()) / size)
+
+
+def _column_stats(values: List[Any], rows: int) -> ColumnStats:
+    """values: a sample of the column out of rows in the table"""
+    present = [value for value in values if value is not None]
+    null_frac = 1.0 - len(present) / len(values) if values else 0.0
+    try:
+        present.sort()
+    except TypeError:
+        return ColumnStats(len(set(present)), null_frac, [])
+    if present:
+        last = len(present) - 1
+        buckets = min(BUCKETS, last) or 1
+        bounds = [present[last * i // buckets] for i in range(buckets + 1)]
+    else:
+        bounds = []
+    return ColumnStats(_distinct(present, rows * (1.0 - null_frac)), null_frac, bounds)
+
+
+def _distinct(sample: List[Any], total: float) -> float:
+    """
+    distinct values among total, estimated from a sample of them with the
+    Duj1 estimator of Haas and Stokes: the fewer values the sample holds
+    only once, the more likely it has seen most of them
+    """
+    counts = Counter(sample)
+    if len(sample) >= total:
+        return float(len(counts))
+    once = sum(1 for count in counts.values() if count == 1)
+    n = len(sample)
+    return n * len(counts) / (n - once + once * n / total)
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
@@ -1,9 +1,22 @@
 from dataclasses import dataclass
 from enum import Enum
-from typing import Any, Dict, Iterator, Optional, Protocol, Sequence, Tuple
+from operator import itemgetter
+import itertools
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Protocol,
+    Sequence,
+    Tuple,
+)
 
 from .error import SchemaError
-from .index import Index
+from .index import Index, IndexKind
 
 # TODO: Move public schema stuff to schema.py?
 
@@ -49,6 +62,12 @@ class Column:
         return attr in self.attrs
 
 
+def is_unique(col: Column) -> bool:
+    return any(
+        col.hasattr(attr) for attr in (ColumnAttr.PRIMARY_KEY, ColumnAttr.UNIQUE)
+    )
+
+
 def check_column(col: Column):
     if not col.name:
         raise SchemaError("column name must not be empty")
@@ -86,12 +105,73 @@ def check_schema(schema: Schema):
     for col in schema.columns:
         check_column(col)
 
+
+@dataclass(frozen=True)
+class IndexDef:
+    """
+    An index of a table. The key of a row is the value of its single column,
+    or the tuple of values of several; rows with a null key column aren't
+    indexed. The value is the rowid, or (rowid, *values of include) for a
+    covering index, so queries that only need the key and included columns
+    can be answered from the index alone.
+    """
+
+    columns: Tuple[str, ...]
+    include: Tuple[str, ...] = ()
+    kind: IndexKind = IndexKind.HASH
+    unique: bool = False
+
+    def key_fn(self, schema: Schema) -> Callable[[Tuple], Any]:
+        get = itemgetter(*schema.columnids(*self.columns))
+        if len(self.columns) == 1:
+            return get
+
+        def key(row):
+            key = get(row)
+            return None if None in key else key
+
+        return key
+
+    def val_fn(self, schema: Schema) -> Callable[[int, Tuple], Any]:
+        if not self.include:
+            return lambda rowid, row: rowid
+        cols = schema.columnids(*self.include)
+        return lambda rowid, row: (rowid, *(row[col] for col in cols))
+
+
+def check_index_def(schema: Schema, definition: IndexDef):
+    names = schema.column_names()
+    if not definition.columns:
+        raise ValueError("index must have a column")
+    for column in definition.columns + definition.include:
+        if column not in names:
+            raise ValueError("unrecognized column {}".format(column))
+    columns = definition.columns + definition.include
+    if len(set(columns)) != len(columns):
+        raise ValueError("duplicate index column")
+    if definition.include and definition.kind == IndexKind.BITMAP:
+        raise ValueError("bitmap indexes can't include columns")
+
+
+def batched(rows: Iterable[Tuple], size: int) -> Iterator[List[Tuple]]:
+    """rows in lists of size, the last one possibly shorter"""
+    if size < 1:
+        raise ValueError("batch size must be positive")
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
 # TODO: finish!
 @dataclass
 class Row:
     rowid: int
     columns: Tuple
 
+
 class ITable(Protocol):
     def name(self) -> str:
         return self.schema().name
@@ -103,17 +183,62 @@ class ITable(Protocol):
         """returns (rowid, row)"""
         pass
 
+    def insert_many(self, rows: Sequence[Tuple]) -> Sequence[int]:
+        """returns rowids"""
+        return [self.insert(row)[0] for row in rows]
+
     def delete(self, rowid: int):
         pass
 
     def get(self, rowid: int) -> Optional[Tuple]:
         pass
 
+    def get_many(self, rowids: Iterable[int]) -> List[Optional[Tuple]]:
+        return [self.get(rowid) for rowid in rowids]
+
     def rows(self) -> Iterator[Tuple[int, Tuple]]:
         """row format: (rowid, row)"""
         pass
 
+    def count(self) -> int:
+        """number of rows"""
+        return sum(1 for _ in self.rows())
+
+    def partitions(self, n: int) -> Optional[Sequence["ITable"]]:
+        """
+        Up to n picklable tables that hold the rows between them, in order,
+        for other processes to scan. None if the table can't be split.
+        """
+        return None
+
+    def bytes_read(self) -> int:
+        """bytes of stored rows read so far, see EXPLAIN ANALYZE"""
+        return 0
+
+    def row_batches(self, size: int) -> Iterator[List[Tuple]]:
+        """rows() in lists of up to size rows"""
+        return batched(self.rows(), size)
+
+    def column_array(self, col: int) -> Optional[Any]:
+        """
+        The values of an INT column by rowid as a vector.int_array(), if
+        the table keeps one and every row is live
+        """
+        return None
+
     def indexes(self, column: Optional[str] = None) -> Sequence[Index]:
+        """indexes keyed by column alone, or every index"""
+        return tuple(
+            index
+            for definition, index in self.index_defs()
+            if column is None or definition.columns == (column,)
+        )
+
+    def index_defs(self) -> Sequence[Tuple[IndexDef, Index]]:
+        pass
+
+    def create_index(self, definition: IndexDef) -> Index:
+        """index columns whose values may repeat, in one pass over the rows"""
         pass
 
     def __str__(self):
@@ -0,0 +1,84 @@
+"""
+Optional NumPy kernels for INT columns.
+
+Tables may keep an int64 array per INT column, and conditions, projections
+and aggregates then run over whole arrays. Every caller falls back to the
+pure-Python path when NumPy is missing, ENABLED is False or a column holds
+anything but ints, e.g. nulls.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # type: ignore
+
+ENABLED = numpy is not None  # set to False to force the pure-Python path
+
+_REDUCTIONS = {
+    "SUM": sum,
+    "MIN": min,
+    "MAX": max,
+}  # type: Dict[str, Callable[[List[Any]], Any]]
+
+
+def int_array(values: Sequence[Any]) -> Optional[Any]:
+    """values as an int64 array, or None if they can't be held in one"""
+    if not ENABLED or not set(map(type, values)) <= {int}:
+        return None
+    try:
+        return numpy.array(values, dtype=numpy.int64)
+    except OverflowError:
+        return None
+
+
+def extend(array: Optional[Any], values: Sequence[Any]) -> Optional[Any]:
+    """array followed by values, or None if either can't be held in one"""
+    tail = int_array(values)
+    if array is None or tail is None:
+        return None
+    return numpy.concatenate((array, tail))
+
+
+def all_of(masks: Sequence[Any]) -> Any:
+    return numpy.logical_and.reduce(masks)
+
+
+def any_of(masks: Sequence[Any]) -> Any:
+    return numpy.logical_or.reduce(masks)
+
+
+def negate(mask: Any) -> Any:
+    return numpy.logical_not(mask)
+
+
+def nonzero(mask: Any) -> Any:
+    """positions where mask is True"""
+    return numpy.flatnonzero(mask)
+
+
+def take(arrays: Sequence[Any], index: Any) -> List[Tuple]:
+    """rows made of the values of arrays at index, a slice or array of positions"""
+    return list(zip(*(array[index].tolist() for array in arrays)))
+
+
+def reduce(op: str, values: Any) -> Any:
+    """
+    COUNT, SUM, MIN or MAX of values, an array or a sequence that may hold
+    None, which is ignored. SUM, MIN and MAX of nothing are None.
+    """
+    if op != "COUNT" and op not in _REDUCTIONS:
+        raise ValueError("unsupported aggregate: {}".format(op))
+    if numpy is None or not isinstance(values, numpy.ndarray):
+        values = [val for val in values if val is not None]
+        if op == "COUNT":
+            return len(values)
+        return _REDUCTIONS[op](values) if values else None
+    if op == "COUNT":
+        return len(values)
+    if not len(values):
+        return None
+    if op == "SUM" and abs(values.sum(dtype=numpy.float64)) >= 2**62:
+        return sum(values.tolist())  # int64 would overflow
+    return int(getattr(values, op.lower())())
@@ -0,0 +1,155 @@
+from dataclasses import dataclass
+from enum import Enum
+from typing import Iterator, List, Optional, Sequence, Tuple
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+
+class LogOp(Enum):
+    INSERT = "INSERT"
+    INSERT_MANY = "INSERT_MANY"  # rows get consecutive rowids from rowid
+    DELETE = "DELETE"
+
+
+@dataclass
+class LogRecord:
+    lsn: int
+    op: LogOp
+    table: str
+    rowid: int
+    row: Optional[Tuple] = None
+    rows: Optional[Sequence[Tuple]] = None
+
+
+class WriteAheadLog:
+    """
+    Sequential log of table changes.
+
+    [size][crc32][pickled LogRecord] ...
+
+    append() only buffers a record. commit() makes everything appended so
+    far durable with group commit: one committer at a time writes and fsyncs
+    the whole buffer while later committers queue up behind it, so
+    concurrent committers share a single fsync. commit_delay makes the
+    leader wait that many seconds first to collect a larger group.
+
+    - threadsafe
+    """
+
+    FRAME = struct.Struct("<LL")
+
+    def __init__(self, fd: int, lsn: int, commit_delay: float = 0.0):
+        self._fd = fd
+        self._commit_delay = commit_delay
+        self._cond = threading.Condition()
+        self._pending = []  # type: List[bytes]
+        self._lsn = lsn  # last appended
+        self._durable_lsn = lsn
+        self._flushing = False
+        self._size = os.fstat(fd).st_size
+
+    @staticmethod
+    def open(path: str, commit_delay: float = 0.0) -> "WriteAheadLog":
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            end, lsn = 0, 0
+            for end, record in WriteAheadLog._read(fd):
+                lsn = record.lsn
+            os.ftruncate(fd, end)  # drop a torn tail
+            os.lseek(fd, 0, os.SEEK_END)
+            return WriteAheadLog(fd, lsn, commit_delay)
+        except:
+            os.close(fd)
+            raise
+
+    def close(self):
+        try:
+            self.commit()
+        finally:
+            os.close(self._fd)
+
+    def size(self) -> int:
+        """bytes written to the log file"""
+        return self._size
+
+    def records(self) -> Iterator[LogRecord]:
+        """durable records in log order"""
+        for _, record in self._read(self._fd):
+            yield record
+
+    def append(
+        self,
+        op: LogOp,
+        table: str,
+        rowid: int,
+        row: Optional[Tuple] = None,
+        rows: Optional[Sequence[Tuple]] = None,
+    ) -> int:
+        with self._cond:
+            self._lsn += 1
+            data = pickle.dumps(LogRecord(self._lsn, op, table, rowid, row, rows))
+            self._pending.append(self.FRAME.pack(len(data), zlib.crc32(data)))
+            self._pending.append(data)
+            return self._lsn
+
+    def commit(self):
+        """returns once every record appended before the call is durable"""
+        with self._cond:
+            lsn = self._lsn
+            while self._durable_lsn < lsn:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+                self._flushing = True
+                self._cond.release()
+                try:
+                    self._flush()
+                finally:
+                    self._cond.acquire()
+                    self._flushing = False
+                    self._cond.notify_all()
+
+    def truncate(self):
+        """discard every record. Callers must make sure nothing is appended
+        concurrently and that the changes logged so far are durable elsewhere."""
+        with self._cond:
+            assert not self._pending and not self._flushing
+            os.ftruncate(self._fd, 0)
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            os.fsync(self._fd)
+            self._size = 0
+
+    def _flush(self):
+        if self._commit_delay:
+            time.sleep(self._commit_delay)
+        with self._cond:
+            data = b"".join(self._pending)
+            self._pending = []
+            lsn = self._lsn
+        if data:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._fd, view) :]
+            os.fsync(self._fd)
+        with self._cond:
+            self._size += len(data)
+            self._durable_lsn = lsn
+
+    @classmethod
+    def _read(cls, fd: int) -> Iterator[Tuple[int, LogRecord]]:
+        """yields (end offset, record) up to the first torn or corrupt frame"""
+        offset = 0
+        while True:
+            frame = os.pread(fd, cls.FRAME.size, offset)
+            if len(frame) < cls.FRAME.size:
+                return
+            size, crc = cls.FRAME.unpack(frame)
+            data = os.pread(fd, size, offset + cls.FRAME.size)
+            if len(data) < size or zlib.crc32(data) != crc:
+                return
+            offset += cls.FRAME.size + size
+            yield offset, pickle.loads(data)
@@ -3,19 +3,29 @@ from . import context
 import unittest
 from pydb.error import SchemaError
 from pydb.core import Database
+from pydb.index import IndexKind
 from pydb.mem import MemDatabase, MemTable
 from pydb.query import (
+    Aggregate,
+    Analyze,
     BinExpr,
     Const,
+    CreateIndex,
     CreateTable,
     Delete,
+    Explain,
+    ExplainFormat,
     From,
     Insert,
+    InsertMany,
     Select,
     Symbol,
     Where,
     Join,
+    Not,
     On,
+    OrderBy,
+    Param,
 )
 from pydb.table import Column, ColumnAttr, DataType, Schema
 
@@ -27,6 +37,14 @@ STUDENTS_SCHEMA = Schema(
 )
 
 
+SIGNUPS = Schema(
+    "signups",
+    Column("id", DataType.INT, ColumnAttr.PRIMARY_KEY, ColumnAttr.AUTO_INCREMENT),
+    Column("sid", DataType.INT),
+    Column("timestamp", DataType.INT),
+)
+
+
 def create_test_student(sid: int):
     return (sid, "test", 99)
 
@@ -63,6 +81,117 @@ class DatabaseTestCase:
             )
         )
         self.assertEqual(list(results), [students[1]])
+        results = self.db.exec(
+            Select(
+                STUDENTS_SCHEMA.column_names(),
+                From("students"),
+                Where(BinExpr("=", Symbol("id"), Const(0))),
+            )
+        )
+        self.assertEqual(list(results), [students[0]])
+
+    def test_select_range(self):
+        students = [(x, "s{}".format(x), 20 + x % 3) for x in range(10)]
+        self._insert(*students)
+        cases = [
+            (BinExpr(">", Symbol("id"), Const(6)), lambda s: s[0] > 6),
+            (BinExpr("<=", Symbol("id"), Const(2)), lambda s: s[0] <= 2),
+            (BinExpr(">", Const(3), Symbol("id")), lambda s: s[0] < 3),
+            (BinExpr(">=", Symbol("age"), Const(21)), lambda s: s[2] >= 21),
+        ]
+        for cond, pred in cases:
+            results = self.db.exec(
+                Select(STUDENTS_SCHEMA.column_names(), From("students"), Where(cond))
+            )
+            self.assertEqual(list(results), [s for s in students if pred(s)])
+
+    def test_analyze(self):
+        students = [(x, "s{}".format(x % 7), 20 + x % 5) for x in range(200)]
+        self._insert(*students)
+        self.db.exec(CreateIndex("students", ("age",), IndexKind.SORTED))
+        self.db.exec(Analyze())
+        self._insert((200, "s", 30))
+        cond = BinExpr(
+            "AND",
+            BinExpr(">=", Symbol("age"), Const(21)),
+            BinExpr("=", Symbol("name"), Const("s3")),
+        )
+        results = self.db.exec(
+            Select(STUDENTS_SCHEMA.column_names(), From("students"), Where(cond))
+        )
+        expected = [s for s in students if s[2] >= 21 and s[1] == "s3"]
+        self.assertEqual(list(results), expected)
+        with self.assertRaises(ValueError):
+            self.db.exec(Analyze("missing"))
+
+    def test_explain(self):
+        students = [(x, "s{}".format(x % 7), 20 + x % 5) for x in range(50)]
+        self._insert(*students)
+        self.db.exec(Analyze())
+        query = Select(
+            ("name",), From("students"), Where(BinExpr("<", Symbol("age"), Const(22)))
+        )
+        lines = [line for (line,) in self.db.exec(Explain(query))]
+        # the cached plan exec() runs
+        self.assertTrue(lines[0].startswith("CompiledPipeline [table=students]"))
+        self.assertIn("ColumnProjection [columns=(name)]", lines[1])
+        self.assertIn("FilteredScan [table=students, cond=age < 22]", lines[2])
+        ((tree,),) = self.db.exec(Explain(query, True, ExplainFormat.DICT))
+        self.assertEqual(tree["actual"]["rows"], 20)
+        self.assertIn("estimated_cost", tree)
+        lookup = Select(
+            ("name",), From("students"), Where(BinExpr("=", Symbol("id"), Param(0)))
+        )
+        ((tree,),) = self.db.exec(Explain(lookup, format=ExplainFormat.DICT))
+        self.assertEqual(tree["children"][0]["operator"], "IndexedLookup")
+        with self.assertRaises(ValueError):
+            self.db.exec(Explain(lookup, True))
+
+    def test_prepare(self):
+        students = [(x, "s{}".format(x % 7), 20 + x % 5) for x in range(50)]
+        self._insert(*students)
+        cond = BinExpr(
+            "AND",
+            BinExpr("=", Symbol("name"), Param(0)),
+            BinExpr("<", Symbol("age"), Param(1)),
+        )
+        statement = self.db.prepare(Select(("id",), From("students"), Where(cond)))
+
+        def expected(name, age):
+            return [(s[0],) for s in students if s[1] == name and s[2] < age]
+
+        self.assertEqual(list(statement.exec("s3", 22)), expected("s3", 22))
+        self.db.exec(CreateIndex("students", ("name",)))
+        self.assertEqual(list(statement.exec("s4", 24)), expected("s4", 24))
+        self.db.exec(Analyze())
+        self.assertEqual(list(statement.exec("s1", 30)), expected("s1", 30))
+        with self.assertRaises(ValueError):
+            statement.exec("s1")
+        with self.assertRaises(ValueError):
+            self.db.exec(Select(("id",), From("students"), Where(cond)))
+        with self.assertRaises(ValueError):
+            self.db.prepare(Analyze())
+        # queries of the same shape share a plan, each with its own values
+        for x in (3, 4):
+            query = Select(
+                ("name",), From("students"), Where(BinExpr("=", Symbol("id"), Const(x)))
+            )
+            self.assertEqual(list(self.db.exec(query)), [("s{}".format(x),)])
+
+    def test_insert_duplicate_primary_key(self):
+        self._insert((0, "ark", 10))
+        with self.assertRaises(ValueError):
+            self._insert((0, "bam", 11))
+        with self.assertRaises(ValueError):
+            self.db.exec(
+                InsertMany(
+                    "students",
+                    STUDENTS_SCHEMA.column_names(),
+                    [(1, "cam", 12), (0, "dan", 13)],
+                )
+            )
+        results = self.db.exec(Select(STUDENTS_SCHEMA.column_names(), From("students")))
+        self.assertEqual(list(results), [(0, "ark", 10)])
 
     def test_select_with_name_filter(self):
         students = [
@@ -135,6 +264,201 @@ class DatabaseTestCase:
         ]
         self.assertEqual(list(results), expected)
 
+    def test_create_index(self):
+        students = [(x, "s{}".format(x), 20 + x % 3) for x in range(30)]
+        self._insert(*students[:20])
+        self.db.exec(CreateIndex("students", ("age",), IndexKind.SORTED))
+        with self.assertRaises(ValueError):
+            self.db.exec(CreateIndex("students", ("age",)))
+        with self.assertRaises(ValueError):
+            self.db.exec(CreateIndex("students", ("missing",)))
+        self._insert(*students[20:])
+        for age in (20, 22, 30):
+            results = self.db.exec(
+                Select(
+                    STUDENTS_SCHEMA.column_names(),
+                    From("students"),
+                    Where(BinExpr("=", Symbol("age"), Const(age))),
+                )
+            )
+            self.assertEqual(list(results), [s for s in students if s[2] == age])
+        results = self.db.exec(
+            Select(
+                STUDENTS_SCHEMA.column_names(),
+                From("students"),
+                Where(BinExpr(">", Symbol("age"), Const(20))),
+            )
+        )
+        expected = sorted((s for s in students if s[2] > 20), key=lambda s: s[2])
+        self.assertEqual(list(results), expected)
+
+    def test_composite_index(self):
+        students = [(x, "s{}".format(x % 4), 20 + x % 3) for x in range(24)]
+        self._insert(*students)
+        self.db.exec(
+            CreateIndex("students", ("age", "name"), IndexKind.SORTED, ("id",))
+        )
+        age = BinExpr("=", Symbol("age"), Const(21))
+        name = BinExpr("=", Symbol("name"), Const("s2"))
+        for cond, pred in [
+            (age, lambda s: s[2] == 21),
+            (BinExpr("AND", name, age), lambda s: s[1] == "s2" and s[2] == 21),
+        ]:
+            for columns in (("id", "name"), STUDENTS_SCHEMA.column_names()):
+                cols = STUDENTS_SCHEMA.columnids(*columns)
+                results = self.db.exec(Select(columns, From("students"), Where(cond)))
+                expected = [tuple(s[c] for c in cols) for s in students if pred(s)]
+                self.assertEqual(sorted(results), sorted(expected))
+
+    def test_bitmap_index(self):
+        students = [(x, "s{}".format(x % 3), 20 + x % 4) for x in range(40)]
+        self._insert(*students)
+        self.db.exec(CreateIndex("students", ("age",), IndexKind.BITMAP))
+        self.db.exec(CreateIndex("students", ("name",), IndexKind.BITMAP))
+        with self.assertRaises(ValueError):
+            self.db.exec(CreateIndex("students", ("id",), IndexKind.BITMAP, ("age",)))
+        age = BinExpr("=", Symbol("age"), Const(21))
+        name = BinExpr("=", Symbol("name"), Const("s1"))
+        older = BinExpr("OR", age, BinExpr(">", Symbol("age"), Const(21)))
+        for cond, pred in [
+            (BinExpr("AND", age, name), lambda s: s[2] == 21 and s[1] == "s1"),
+            (BinExpr("OR", age, name), lambda s: s[2] == 21 or s[1] == "s1"),
+            (BinExpr("AND", Not(age), name), lambda s: s[2] != 21 and s[1] == "s1"),
+            (BinExpr("AND", name, older), lambda s: s[1] == "s1" and s[2] >= 21),
+        ]:
+            results = self.db.exec(
+                Select(STUDENTS_SCHEMA.column_names(), From("students"), Where(cond))
+            )
+            self.assertEqual(list(results), [s for s in students if pred(s)])
+
+    def test_order_by(self):
+        students = [(x, "s{}".format(x % 4), 20 + (x * 7) % 5) for x in range(20)]
+        self._insert(*reversed(students))
+        self.db.exec(CreateIndex("students", ("age",), IndexKind.SORTED))
+        for where, descending in [(None, False), (None, True), (21, False), (21, True)]:
+            cond = Where(BinExpr(">=", Symbol("age"), Const(where))) if where else None
+            results = self.db.exec(
+                Select(
+                    ("id", "age"),
+                    From("students"),
+                    cond,
+                    OrderBy(("age", "id"), descending),
+                )
+            )
+            expected = sorted(
+                ((s[0], s[2]) for s in students if not where or s[2] >= where),
+                key=lambda s: (s[1], s[0]),
+                reverse=descending,
+            )
+            self.assertEqual(list(results), expected)
+
+    def test_limit(self):
+        students = [(x, "s{}".format(x % 4), 20 + x % 5) for x in range(40)]
+        self._insert(*students)
+        old = Where(BinExpr(">", Symbol("age"), Const(22)))
+        query = Select(("id",), From("students"), old, limit=4, offset=3)
+        expected = [(s[0],) for s in students if s[2] > 22][3:7]
+        self.assertEqual(list(self.db.exec(query)), expected)
+        query.order_by = OrderBy(("name", "id"))
+        expected = sorted((s[1], s[0]) for s in students if s[2] > 22)[3:7]
+        self.assertEqual(list(self.db.exec(query)), [(s[1],) for s in expected])
+
+    def test_group_by(self):
+        students = [(x, "s{}".format(x % 3), 20 + x % 4) for x in range(30)]
+        students.append((30, "s0", None))
+        self._insert(*students)
+        query = Select(
+            (
+                Aggregate("AVG", "age"),
+                "name",
+                Aggregate("COUNT"),
+                Aggregate("MAX", "id"),
+            ),
+            From("students"),
+            Where(BinExpr(">", Symbol("id"), Const(2))),
+            OrderBy(("name",), descending=True),
+            ("name",),
+        )
+        expected = []
+        for name in ("s2", "s1", "s0"):
+            group = [s for s in students if s[1] == name and s[0] > 2]
+            ages = [s[2] for s in group if s[2] is not None]
+            expected.append(
+                (sum(ages) / len(ages), name, len(group), max(s[0] for s in group))
+            )
+        self.assertEqual(list(self.db.exec(query)), expected)
+        count = Select((Aggregate("COUNT"),), From("students"))
+        self.assertEqual(list(self.db.exec(count)), [(31,)])
+        with self.assertRaises(ValueError):
+            self.db.exec(Select(("id", Aggregate("COUNT")), From("students")))
+
+    def test_indexed_join_many(self):
+        self._insert((0, "abe", 20), (1, "bark", 30))
+        for kind in (IndexKind.HASH, IndexKind.SORTED):
+            with self.subTest(kind=kind):
+                name = "signups_" + kind.value.lower()
+                self.db.exec(CreateTable(Schema(name, *SIGNUPS.columns)))
+                signups = [(0, 0, 100), (1, 1, 101), (2, 0, 102)]
+                for signup in signups:
+                    self.db.exec(Insert(name, SIGNUPS.column_names(), signup))
+                self.db.exec(CreateIndex(name, ("sid",), kind))
+                results = self.db.exec(
+                    Select(
+                        ("students.name", name + ".timestamp"),
+                        From(
+                            Join(
+                                ("students", name),
+                                On(
+                                    BinExpr(
+                                        "=",
+                                        Symbol("students.id"),
+                                        Symbol(name + ".sid"),
+                                    )
+                                ),
+                            )
+                        ),
+                    )
+                )
+                expected = [("abe", 100), ("abe", 102), ("bark", 101)]
+                self.assertEqual(list(results), expected)
+
+    def test_indexed_join_null(self):
+        self._insert((0, "abe", 20), (1, "bark", None), (2, "cab", 30))
+        kinds = (None, IndexKind.HASH, IndexKind.SORTED, IndexKind.BITMAP)
+        for kind in kinds:
+            with self.subTest(kind=kind):
+                name = "ages_" + (kind.value.lower() if kind else "none")
+                schema = Schema(
+                    name,
+                    Column("id", DataType.INT, ColumnAttr.PRIMARY_KEY),
+                    Column("age", DataType.INT),
+                )
+                self.db.exec(CreateTable(schema))
+                rows = [(0, 20), (1, None), (2, 30)]
+                self.db.exec(InsertMany(name, schema.column_names(), rows))
+                if kind:
+                    self.db.exec(CreateIndex(name, ("age",), kind))
+                cond = BinExpr("=", Symbol("students.age"), Symbol(name + ".age"))
+                query = Select(
+                    ("students.id", name + ".id"),
+                    From(Join(("students", name), On(cond))),
+                )
+                # null keys never match, not even each other
+                self.assertEqual(list(self.db.exec(query)), [(0, 0), (2, 2)])
+
+    def test_insert_many(self):
+        students = [create_test_student(x) for x in range(10000)]
+        results = self.db.exec(
+            InsertMany("students", STUDENTS_SCHEMA.column_names(), students)
+        )
+        self.assertEqual(list(results), students)
+        self._insert((10000, "last", 1))
+        students.append((10000, "last", 1))
+        results = self.db.exec(Select(STUDENTS_SCHEMA.column_names(), From("students")))
+        self.assertEqual(list(results), students)
+        with self.assertRaises(ValueError):
+            self.db.exec(InsertMany("students", ("id", "name"), [(0, "bad")]))
+
     def test_create_table_bad_schema(self):
         with self.assertRaises(SchemaError):
             self.db.exec(CreateTable(Schema("")))
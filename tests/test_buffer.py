@@ -0,0 +1,66 @@
+from . import context
+import unittest
+from pydb.buffer import BufferPool
+
+
+class FakeFile:
+    def __init__(self):
+        self.pages = {}
+        self.reads = 0
+        self.writes = []
+
+    def read_page(self, page_no):
+        self.reads += 1
+        return self.pages.get(page_no, "empty")
+
+    def write_pages(self, page_no, pages):
+        self.writes.append((page_no, list(pages)))
+        for i, page in enumerate(pages):
+            self.pages[page_no + i] = page
+
+
+class BufferPoolTestCase(unittest.TestCase):
+    def test_hits_and_misses(self):
+        pool = BufferPool(2)
+        f = FakeFile()
+        f.pages[0] = "a"
+        self.assertEqual(pool.get(f, 0), "a")
+        self.assertEqual(pool.get(f, 0), "a")
+        self.assertEqual((pool.hits, pool.misses, f.reads), (1, 1, 1))
+
+    def test_lru_eviction_writes_back_dirty_pages(self):
+        pool = BufferPool(2)
+        f = FakeFile()
+        pool.put(f, 0, "a")
+        pool.put(f, 1, "b", dirty=False)
+        pool.get(f, 0)  # 1 is now least recently used
+        pool.put(f, 2, "c")
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(f.writes, [])
+        pool.put(f, 3, "d")  # evicts dirty page 0
+        self.assertEqual(f.writes, [(0, ["a"])])
+
+    def test_flush_coalesces_contiguous_pages(self):
+        pool = BufferPool(8)
+        f = FakeFile()
+        for page_no in (3, 1, 2, 5):
+            pool.put(f, page_no, str(page_no))
+        pool.flush(f)
+        self.assertEqual(f.writes, [(1, ["1", "2", "3"]), (5, ["5"])])
+        pool.flush(f)
+        self.assertEqual(len(f.writes), 2)
+
+    def test_shared_between_files(self):
+        pool = BufferPool(4)
+        f1, f2 = FakeFile(), FakeFile()
+        pool.put(f1, 0, "a")
+        pool.put(f2, 0, "b")
+        self.assertEqual(pool.get(f1, 0), "a")
+        self.assertEqual(pool.get(f2, 0), "b")
+        pool.discard(f1)
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(f1.writes, [])
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            BufferPool(0)
@@ -0,0 +1,42 @@
+from . import context
+from .base import STUDENTS_SCHEMA
+import unittest
+from pydb.codec import PickleCodec, RowCodec
+from pydb.table import Column, DataType, Schema
+
+
+class RowCodecTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        codec = RowCodec(STUDENTS_SCHEMA)
+        rows = [
+            (0, "ark", 42),
+            (-1, "", 2**62),
+            (1, "ü€x", 2),
+            (None, "bam", None),
+            (2, None, 3),
+        ]
+        for row in rows:
+            data = codec.encode(row)
+            self.assertEqual(codec.decode(data), row)
+            self.assertEqual(codec.decode(memoryview(bytearray(data))), row)
+
+    def test_smaller_than_pickle(self):
+        codec = RowCodec(STUDENTS_SCHEMA)
+        row = (1000000, "ark", 100000)
+        self.assertLess(len(codec.encode(row)), len(PickleCodec().encode(row)))
+
+    def test_int_only_schema(self):
+        codec = RowCodec(Schema("ints", Column("a", DataType.INT)))
+        self.assertEqual(codec.decode(codec.encode((7,))), (7,))
+        self.assertEqual(codec.decode(codec.encode((None,))), (None,))
+
+    def test_bad_rows(self):
+        codec = RowCodec(STUDENTS_SCHEMA)
+        for row in [(0, 1, 2), ("0", "a", 2), (0, "a"), (0, "a", 2**64)]:
+            with self.assertRaises(ValueError):
+                codec.encode(row)
+
+    def test_too_many_columns(self):
+        columns = [Column(str(i), DataType.INT) for i in range(65)]
+        with self.assertRaises(ValueError):
+            RowCodec(Schema("wide", *columns))
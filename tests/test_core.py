@@ -26,3 +26,8 @@ class PydbInterfaceTestCase(unittest.TestCase):
                 assert db
             with pydb.connect("disk:" + folder) as db:
                 assert db
+
+    def test_connect_options(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with pydb.connect(folder, buffer_pool_size=16) as db:
+                assert db._pool.size() == 16
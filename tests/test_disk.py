@@ -1,11 +1,31 @@
 from . import context
-from .base import DatabaseTestCase, STUDENTS_SCHEMA, create_test_student
-from pydb.query import CreateTable, Insert, Select, From
-from pydb.disk import RowHeader, HeapFile, DiskTable, DiskDatabase
+from .base import DatabaseTestCase, SIGNUPS, STUDENTS_SCHEMA, create_test_student
+from pydb.index import IndexKind
+from pydb.table import IndexDef
+from pydb.query import (
+    Analyze,
+    BinExpr,
+    Const,
+    CreateIndex,
+    CreateTable,
+    From,
+    Insert,
+    InsertMany,
+    Join,
+    Not,
+    On,
+    Select,
+    Symbol,
+    Where,
+)
+from pydb.buffer import BufferPool
+from pydb.codec import RowCodec
+from pydb.disk import RowHeader, Page, HeapFile, RowIndex, DiskTable, DiskDatabase
 from io import BytesIO
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 
 
@@ -18,7 +38,24 @@ def test_row_header():
         assert h == RowHeader.read(buf)
 
 
+def test_page():
+    page = Page.empty(64)
+    assert page.num_slots() == 0
+    assert page.insert(b"abc") == 0
+    assert page.insert(b"defg") == 1
+    header, data = page.read(1)
+    assert (header.size, header.tombstone, bytes(data)) == (4, False, b"defg")
+    assert page.remove(0)
+    assert not page.remove(0)
+    assert page.read(0)[0].tombstone
+    while page.insert(b"x") is not None:
+        pass
+    assert page.free_space() < RowHeader.SIZE + 1 + Page.SLOT.size
+
+
 class HeapFileTestCase(unittest.TestCase):
+    use_mmap = False
+
     def test_heap_file(self):
         fd, path = tempfile.mkstemp("heap_file_test")
         os.close(fd)
@@ -36,11 +73,11 @@ class HeapFileTestCase(unittest.TestCase):
                 self.assertEqual(f.get(offset), record)
             self.assertEqual(list(iter(f)), list(zip(offsets, records)))
 
-        with HeapFile.open(path) as f:
+        with HeapFile.open(path, use_mmap=self.use_mmap) as f:
             for record in records:
                 offsets.append(f.append(record))
             check_contents(f)
-        with HeapFile.open(path) as f:
+        with HeapFile.open(path, use_mmap=self.use_mmap) as f:
             check_contents(f)
 
             records.append((4, "e", 4.4))
@@ -57,6 +94,83 @@ class HeapFileTestCase(unittest.TestCase):
 
             check_contents(f)
 
+    def test_heap_file_pages(self):
+        fd, path = tempfile.mkstemp("heap_file_test")
+        os.close(fd)
+        os.remove(path)
+
+        pool = BufferPool(4)
+        records = [(i, "x" * 100) for i in range(1000)]
+        with HeapFile.open(path, pool, self.use_mmap) as f:
+            offsets = [f.append(record) for record in records]
+            self.assertGreater(f.num_pages(), pool.size())
+            self.assertLessEqual(len(pool), pool.size())
+            self.assertEqual([f.get(offset) for offset in offsets], records)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(os.path.getsize(path) % HeapFile.PAGE_SIZE, 0)
+        with HeapFile.open(path, pool, self.use_mmap) as f:
+            self.assertEqual(list(f), list(zip(offsets, records)))
+            self.assertEqual(
+                list(f.scan(offsets[500])), list(zip(offsets, records))[500:]
+            )
+            with self.assertRaises(ValueError):
+                f.append(("x" * HeapFile.PAGE_SIZE,))
+        os.remove(path)
+
+    def test_append_many(self):
+        fd, path = tempfile.mkstemp("heap_file_test")
+        os.close(fd)
+        os.remove(path)
+
+        records = [(i, "x" * 100) for i in range(1000)]
+        with HeapFile.open(path, use_mmap=self.use_mmap) as f:
+            offsets = [f.append(records[0], 0)]
+            offsets += f.append_many(records[1:], 1)
+            self.assertEqual(list(f), list(zip(offsets, records)))
+            rowids = [header.rowid for _, header in f.offsets()]
+            self.assertEqual(rowids, list(range(len(records))))
+            with self.assertRaises(ValueError):
+                f.append_many([(0, "ok"), (1, "x" * HeapFile.PAGE_SIZE)])
+        with HeapFile.open(path, use_mmap=self.use_mmap) as f:
+            self.assertEqual(list(f), list(zip(offsets, records)))
+        os.remove(path)
+
+    def test_heap_file_codec(self):
+        fd, path = tempfile.mkstemp("heap_file_test")
+        os.close(fd)
+        os.remove(path)
+
+        codec = RowCodec(STUDENTS_SCHEMA)
+        records = [create_test_student(x) for x in range(10)]
+        with HeapFile.open(path, codec=codec, use_mmap=self.use_mmap) as f:
+            offsets = [f.append(record) for record in records]
+        with HeapFile.open(path, codec=codec, use_mmap=self.use_mmap) as f:
+            self.assertEqual(list(f), list(zip(offsets, records)))
+        with self.assertRaises(ValueError):
+            HeapFile.open(path)  # pickle codec
+        os.remove(path)
+
+
+class MmapHeapFileTestCase(HeapFileTestCase):
+    use_mmap = True
+
+    def test_append_while_scanning(self):
+        fd, path = tempfile.mkstemp("heap_file_test")
+        os.close(fd)
+        os.remove(path)
+
+        with HeapFile.open(path, use_mmap=True) as f:
+            records = [(i, "x" * 1000) for i in range(20)]
+            for record in records:
+                f.append(record)
+            scanned = []
+            for offset, record in f:
+                scanned.append(record)
+                f.append(record)  # grows the file and remaps it
+            self.assertEqual(scanned[: len(records)], records)
+            self.assertEqual(len(list(f)), len(records) + len(scanned))
+        os.remove(path)
+
 
 class DiskTableTestCase(unittest.TestCase):
     def test_disk_table(self):
@@ -82,6 +196,230 @@ class DiskTableTestCase(unittest.TestCase):
                 records.pop(idx)
             check_table(table)
 
+    def test_primary_key_index(self):
+        records = [create_test_student(x) for x in range(10)]
+        folder = tempfile.mkdtemp()
+        with DiskTable.open(STUDENTS_SCHEMA, folder) as table:
+            self.assertEqual(table.indexes("name"), ())
+            table.insert_many(records)
+            with self.assertRaises(ValueError):
+                table.insert(create_test_student(3))
+            table.delete(4)
+        table = DiskTable.open(STUDENTS_SCHEMA, folder)
+        (index,) = table.indexes("id")
+        self.assertFalse(index.stale)
+        self.assertEqual([index.find(x) for x in range(3, 6)], [3, None, 5])
+        table.insert(create_test_student(4))
+        table.delete(5)
+        table._file.close()  # crash before the index is flushed
+        table._row_index.close(flush=False)
+        index.close(flush=False)
+        with DiskTable.open(STUDENTS_SCHEMA, folder) as table:
+            (index,) = table.indexes("id")
+            self.assertEqual([index.find(x) for x in range(3, 6)], [3, 10, None])
+            self.assertEqual(list(index.scan()), [0, 1, 2, 3, 10, 6, 7, 8, 9])
+        shutil.rmtree(folder)
+
+    def test_create_index(self):
+        records = [(x, "s{}".format(x % 2), x % 3) for x in range(10)]
+        folder = tempfile.mkdtemp()
+        age = IndexDef(("age",))
+        covering = IndexDef(("name", "age"), include=("id",))
+        with DiskTable.open(STUDENTS_SCHEMA, folder) as table:
+            table.insert_many(records)
+            index = table.create_index(age)
+            self.assertEqual(table.indexes("age"), (index,))
+            self.assertEqual(list(index.find_all(1)), [1, 4, 7])
+            with self.assertRaises(ValueError):
+                table.create_index(IndexDef(("id",)))
+            table.create_index(covering)
+            table.delete(4)
+        defs = [age, covering]
+        table = DiskTable.open(STUDENTS_SCHEMA, folder, index_defs=defs)
+        (index,) = table.indexes("age")
+        self.assertEqual(list(index.find_all(1)), [1, 7])
+        table.insert((10, "s0", 1))
+        table.delete(7)
+        table._file.close()  # crash before the indexes are flushed
+        table._row_index.close(flush=False)
+        for tree in table._trees.values():
+            tree.close(flush=False)
+        with DiskTable.open(STUDENTS_SCHEMA, folder, index_defs=defs) as table:
+            (index,) = table.indexes("age")
+            self.assertEqual(list(index.find_all(1)), [1, 10])
+            self.assertEqual(list(index.find_all(0)), [0, 3, 6, 9])
+            index = dict(table.index_defs())[covering]
+            # values are (rowid, id)
+            self.assertEqual(list(index.find_all(("s0", 0))), [(0, 0), (6, 6)])
+            self.assertEqual(list(index.find_all(("s1", 0))), [(3, 3), (9, 9)])
+            self.assertEqual(list(index.find_all(("s0", 1))), [(10, 10)])
+        shutil.rmtree(folder)
+
+    def test_delete_logged_first(self):
+        folder = tempfile.mkdtemp()
+        try:
+            with DiskTable.open(STUDENTS_SCHEMA, folder) as table:
+                table.insert(create_test_student(0))
+                seen = []
+
+                class Log:
+                    def append(self, op, table_name, rowid, *args, **kwargs):
+                        seen.append(table.get(rowid))
+
+                table.log_to(Log())
+                table.delete(0)
+                table.log_to(None)
+                self.assertEqual(seen, [create_test_student(0)])
+                self.assertIsNone(table.get(0))
+        finally:
+            shutil.rmtree(folder)
+
+
+class RowIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "students.rowidx")
+        self.records = [create_test_student(x) for x in range(10)]
+        with DiskTable.open(STUDENTS_SCHEMA, self.folder) as table:
+            for record in self.records:
+                table.insert(record)
+            table.delete(3)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def check_table(self, table):
+        for rowid, record in enumerate(self.records):
+            self.assertEqual(table.get(rowid), None if rowid == 3 else record)
+        live = [r for rowid, r in enumerate(self.records) if rowid != 3 and r]
+        self.assertEqual(table.count(), len(live))
+
+    def test_reopen_uses_row_index(self):
+        with DiskTable.open(STUDENTS_SCHEMA, self.folder) as table:
+            self.assertEqual(table._row_index._synced, len(self.records))
+            self.check_table(table)
+            rowid, _ = table.insert(create_test_student(10))
+            self.records.append(create_test_student(10))
+            table.delete(5)
+            self.records[5] = None
+        with DiskTable.open(STUDENTS_SCHEMA, self.folder) as table:
+            self.assertEqual(table._row_index._synced, len(self.records))
+            self.check_table(table)
+
+    def check_rebuilt(self):
+        with DiskTable.open(STUDENTS_SCHEMA, self.folder) as table:
+            self.assertEqual(table._row_index._synced, 0)
+            self.check_table(table)
+        with DiskTable.open(STUDENTS_SCHEMA, self.folder) as table:
+            self.assertEqual(table._row_index._synced, len(self.records))
+
+    def test_corrupt_row_index(self):
+        with open(self.path, "rb+") as f:
+            f.seek(RowIndex.HEADER.size)
+            f.write(b"garbage!")
+        self.check_rebuilt()
+
+    def test_truncated_row_index(self):
+        os.truncate(self.path, os.path.getsize(self.path) - 8)
+        self.check_rebuilt()
+
+    def test_missing_row_index(self):
+        os.remove(self.path)
+        self.check_rebuilt()
+
+    def test_unclean_row_index(self):
+        table = DiskTable.open(STUDENTS_SCHEMA, self.folder)
+        table.insert(create_test_student(10))
+        self.records.append(create_test_student(10))
+        table._file.close()  # crash before the row index is flushed
+        table._row_index.close(flush=False)
+        self.check_rebuilt()
+
+
+class CompactionTestCase(unittest.TestCase):
+    use_mmap = False
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "students.data")
+        self.table = self.open()
+        self.records = [create_test_student(x) for x in range(4000)]
+        self.table.insert_many(self.records)
+        for rowid in range(0, len(self.records), 4):
+            if rowid % 8:
+                self.delete(rowid)
+
+    def tearDown(self):
+        self.table.close()
+        shutil.rmtree(self.folder)
+
+    def open(self, **options):
+        return DiskTable.open(
+            STUDENTS_SCHEMA, self.folder, use_mmap=self.use_mmap, **options
+        )
+
+    def delete(self, rowid):
+        self.table.delete(rowid)
+        self.records[rowid] = None
+
+    def check_table(self, table):
+        for rowid, record in enumerate(self.records):
+            self.assertEqual(table.get(rowid), record)
+        live = [record for record in self.records if record is not None]
+        self.assertEqual(sorted(table.rows()), sorted(live))
+
+    def test_compact(self):
+        self.assertGreater(self.table.dead_space(), 0.1)
+        size = os.path.getsize(self.path)
+        self.assertTrue(self.table.compact())
+        self.assertEqual(self.table.dead_space(), 0.0)
+        self.assertLess(os.path.getsize(self.path), size)
+        self.assertFalse(os.path.exists(self.path + ".compact"))
+        self.check_table(self.table)
+        self.table.close()
+        self.table = self.open()
+        self.assertEqual(self.table._row_index._synced, len(self.records))
+        self.check_table(self.table)
+
+    def test_incremental_compact(self):
+        self.table.COMPACT_STEP = 1  # continued by every change
+        source = self.table._file
+        steps = 0
+        while not self.table.compact(max_pages=2):
+            steps += 1
+            rowid, record = self.table.insert(create_test_student(len(self.records)))
+            self.records.append(record)
+            self.delete(steps * 8)  # copied already
+            self.delete(len(self.records) - 2)  # not copied yet
+            self.check_table(self.table)
+        self.assertGreater(steps, 2)
+        self.check_table(self.table)
+        self.assertTrue(source._file.closed)
+        self.assertFalse(any(file is source for file, _ in self.table._pool._pages))
+
+    def test_auto_compact(self):
+        self.table.close()
+        self.table = self.open(compact_threshold=0.3)
+        pages = self.table._file.num_pages()
+        rowid = 1
+        while self.table._file.num_pages() == pages:
+            if self.records[rowid] is not None:
+                self.delete(rowid)
+            rowid += 1
+        self.assertLess(self.table.dead_space(), 0.3)
+        self.check_table(self.table)
+
+    def test_close_while_compacting(self):
+        self.assertFalse(self.table.compact(max_pages=1))
+        self.table.close()
+        self.assertFalse(os.path.exists(self.path + ".compact"))
+        self.table = self.open()
+        self.check_table(self.table)
+
+
+class MmapCompactionTestCase(CompactionTestCase):
+    use_mmap = True
+
 
 class DiskDatabaseTestCase(DatabaseTestCase, unittest.TestCase):
     def setUp(self):
@@ -109,14 +447,131 @@ class DiskDatabaseTestCase(DatabaseTestCase, unittest.TestCase):
         with DiskDatabase.open(path) as db:
             pass  # ok
 
+    def test_delete(self):
+        folder = os.path.join(self.folder, "db")
+        with DiskDatabase.open(folder) as db:
+            db.exec(CreateTable(STUDENTS_SCHEMA))
+            db.exec(CreateIndex("students", ("age",), IndexKind.SORTED))
+        open(os.path.join(folder, "notes"), "w").close()
+        DiskDatabase.open(folder).delete()
+        self.assertEqual(os.listdir(folder), ["notes"])  # not one of its files
+        os.remove(os.path.join(folder, "notes"))
+        DiskDatabase.open(folder).delete()
+        self.assertFalse(os.path.exists(folder))
+
     def test_open_close(self):
         students = [create_test_student(x) for x in range(10)]
-        with DiskDatabase.open(self.folder) as db:
+        # self.db already holds self.folder open and its tables are durable
+        folder = os.path.join(self.folder, "db")
+        with DiskDatabase.open(folder) as db:
             db.exec(CreateTable(STUDENTS_SCHEMA))
             for student in students:
                 db.exec(Insert("students", STUDENTS_SCHEMA.column_names(), student))
-        with DiskDatabase.open(self.folder) as db:
+        with DiskDatabase.open(folder) as db:
             results = db.exec(Select(STUDENTS_SCHEMA.column_names(), From("students")))
             results = list(results)
             results.sort(key=lambda s: s[0])
             self.assertEqual(results, students)
+
+    def test_select_under_lock(self):
+        students = [create_test_student(x) for x in range(10)]
+        self.db.exec(InsertMany("students", STUDENTS_SCHEMA.column_names(), students))
+        query = Select(("id",), From("students"))
+        insert = Insert("students", STUDENTS_SCHEMA.column_names(), (10, "s", 2))
+        rows = iter(self.db.exec(query))
+        self.assertEqual(next(rows), (0,))
+        with self.assertRaises(ValueError):
+            self.db.exec(insert)  # by the reading thread
+        writer = threading.Thread(target=self.db.exec, args=(insert,))
+        writer.start()
+        writer.join(0.1)
+        self.assertTrue(writer.is_alive())  # waits for the cursor
+        self.assertEqual(list(rows), [(x,) for x in range(1, 10)])
+        writer.join()
+        statement = self.db.prepare(query)
+        self.assertEqual(len(list(statement.exec())), 11)
+        statement.exec().close()
+        self.db.exec(query)  # dropped unread
+        self.db.exec(Insert("students", STUDENTS_SCHEMA.column_names(), (11, "s", 2)))
+
+    def test_create_index_reopen(self):
+        students = [(x, "s{}".format(x), x % 3) for x in range(10)]
+        self.db.exec(InsertMany("students", STUDENTS_SCHEMA.column_names(), students))
+        self.db.exec(CreateIndex("students", ("age",), IndexKind.SORTED))
+        self.db.close()
+        self.db = DiskDatabase.open(self.folder)
+        (index,) = self.db._tables["students"].indexes("age")
+        self.assertEqual(list(index.find_all(2)), [2, 5, 8])
+        self.db.exec(Insert("students", STUDENTS_SCHEMA.column_names(), (10, "s", 2)))
+        self.db.close()
+        self.db = DiskDatabase.open(self.folder)
+        results = self.db.exec(
+            Select(
+                STUDENTS_SCHEMA.column_names(),
+                From("students"),
+                Where(BinExpr("=", Symbol("age"), Const(2))),
+            )
+        )
+        self.assertEqual([s[0] for s in results], [2, 5, 8, 10])
+
+    def test_analyze_reopen(self):
+        students = [(x, "s{}".format(x % 4), x % 10) for x in range(100)]
+        self.db.exec(InsertMany("students", STUDENTS_SCHEMA.column_names(), students))
+        self.db.exec(Analyze("students"))
+        self.db.exec(Insert("students", STUDENTS_SCHEMA.column_names(), (100, "s", 20)))
+        self.db.close()
+        self.db = DiskDatabase.open(self.folder)
+        stats = self.db._stats["students"]
+        self.assertEqual(stats.rows, 101)
+        self.assertAlmostEqual(stats.columns["name"].distinct, 4, delta=0.1)
+        self.assertEqual(stats.columns["age"].bounds[-1], 20)
+        with self.assertRaises(ValueError):
+            self.db.exec(Analyze("missing"))
+
+    def test_bitmap_index_reopen(self):
+        students = [(x, "s{}".format(x), x % 3) for x in range(10)]
+        self.db.exec(InsertMany("students", STUDENTS_SCHEMA.column_names(), students))
+        self.db.exec(CreateIndex("students", ("age",), IndexKind.BITMAP))
+        self.db.exec(Insert("students", STUDENTS_SCHEMA.column_names(), (10, "s", 2)))
+        self.db.close()
+        self.assertFalse(any(f.endswith(".age.btree") for f in os.listdir(self.folder)))
+        self.db = DiskDatabase.open(self.folder)
+        (index,) = self.db._tables["students"].indexes("age")
+        self.assertEqual(list(index.find_all(2)), [2, 5, 8, 10])
+        results = self.db.exec(
+            Select(
+                STUDENTS_SCHEMA.column_names(),
+                From("students"),
+                Where(Not(BinExpr("=", Symbol("age"), Const(2)))),
+            )
+        )
+        self.assertEqual([s[0] for s in results], [0, 1, 3, 4, 6, 7, 9])
+
+    def test_join_null_key(self):
+        self.db.exec(CreateTable(SIGNUPS))
+        students = [create_test_student(x) for x in range(3)]
+        self.db.exec(InsertMany("students", STUDENTS_SCHEMA.column_names(), students))
+        signups = [(0, 1, 100), (1, None, 101), (2, 2, 102)]
+        self.db.exec(InsertMany("signups", SIGNUPS.column_names(), signups))
+        cond = BinExpr("=", Symbol("signups.sid"), Symbol("students.id"))
+        query = Select(
+            ("signups.timestamp", "students.id"),
+            From(Join(("signups", "students"), On(cond))),
+        )
+        self.assertEqual(list(self.db.exec(query)), [(100, 1), (102, 2)])
+
+    def test_compact(self):
+        students = [create_test_student(x) for x in range(10)]
+        for student in students:
+            self.db.exec(Insert("students", STUDENTS_SCHEMA.column_names(), student))
+        self.assertTrue(self.db.compact("students"))
+        results = self.db.exec(Select(STUDENTS_SCHEMA.column_names(), From("students")))
+        self.assertEqual(sorted(results), students)
+        with self.assertRaises(ValueError):
+            self.db.compact("missing")
+
+
+class MmapDiskDatabaseTestCase(DiskDatabaseTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.initdb(DiskDatabase.open(self.folder, use_mmap=True))
@@ -0,0 +1,143 @@
+from . import context
+from .base import STUDENTS_SCHEMA
+import shutil
+import tempfile
+import unittest
+from pydb.disk import DiskTable
+from pydb import vector
+from pydb.explain import analyze, explain, format_text, instrument
+from pydb.expr import (
+    AggFunc,
+    Aggregation,
+    BinOp,
+    ColumnProjection,
+    FilteredScan,
+    HashAggregate,
+    HashJoin,
+    IndexedJoin,
+    IndexedLookup,
+    IndexRangeScan,
+    Limit,
+    Scan,
+    Sort,
+    ValueComp,
+)
+from pydb.index import IndexKind
+from pydb.mem import MemTable
+from pydb.pipeline import compile_pipeline
+from pydb.query import Param
+from pydb.stats import analyze as analyze_table
+from pydb.table import Column, DataType, IndexDef, Schema
+
+SIGNUPS = Schema("signups", Column("sid", DataType.INT), Column("ts", DataType.INT))
+
+
+class ExplainTestCase(unittest.TestCase):
+    def setUp(self):
+        self.students = MemTable(STUDENTS_SCHEMA)
+        self.students.insert_many(
+            [(x, "s" + str(x % 4), 20 + x % 10) for x in range(200)]
+        )
+        self.ages = self.students.create_index(
+            IndexDef(("age",), kind=IndexKind.SORTED)
+        )
+        self.signups = MemTable(SIGNUPS)
+        self.signups.insert_many([(x % 50, x) for x in range(100)])
+        self.stats = {"students": analyze_table(self.students)}
+
+    def test_explain(self):
+        young = FilteredScan(self.students, ValueComp(BinOp.LT, 2, 22))
+        plan = Limit(Sort(ColumnProjection(young, (1, 0)), (0,), limit=5), 5)
+        tree = explain(plan, self.stats)
+        self.assertEqual(tree["operator"], "Limit")
+        self.assertEqual(tree["details"], {"limit": 5})
+        self.assertEqual(tree["estimated_rows"], 5)
+        sort = tree["children"][0]
+        self.assertEqual(sort["details"], {"columns": "(name)", "limit": 5})
+        projection = sort["children"][0]
+        self.assertEqual(projection["details"], {"columns": "(name, id)"})
+        scan = projection["children"][0]
+        self.assertEqual(scan["details"], {"table": "students", "cond": "age < 22"})
+        self.assertAlmostEqual(scan["estimated_rows"], 40, delta=8)
+        self.assertEqual(scan["estimated_cost"], 200)
+        self.assertGreater(tree["estimated_cost"], scan["estimated_cost"])
+        self.assertNotIn("actual", scan)
+        lines = format_text(tree)
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith("Limit [limit=5]  (cost="))
+        self.assertTrue(lines[3].startswith("      -> FilteredScan [table=students"))
+        # without stats the default selectivity applies
+        self.assertEqual(explain(young, {})["estimated_rows"], 67)
+
+    def test_params(self):
+        index = self.students.indexes("id")[0]
+        lookup = explain(IndexedLookup(self.students, index, Param(0)), self.stats)
+        self.assertEqual(lookup["estimated_rows"], 1)
+        older = IndexRangeScan(self.students, self.ages, low=Param(0))
+        self.assertEqual(explain(older, self.stats)["estimated_rows"], 67)
+        young = FilteredScan(self.students, ValueComp(BinOp.LT, 2, Param(0)))
+        self.assertEqual(explain(young, self.stats)["estimated_rows"], 67)
+
+    def test_analyze(self):
+        range_scan = IndexRangeScan(self.students, self.ages, low=27)
+        join = HashJoin(range_scan, Scan(self.signups), 0, 0)
+        tree = analyze(ColumnProjection(join, (1, 4)), self.stats)
+        self.assertEqual(tree["actual"]["rows"], 30)  # 15 ids < 50, twice each
+        join_node = tree["children"][0]
+        self.assertEqual(join_node["details"], {"col1": "id", "col2": "sid"})
+        actual = join_node["actual"]
+        self.assertEqual(actual["loops"], 1)
+        self.assertEqual(actual["rows"], 30)
+        self.assertEqual(actual["rows_in"], 60 + 100)
+        self.assertLessEqual(actual["self_ms"], actual["time_ms"])
+        scan = join_node["children"][0]["actual"]
+        self.assertEqual((scan["rows"], scan["index_probes"]), (60, 1))
+        self.assertEqual(scan["heap_bytes"], 0)  # in memory
+        self.assertIn("actual rows=30 loops=1", format_text(tree)[0])
+        limited = analyze(Limit(join, 3), self.stats)["actual"]
+        self.assertEqual(limited["rows"], 3)
+
+        index = self.students.indexes("id")[0]
+        indexed = IndexedJoin(Scan(self.signups), 0, index, self.students)
+        actual = analyze(indexed, self.stats)["actual"]
+        self.assertEqual((actual["rows"], actual["index_probes"]), (100, 100))
+
+    def test_analyze_compiled(self):
+        young = FilteredScan(self.students, ValueComp(BinOp.LT, 2, 22))
+        plan = compile_pipeline(ColumnProjection(young, (0,)))
+        tree = analyze(plan, self.stats)
+        self.assertEqual(tree["operator"], "CompiledPipeline")
+        self.assertEqual(tree["actual"]["rows"], 40)
+        projection = tree["children"][0]
+        self.assertEqual(projection["runner"], "CompiledPipeline")
+        self.assertNotIn("actual", projection)
+        self.assertIn("(in CompiledPipeline)", format_text(tree)[1])
+
+    @unittest.skipIf(vector.numpy is None, "numpy is not installed")
+    def test_analyze_arrays(self):
+        young = FilteredScan(self.students, ValueComp(BinOp.LT, 2, 22))
+        projection = ColumnProjection(young, (0, 2))
+        aggregate = HashAggregate(young, (), [Aggregation(AggFunc.SUM, 2)])
+        # their scans aren't wrapped, so they still read column arrays
+        measured = instrument(projection, lambda: 0).expr
+        self.assertIsNotNone(measured.array_batches())
+        measured = instrument(aggregate, lambda: 0).expr
+        self.assertIsNotNone(measured._array_state())
+        tree = analyze(aggregate, self.stats)
+        self.assertEqual(tree["actual"]["rows"], 1)
+        self.assertEqual(tree["children"][0]["runner"], "HashAggregate")
+        self.assertNotIn("runner", explain(aggregate, self.stats)["children"][0])
+        tree = analyze(projection, self.stats)
+        self.assertEqual(tree["actual"]["rows"], 40)
+        self.assertIn("(in ColumnProjection)", format_text(tree)[1])
+
+    def test_heap_bytes(self):
+        folder = tempfile.mkdtemp()
+        try:
+            with DiskTable.open(STUDENTS_SCHEMA, folder) as table:
+                table.insert_many([(x, "s", 20) for x in range(100)])
+                actual = analyze(Scan(table), {})["actual"]
+                self.assertGreater(actual["heap_bytes"], 100)
+                self.assertEqual(actual["heap_bytes"], table.bytes_read())
+        finally:
+            shutil.rmtree(folder)
@@ -1,10 +1,19 @@
 from . import context
+import os
 import unittest
 import random
+import shutil
+import tempfile
+from pydb.buffer import BufferPool
 from pydb.index import (
+    Bitmap,
+    BitmapIndex,
+    BTreeIndex,
     Index,
     SortedIndex,
     HashIndex,
+    MultiHashIndex,
+    MultiSortedIndex,
     SortedListIndex,
 )
 
@@ -13,11 +22,249 @@ def test_hash_index():
     check_index_ops(HashIndex())
 
 
+def test_hash_index_insert_many():
+    index = HashIndex()
+    index.insert_many([(1, "a"), (2, "b")])
+    for items in ([(3, "c"), (3, "d")], [(4, "d"), (1, "e")]):
+        try:
+            index.insert_many(items)
+            assert False, "expected duplicate key"
+        except ValueError:
+            pass
+    assert [index.find(key) for key in range(5)] == [None, "a", "b", None, None]
+
+
 def test_sorted_index():
     check_index_ops(SortedListIndex())
     check_sorted_index_ops(SortedListIndex())
 
 
+def test_multi_hash_index():
+    index = MultiHashIndex.from_items([(1, "a"), (2, "b"), (1, "c"), (None, "d")])
+    check_multi_index_ops(index)
+
+
+def test_multi_sorted_index():
+    index = MultiSortedIndex.from_sorted([(1, "a"), (1, "c"), (2, "b")])
+    check_multi_index_ops(index)
+    index.insert_many([(0, "x"), (3, "y"), (None, "z")])
+    assert list(index.items(1)) == [(1, "a"), (1, "e"), (3, "y")]
+    assert list(index.ritems(1)) == [(1, "e"), (1, "a"), (0, "x")]
+    assert list(index.rscan()) == ["y", "e", "a", "x"]
+
+
+def check_multi_index_ops(index: Index):
+    """index must start with 1 -> a, c and 2 -> b"""
+    assert not index.unique
+    assert len(index) == 3
+    assert sorted(index.find_all(1)) == ["a", "c"]
+    assert list(index.find_all(3)) == []
+    assert list(index.find_all(None)) == []
+    assert index.find(2) == "b"
+    index.insert(1, "e")
+    index.insert(None, "f")
+    assert index.update(1, "e") == "e"
+    assert len(index) == 4
+    assert index.remove(1, "x") is None
+    assert index.remove(1, "c") == "c"
+    assert sorted(index.find_all(1)) == ["a", "e"]
+    assert index.remove(2) == "b"
+    assert index.find(2) is None
+
+
+def test_sorted_list_index_remove_value():
+    index = SmallSortedListIndex()
+    for val in range(10):
+        index.insert(1, val)
+    index.insert(0, 0)
+    index.insert(2, 0)
+    assert index.remove(1, 10) is None
+    assert index.remove(1, 7) == 7
+    assert index.remove(0, 1) is None
+    assert list(index.scan(1)) == [9, 8, 6, 5, 4, 3, 2, 1, 0, 0]
+
+
+class SmallSortedListIndex(SortedListIndex):
+    CHUNK_SIZE = 4  # many chunks even for small tests
+
+
+def check_sorted_items(index: SortedIndex, items: dict):
+    keys = sorted(items)
+    assert list(index.scan()) == [items[key] for key in keys]
+    assert list(index.rscan()) == [items[key] for key in reversed(keys)]
+    for key in range(-1, 402):
+        assert index.find(key) == items.get(key, None)
+        assert list(index.scan(key)) == [items[k] for k in keys if k >= key]
+        before = [items[k] for k in reversed(keys) if k <= key]
+        assert list(index.rscan(key)) == before
+        assert list(index.items(key)) == [(k, items[k]) for k in keys if k >= key]
+        before = [(k, items[k]) for k in reversed(keys) if k <= key]
+        assert list(index.ritems(key)) == before
+    assert list(index.items()) == [(key, items[key]) for key in keys]
+    assert list(index.ritems()) == [(key, items[key]) for key in reversed(keys)]
+
+
+def test_sorted_list_index_chunks():
+    index = SmallSortedListIndex()
+    items = {key: str(key) for key in range(0, 400, 2)}
+    shuffled = list(items)
+    random.shuffle(shuffled)
+    for key in shuffled:
+        index.insert(key, items[key])
+    check_sorted_items(index, items)
+    for key in shuffled[:150]:
+        assert index.remove(key) == items.pop(key)
+    assert index.remove(shuffled[0]) is None
+    assert len(index) == len(items)
+    check_sorted_items(index, items)
+    for key in shuffled[:150]:
+        index.insert(key, items.setdefault(key, str(key)))
+    check_sorted_items(index, items)
+
+
+def test_sorted_list_index_from_sorted():
+    items = {key: str(key) for key in range(1, 400, 3)}
+    index = SmallSortedListIndex.from_sorted(sorted(items.items()))
+    check_sorted_items(index, items)
+    index.insert(0, "0")
+    items[0] = "0"
+    check_sorted_items(index, items)
+    try:
+        SortedListIndex.from_sorted([(2, "a"), (1, "b")])
+        assert False, "expected unsorted key"
+    except ValueError:
+        pass
+    check_sorted_items(SortedListIndex.from_sorted([]), {})
+
+
+def test_sorted_list_index_duplicates():
+    index = SmallSortedListIndex()
+    for val in range(20):
+        index.insert(val % 2, val)
+    assert sorted(index.scan(1)) == list(range(1, 20, 2))
+    assert sorted(index.rscan(0)) == list(range(0, 20, 2))
+    assert index.remove(0) in range(0, 20, 2)
+    assert len(index) == 19
+
+
+class SmallBTreeIndex(BTreeIndex):
+    PAGE_SIZE = 256  # a few keys per node, so small trees are deep
+    CAPACITY = PAGE_SIZE - BTreeIndex.NODE.size - 64
+    MAX_KEY_SIZE = CAPACITY // 4
+
+
+class BTreeIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "test.btree")
+        self.pool = BufferPool(8)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def open(self):
+        return SmallBTreeIndex.open(self.path, self.pool)
+
+    def check(self, index, items):
+        keys = sorted(items)
+        self.assertEqual(len(index), len(keys))
+        self.assertEqual(list(index.scan()), [items[key] for key in keys])
+        self.assertEqual(list(index.rscan()), [items[key] for key in reversed(keys)])
+        for key in range(-1, 1002, 7):
+            self.assertEqual(index.find(key), items.get(key, None))
+            after = [items[k] for k in keys if k >= key]
+            self.assertEqual(list(index.scan(key)), after)
+            before = [items[k] for k in reversed(keys) if k <= key]
+            self.assertEqual(list(index.rscan(key)), before)
+            after = [(k, items[k]) for k in keys if k >= key]
+            self.assertEqual(list(index.items(key)), after)
+            before = [(k, items[k]) for k in reversed(keys) if k <= key]
+            self.assertEqual(list(index.ritems(key)), before)
+
+    def test_ops(self):
+        with self.open() as index:
+            self.assertTrue(index.stale)
+            check_index_ops(index)
+            check_sorted_index_ops(index)
+
+    def test_random_ops(self):
+        items = {}
+        keys = list(range(1000))
+        random.shuffle(keys)
+        with self.open() as index:
+            for key in keys:
+                index.insert(key, key * 10)
+                items[key] = key * 10
+            with self.assertRaises(ValueError):
+                index.insert(keys[0], 0)
+            for key in keys[:500]:
+                self.assertEqual(index.remove(key), items.pop(key))
+            self.assertEqual(index.remove(keys[0]), None)
+            for key in keys[:100]:
+                self.assertEqual(index.update(key, -key), items.get(key, None))
+                items[key] = -key
+            self.check(index, items)
+        with self.open() as index:
+            self.assertFalse(index.stale)
+            self.check(index, items)
+
+    def test_load(self):
+        items = {key: str(key) for key in range(0, 6000, 3)}  # > 256 leaves
+        with self.open() as index:
+            index.insert(5, "x")
+            index.load(sorted(items.items()))
+            self.check(index, items)
+            index.insert(1, "1")
+            items[1] = "1"
+            self.check(index, items)
+        with self.open() as index:
+            self.check(index, items)
+            with self.assertRaises(ValueError):
+                index.load([(2, "a"), (1, "b")])
+            self.check(index, {})
+
+    def test_insert_many(self):
+        with self.open() as index:
+            index.insert_many([(1, "a"), (2, "b")])
+            for items in ([(3, "c"), (3, "d")], [(4, "d"), (1, "e")]):
+                with self.assertRaises(ValueError):
+                    index.insert_many(items)
+            found = [index.find(key) for key in range(5)]
+            self.assertEqual(found, [None, "a", "b", None, None])
+            items = {key: str(key) for key in range(3, 1000, 2)}
+            shuffled = list(items.items())
+            random.shuffle(shuffled)
+            index.insert_many(shuffled)
+            items.update({1: "a", 2: "b"})
+            self.check(index, items)
+
+    def test_unclean(self):
+        index = self.open()
+        index.insert(1, "a")
+        index.close()
+        index = self.open()
+        index.insert(2, "b")
+        index.close(flush=False)  # crash
+        with self.open() as index:
+            self.assertTrue(index.stale)
+            self.assertEqual(len(index), 0)
+
+    def test_key_too_large(self):
+        with self.open() as index:
+            with self.assertRaises(ValueError):
+                index.insert("x" * SmallBTreeIndex.MAX_KEY_SIZE, 1)
+
+    def test_multi(self):
+        with self.open() as tree:
+            index = MultiSortedIndex(tree)
+            index.load([(1, "a"), (1, "c"), (2, "b")])
+            check_multi_index_ops(index)
+            index.insert_many([(key % 7, "v{:03}".format(key)) for key in range(200)])
+            found = ["v{:03}".format(key) for key in range(3, 200, 7)]
+            self.assertEqual(list(index.find_all(3)), found)
+            self.assertEqual(len(tree), 202)
+
+
 def check_index_ops(index: Index):
     assert index.find("foo") == None
     index.insert("foo", "bar")
@@ -54,3 +301,42 @@ def check_sorted_index_ops(index: SortedIndex):
     check()
     remove(8, 5, 1)
     check()
+
+
+def test_bitmap():
+    vals = [0, 3, 65535, 65536, 200000]
+    bitmap = Bitmap.from_iterable(reversed(vals))
+    assert list(bitmap) == vals
+    assert len(bitmap) == 5 and 65536 in bitmap and 4 not in bitmap
+    other = Bitmap.from_iterable([3, 4, 200000])
+    assert list(bitmap & other) == [3, 200000]
+    assert list(bitmap | other) == [0, 3, 4, 65535, 65536, 200000]
+    assert list(bitmap - other) == [0, 65535, 65536]
+    assert not (bitmap - bitmap)
+    copy = bitmap.copy()
+    copy.discard(65536)
+    copy.add(7)
+    assert list(copy) == [0, 3, 7, 65535, 200000]
+    assert list(bitmap) == vals
+    assert Bitmap.from_iterable([1, 2]) == Bitmap.from_iterable([2, 1])
+
+
+def test_bitmap_index():
+    index = BitmapIndex.from_items([(1, 0), (2, 1), (1, 2), (None, 4)])
+    assert not index.unique
+    assert len(index) == 4
+    assert list(index.find_all(1)) == [0, 2]
+    assert list(index.find_all(None)) == [4]
+    assert list(index.find_all(3)) == []
+    assert index.find(2) == 1
+    index.insert(1, 5)
+    assert index.update(1, 5) == 5
+    assert list(index.bitmap(1)) == [0, 2, 5]
+    assert list(index.bitmap(3)) == []
+    assert list(index.all()) == [0, 1, 2, 4, 5]
+    assert index.remove(1, 7) is None
+    assert index.remove(1, 2) == 2
+    assert list(index.find_all(1)) == [0, 5]
+    assert index.remove(2) == 1
+    assert index.find(2) is None
+    assert list(index.all()) == [0, 4, 5]
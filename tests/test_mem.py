@@ -32,3 +32,18 @@ class MemTableTestCase(unittest.TestCase):
 class MemDatabaseTestCase(DatabaseTestCase, unittest.TestCase):
     def setUp(self):
         self.initdb(MemDatabase("test"))
+
+    def test_insert_many_duplicate_key(self):
+        schema = Schema(
+            "students",
+            Column("id", DataType.INT, ColumnAttr.PRIMARY_KEY),
+            Column("name", DataType.STRING, ColumnAttr.UNIQUE),
+        )
+        table = MemTable(schema)
+        table.insert((0, "a"))
+        self.assertEqual(table.insert_many([(1, "b"), (2, "c")]), range(1, 3))
+        for rows in ([(3, "d"), (3, "e")], [(4, "e"), (5, "a")]):
+            with self.assertRaises(ValueError):
+                table.insert_many(rows)
+        self.assertEqual(list(table.rows()), [(0, "a"), (1, "b"), (2, "c")])
+        self.assertEqual(table.insert_many([(3, "d")]), range(3, 4))
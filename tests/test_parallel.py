@@ -0,0 +1,120 @@
+from . import context
+from .base import STUDENTS_SCHEMA
+import shutil
+import tempfile
+import unittest
+from pydb.disk import DiskDatabase, DiskTable
+from pydb.expr import (
+    AggFunc,
+    Aggregation,
+    BinOp,
+    ColumnProjection,
+    FinalAggregate,
+    FilteredScan,
+    HashAggregate,
+    Scan,
+    ValueComp,
+)
+from pydb.mem import MemTable
+from pydb.parallel import ParallelScan
+from pydb.plan import SimplePlanner
+from pydb.query import (
+    Aggregate,
+    BinExpr,
+    Const,
+    CreateTable,
+    From,
+    InsertMany,
+    OrderBy,
+    Select,
+    Symbol,
+    Where,
+)
+
+
+class ParallelScanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.table = DiskTable.open(STUDENTS_SCHEMA, self.folder)
+        self.rows = [(x, "s" + str(x % 5), 20 + x % 9) for x in range(3000)]
+        self.table.insert_many(self.rows)
+        for rowid in range(0, 3000, 7):
+            self.table.delete(rowid)
+
+    def tearDown(self):
+        self.table.close()
+        shutil.rmtree(self.folder)
+
+    def test_partitions(self):
+        parts = self.table.partitions(8)
+        self.assertEqual(len(parts), 8)
+        rows = [row for part in parts for row in part.rows()]
+        self.assertEqual(rows, list(self.table.rows()))
+        self.assertEqual(len(rows), self.table.count())
+        pages = self.table._file.num_pages() - 1
+        self.assertEqual(len(self.table.partitions(10**6)), pages)
+        self.assertEqual(parts[0].indexes(), ())
+        with self.assertRaises(ValueError):
+            parts[0].insert(self.rows[0])
+        with self.assertRaises(ValueError):
+            parts[0].get(1)
+
+    def test_parallel_scan(self):
+        young = FilteredScan(self.table, ValueComp(BinOp.LT, 2, 23))
+        aggs = [Aggregation(AggFunc.COUNT), Aggregation(AggFunc.AVG, 0)]
+        grouped = HashAggregate(young, (1,), aggs)
+        cases = [
+            (young, ParallelScan(young, 3)),
+            (
+                ColumnProjection(young, (1, 0)),
+                ParallelScan(ColumnProjection(young, (1, 0)), 3),
+            ),
+            (
+                grouped,
+                FinalAggregate(
+                    ParallelScan(HashAggregate(young, (1,), aggs, True), 3), 1, aggs
+                ),
+            ),
+        ]
+        for serial, parallel in cases:
+            self.assertEqual(sorted(parallel.exec()), sorted(serial.exec()))
+        self.assertEqual(list(cases[0][1].exec()), list(young.exec()))
+        mem = MemTable(STUDENTS_SCHEMA)
+        mem.insert_many(self.rows)
+        self.assertEqual(list(ParallelScan(Scan(mem), 3).exec()), self.rows)
+
+    def test_plan_parallel(self):
+        planner = SimplePlanner({"students": self.table}, parallelism=4)
+        query = Select(
+            ("name", Aggregate("SUM", "age")),
+            From("students"),
+            Where(BinExpr(">", Symbol("age"), Const(21))),
+            OrderBy(("name",)),
+            ("name",),
+        )
+        plan = planner.plan(query)
+        self.assertIsInstance(plan.expr, FinalAggregate)
+        serial = SimplePlanner({"students": self.table}).plan(query)
+        self.assertEqual(list(plan.exec()), list(serial.exec()))
+        with self.assertRaises(ValueError):
+            SimplePlanner({}, parallelism=0)
+
+
+class ParallelDatabaseTestCase(unittest.TestCase):
+    def test_exec_parallelism(self):
+        folder = tempfile.mkdtemp()
+        try:
+            with DiskDatabase.open(folder) as db:
+                db.exec(CreateTable(STUDENTS_SCHEMA))
+                rows = [(x, "s" + str(x % 3), x % 50) for x in range(5000)]
+                db.exec(InsertMany("students", STUDENTS_SCHEMA.column_names(), rows))
+                query = Select(
+                    (Aggregate("COUNT"), Aggregate("MAX", "age")),
+                    From("students"),
+                    Where(BinExpr("<", Symbol("age"), Const(10))),
+                )
+                expected = list(db.exec(query))
+                self.assertEqual(expected, [(1000, 9)])
+                self.assertEqual(list(db.exec(query, parallelism=4)), expected)
+        finally:
+            shutil.rmtree(folder)
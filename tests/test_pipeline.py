@@ -0,0 +1,109 @@
+from . import context
+from .base import STUDENTS_SCHEMA
+import unittest
+from pydb import vector
+from pydb.expr import (
+    BinOp,
+    ColumnComp,
+    ColumnProjection,
+    Conjunction,
+    Disjunction,
+    Filter,
+    FilteredScan,
+    HashJoin,
+    IndexedLookup,
+    Negation,
+    Scan,
+    ValueComp,
+)
+from pydb.mem import MemTable
+from pydb.pipeline import CompiledPipeline, compile_pipeline
+from pydb.table import Column, DataType, Schema
+
+SIGNUPS = Schema("signups", Column("sid", DataType.INT), Column("ts", DataType.INT))
+
+
+class CompilePipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.students = MemTable(STUDENTS_SCHEMA)
+        self.students.insert_many(
+            [(x, "s" + str(x % 3), 20 + x % 5) for x in range(40)]
+        )
+        self.signups = MemTable(SIGNUPS)
+        self.signups.insert_many([(x % 9, x) for x in range(30)])
+        vector.ENABLED = False  # or the array path runs instead of the pipeline
+
+    def tearDown(self):
+        vector.ENABLED = vector.numpy is not None
+
+    def check(self, plan):
+        compiled = compile_pipeline(plan)
+        self.assertIsInstance(compiled, CompiledPipeline)
+        rows = list(plan.exec())
+        self.assertTrue(rows)
+        self.assertEqual(list(compiled.exec()), rows)
+        for size in (1, 4):
+            batches = list(compiled.exec_batches(size))
+            self.assertTrue(all(0 < len(batch) <= size for batch in batches))
+        return compiled
+
+    def test_filter_project(self):
+        young = ValueComp(BinOp.LT, 2, 23)
+        conds = [
+            young,
+            ValueComp(BinOp.EQ, 1, "s1"),
+            Conjunction([young, Negation(ValueComp(BinOp.GE, 0, 30))]),
+            Disjunction([ValueComp(BinOp.LE, 0, 3), ColumnComp(BinOp.GT, 0, 2)]),
+            Conjunction([]),
+        ]
+        for cond in conds:
+            self.check(FilteredScan(self.students, cond))
+            self.check(ColumnProjection(FilteredScan(self.students, cond), (1, 0)))
+            self.check(Filter(FilteredScan(self.students, conds[0]), cond))
+        self.check(ColumnProjection(Scan(self.students), (2,)))
+
+    def test_hash_join(self):
+        join = HashJoin(
+            FilteredScan(self.signups, ValueComp(BinOp.GT, 1, 3)),
+            Scan(self.students),
+            0,
+            0,
+        )
+        self.check(join)
+        self.check(ColumnProjection(join, (1, 2, 4)))
+        self.check(Filter(join, ColumnComp(BinOp.LT, 0, 4)))
+        nested = HashJoin(join, Scan(self.signups), 2, 0)
+        compiled = self.check(nested)
+        self.assertIsInstance(compiled.build, CompiledPipeline)
+        right = HashJoin(Scan(self.students), Scan(self.signups), 0, 0, True)
+        self.check(ColumnProjection(right, (4, 1)))
+        # builds that don't fit fall back to the partitioned join
+        self.check(HashJoin(join, Scan(self.students), 2, 0, False, 1))
+        self.check(HashJoin(Scan(self.students), join, 0, 2, True, 1))
+
+    def test_shape_cache(self):
+        def plan(age, name):
+            cond = Conjunction(
+                [ValueComp(BinOp.GT, 2, age), ValueComp(BinOp.EQ, 1, name)]
+            )
+            return compile_pipeline(FilteredScan(self.students, cond))
+
+        plan1, plan2 = plan(21, "s1"), plan(22, "s2")
+        self.assertIs(plan1.fn, plan2.fn)
+        self.assertEqual(plan2.args, (22, "s2"))
+        self.assertNotEqual(list(plan1.exec()), list(plan2.exec()))
+
+    def test_unsupported(self):
+        index = self.students.indexes("id")[0]
+        for plan in (Scan(self.students), IndexedLookup(self.students, index, 3)):
+            self.assertIs(compile_pipeline(plan), plan)
+        lookup = ColumnProjection(IndexedLookup(self.students, index, 3), (0,))
+        self.assertIs(compile_pipeline(lookup), lookup)
+
+    @unittest.skipIf(vector.numpy is None, "numpy is not installed")
+    def test_array_path(self):
+        vector.ENABLED = True
+        plan = FilteredScan(self.students, ValueComp(BinOp.LT, 2, 23))
+        compiled = compile_pipeline(plan)
+        self.assertIsNotNone(plan.array_batches())
+        self.assertEqual(list(compiled.exec()), list(plan.exec()))
@@ -1,30 +1,59 @@
 from . import context
 import unittest
 from pydb.expr import (
+    AggFunc,
+    Aggregation,
+    FinalAggregate,
+    HashAggregate,
+    StreamAggregate,
+    TableCount,
+    BitmapAnd,
+    BitmapLookup,
+    BitmapNot,
+    BitmapOr,
+    BitmapScan,
+    Disjunction,
+    Negation,
     ColumnProjection,
+    Conjunction,
     HashJoin,
     IndexedJoin,
     IndexedLookup,
+    IndexOnlyLookup,
+    IndexRangeScan,
+    JOIN_MEMORY,
+    Limit,
+    MergeJoin,
     Scan,
+    Sort,
+    SORT_MEMORY,
     BinOp,
+    Filter,
     FilteredScan,
     ValueComp,
     ColumnComp,
+    sort_key,
+    unbatched,
 )
+from pydb.index import IndexKind
 from pydb.mem import MemTable
-from pydb.plan import SimplePlanner
+from pydb.plan import CostBasedPlanner, SimplePlanner
 from pydb.query import (
+    Aggregate,
     BinExpr,
     Const,
     From,
     Join,
     JoinKind,
+    Not,
     On,
+    OrderBy,
     Select,
     Symbol,
     Where,
 )
-from pydb.table import Column, ColumnAttr, DataType, Schema
+from pydb.stats import analyze
+from pydb.table import Column, ColumnAttr, DataType, IndexDef, Schema
 
 students = Schema(
     "students",
@@ -78,6 +107,149 @@ class SimplePlannerTestCase(unittest.TestCase):
         expected = IndexedLookup(self.table, index, 42)
         self.assertEqual(plan, expected)
 
+    def test_index_range_scan(self):
+        index = self.table.create_index(IndexDef(("age",), kind=IndexKind.SORTED))
+        age = Symbol("age")
+        cases = [
+            (BinExpr(">", age, Const(20)), dict(low=20, low_inclusive=False)),
+            (BinExpr(">=", age, Const(20)), dict(low=20)),
+            (BinExpr("<", age, Const(20)), dict(high=20, high_inclusive=False)),
+            (BinExpr("<=", Const(20), age), dict(low=20)),
+            (BinExpr(">", Const(20), age), dict(high=20, high_inclusive=False)),
+        ]
+        for cond, bounds in cases:
+            query = Select(students.column_names(), From("students"), Where(cond))
+            plan = self.planner.plan(query)
+            self.assertEqual(plan, IndexRangeScan(self.table, index, **bounds))
+
+        between = BinExpr(
+            "AND", BinExpr(">", age, Const(10)), BinExpr(">=", Const(20), age)
+        )
+        query = Select(students.column_names(), From("students"), Where(between))
+        expected = IndexRangeScan(self.table, index, 10, 20, low_inclusive=False)
+        self.assertEqual(self.planner.plan(query), expected)
+
+        name = BinExpr("=", Symbol("name"), Const("x"))
+        cond = BinExpr("AND", BinExpr("<", age, Const(20)), name)
+        query = Select(students.column_names(), From("students"), Where(cond))
+        expected = Filter(
+            IndexRangeScan(self.table, index, high=20, high_inclusive=False),
+            ValueComp(BinOp.EQ, students.columnid("name"), "x"),
+        )
+        self.assertEqual(self.planner.plan(query), expected)
+
+    def test_index_range_scan_exec(self):
+        index = self.table.create_index(IndexDef(("age",), kind=IndexKind.SORTED))
+        for sid, age in enumerate((12, 10, 14, 10, 13, 11)):
+            self.table.insert((sid, "s", age))
+
+        def ages(**bounds):
+            scan = IndexRangeScan(self.table, index, **bounds)
+            return [row[2] for row in scan.exec()]
+
+        self.assertEqual(ages(), [10, 10, 11, 12, 13, 14])
+        self.assertEqual(ages(low=11, high=13), [11, 12, 13])
+        self.assertEqual(ages(low=10, low_inclusive=False), [11, 12, 13, 14])
+        self.assertEqual(ages(high=12, high_inclusive=False), [10, 10, 11])
+        self.assertEqual(ages(low=11, high=13, reverse=True), [13, 12, 11])
+        exclusive = dict(low_inclusive=False, high_inclusive=False)
+        self.assertEqual(ages(low=10, high=14, reverse=True, **exclusive), [13, 12, 11])
+        self.assertEqual(ages(low=15), [])
+
+    def test_composite_index(self):
+        index = self.table.create_index(
+            IndexDef(("age", "name"), kind=IndexKind.SORTED)
+        )
+        age = BinExpr("=", Symbol("age"), Const(20))
+        name = BinExpr("=", Const("x"), Symbol("name"))
+        cases = [
+            (age, IndexedLookup(self.table, index, (20,), prefix=True)),
+            (BinExpr("AND", name, age), IndexedLookup(self.table, index, (20, "x"))),
+            (name, FilteredScan(self.table, ValueComp(BinOp.EQ, 1, "x"))),
+        ]
+        for cond, expected in cases:
+            query = Select(students.column_names(), From("students"), Where(cond))
+            self.assertEqual(self.planner.plan(query), expected)
+
+        self.table.insert_many([(0, "x", 20), (1, "y", 20), (2, "x", 21), (3, "x", 20)])
+        query = Select(students.column_names(), From("students"), Where(age))
+        rows = [(0, "x", 20), (3, "x", 20), (1, "y", 20)]
+        self.assertEqual(list(self.planner.plan(query).exec()), rows)
+        query = Select(("name",), From("students"), Where(age))
+        self.assertEqual(
+            self.planner.plan(query),
+            IndexOnlyLookup(index, (20,), (1,), composite=True, prefix=True),
+        )
+        rows = [("x",), ("x",), ("y",)]
+        self.assertEqual(list(self.planner.plan(query).exec()), rows)
+
+    def test_hash_composite_index(self):
+        index = self.table.create_index(IndexDef(("age", "name")))
+        age = BinExpr("=", Symbol("age"), Const(20))
+        query = Select(students.column_names(), From("students"), Where(age))
+        self.assertIsInstance(self.planner.plan(query), FilteredScan)
+        name = BinExpr("=", Symbol("name"), Const("x"))
+        cond = BinExpr("AND", age, name)
+        query = Select(students.column_names(), From("students"), Where(cond))
+        self.assertEqual(
+            self.planner.plan(query), IndexedLookup(self.table, index, (20, "x"))
+        )
+
+    def test_covering_index(self):
+        index = self.table.create_index(IndexDef(("age",), include=("name",)))
+        self.table.insert_many([(0, "x", 20), (1, "y", 21), (2, "z", 20)])
+        age = BinExpr("=", Symbol("age"), Const(20))
+        query = Select(("name", "age"), From("students"), Where(age))
+        plan = self.planner.plan(query)
+        self.assertEqual(plan, IndexOnlyLookup(index, 20, (1, 0), covering=True))
+        self.assertEqual(list(plan.exec()), [("x", 20), ("z", 20)])
+        query = Select(students.column_names(), From("students"), Where(age))
+        plan = self.planner.plan(query)
+        self.assertEqual(plan, IndexedLookup(self.table, index, 20, covering=True))
+        self.assertEqual(list(plan.exec()), [(0, "x", 20), (2, "z", 20)])
+
+    def test_bitmap_scan(self):
+        ages = self.table.create_index(IndexDef(("age",), kind=IndexKind.BITMAP))
+        names = self.table.create_index(IndexDef(("name",), kind=IndexKind.BITMAP))
+        age = BinExpr("=", Symbol("age"), Const(20))
+        name = BinExpr("=", Const("x"), Symbol("name"))
+        young = BinExpr("<", Symbol("age"), Const(20))
+        cond = BinExpr("AND", BinExpr("OR", age, name), Not(name))
+        query = Select(students.column_names(), From("students"), Where(cond))
+        plan = self.planner.plan(query)
+        bitmap = BitmapAnd(
+            [
+                BitmapOr([BitmapLookup(ages, 20), BitmapLookup(names, "x")]),
+                BitmapNot(ages, BitmapLookup(names, "x")),
+            ]
+        )
+        self.assertEqual(plan, BitmapScan(self.table, bitmap))
+
+        cond = BinExpr("AND", age, BinExpr("OR", name, young))
+        query = Select(students.column_names(), From("students"), Where(cond))
+        plan = self.planner.plan(query)
+        residual = Disjunction(
+            [ValueComp(BinOp.EQ, 1, "x"), ValueComp(BinOp.LT, 2, 20)]
+        )
+        expected = Filter(BitmapScan(self.table, BitmapLookup(ages, 20)), residual)
+        self.assertEqual(plan, expected)
+
+        rows = [(0, "x", 20), (1, "y", 21), (2, "x", 22), (3, "y", 20), (4, None, 20)]
+        self.table.insert_many(rows)
+        self.assertEqual(list(plan.exec()), [(0, "x", 20)])
+        cond = BinExpr("AND", age, Not(name))
+        query = Select(students.column_names(), From("students"), Where(cond))
+        self.assertEqual(list(self.planner.plan(query).exec()), rows[3:])
+        cond = Not(BinExpr("OR", name, young))
+        query = Select(students.column_names(), From("students"), Where(cond))
+        self.assertEqual(list(self.planner.plan(query).exec()), rows[1::2] + rows[4:])
+
+    def test_negation_filter(self):
+        cond = Not(BinExpr("=", Symbol("age"), Const(20)))
+        query = Select(students.column_names(), From("students"), Where(cond))
+        expected = FilteredScan(self.table, Negation(ValueComp(BinOp.EQ, 2, 20)))
+        self.assertEqual(self.planner.plan(query), expected)
+
     @unittest.skip
     def test_natural_join(self):
         raise NotImplementedError()
@@ -143,6 +315,329 @@ class SimplePlannerTestCase(unittest.TestCase):
         plan = planner.plan(query)
         self.assertEqual(plan, expected)
 
+    def test_bitmap_join_index(self):
+        table2 = MemTable(Schema("signups", Column("sid", DataType.INT)))
+        table2.create_index(IndexDef(("sid",), kind=IndexKind.BITMAP))
+        cond = BinExpr("=", Symbol("students.id"), Symbol("signups.sid"))
+        query = Select(
+            ("students.name", "signups.sid"),
+            From(Join(("students", "signups"), On(cond), JoinKind.INNER)),
+        )
+        planner = SimplePlanner({"students": self.table, "signups": table2})
+        self.assertIsInstance(planner.plan(query).expr, HashJoin)
+
+    def test_merge_join(self):
+        table2 = MemTable(
+            Schema("signups", Column("sid", DataType.INT), Column("ts", DataType.INT))
+        )
+        self.table.insert_many(
+            [(0, "a", 20), (1, "b", None), (2, "c", 22), (3, "d", 20), (4, "e", 23)]
+        )
+        table2.insert_many([(x % 5 + 19 if x % 4 else None, x) for x in range(12)])
+        join = MergeJoin(Sort(Scan(self.table), (2,)), Sort(Scan(table2), (0,)), 2, 0)
+        hashed = HashJoin(Scan(self.table), Scan(table2), 2, 0)
+        expected = [row for row in hashed.exec() if row[2] is not None]
+        self.assertEqual(sorted(join.exec()), sorted(expected))
+        self.assertEqual(len(list(join.exec())), 8)
+        empty = MergeJoin(Scan(self.table), Scan(MemTable(table2.schema())), 2, 0)
+        self.assertEqual(list(empty.exec()), [])
+
+    def test_grace_hash_join(self):
+        table2 = MemTable(
+            Schema("signups", Column("sid", DataType.INT), Column("ts", DataType.INT))
+        )
+        self.table.insert_many(
+            [(x, "s" + str(x), None if x % 11 == 0 else x % 40) for x in range(400)]
+        )
+        table2.insert_many([(None if x % 7 == 0 else x % 50, x) for x in range(300)])
+        expected = sorted(
+            (*row1, *row2)
+            for row1 in self.table.rows()
+            for row2 in table2.rows()
+            if row1[2] is not None and row1[2] == row2[0]
+        )
+        for build_right in (False, True):
+            for memory in (JOIN_MEMORY, 2000, 1):
+                join = HashJoin(
+                    Scan(self.table), Scan(table2), 2, 0, build_right, memory
+                )
+                self.assertEqual(sorted(join.exec()), expected)
+        # the smaller table is built on, whichever side it is
+        planner = SimplePlanner({"students": self.table, "signups": table2})
+        age, sid = Symbol("students.age"), Symbol("signups.sid")
+        for cond, build_right in [((age, sid), True), ((sid, age), False)]:
+            join = Join(("students", "signups"), On(BinExpr("=", *cond)))
+            plan = planner.plan(Select(("signups.ts",), From(join)))
+            self.assertEqual(plan.expr.build_right, build_right)
+
+    def test_sort(self):
+        self.table.insert_many([(0, "b", 20), (1, "a", None), (2, "a", 9), (3, "b", 1)])
+        sort = Sort(Scan(self.table), (1, 2))
+        self.assertEqual([row[0] for row in sort.exec()], [1, 2, 3, 0])
+        sort = Sort(Scan(self.table), (2,), reverse=True)
+        self.assertEqual([row[0] for row in sort.exec()], [0, 2, 3, 1])
+
+    def test_external_sort(self):
+        rows = [(x, "s" + str(x % 7), (x * 37) % 101) for x in range(300)]
+        rows.append((300, None, None))
+        self.table.insert_many(rows)
+        for columns, reverse in [((2,), False), ((1, 0), True), ((1,), False)]:
+            key = sort_key(columns)
+            expected = sorted(rows, key=key, reverse=reverse)
+            for memory in (SORT_MEMORY, 2000, 1):
+                sort = Sort(Scan(self.table), columns, reverse, memory=memory)
+                self.assertEqual(list(sort.exec()), expected)
+            sort = Sort(Scan(self.table), columns, reverse, limit=10)
+            self.assertEqual(list(sort.exec()), expected[:10])
+
+    def test_order_by(self):
+        index = self.table.create_index(IndexDef(("age",), kind=IndexKind.SORTED))
+        self.table.insert_many([(0, "b", 21), (1, "a", None), (2, "c", 20)])
+        old = Where(BinExpr(">", Symbol("age"), Const(10)))
+        by_age = IndexRangeScan(
+            self.table, index, 10, low_inclusive=False, reverse=True
+        )
+        by_name = Sort(Scan(self.table), (1,), True)
+        cases = [
+            (None, OrderBy(("age",)), Sort(Scan(self.table), (2,)), [1, 2, 0]),
+            (None, OrderBy(("name",), True), by_name, [2, 0, 1]),
+            (old, OrderBy(("age",), True), by_age, [0, 2]),
+        ]
+        for where, order_by, expected, ids in cases:
+            query = Select(("id",), From("students"), where, order_by)
+            plan = self.planner.plan(query)
+            self.assertEqual(plan, ColumnProjection(expected, (0,)))
+            self.assertEqual([row[0] for row in plan.exec()], ids)
+        with self.assertRaises(ValueError):
+            self.planner.plan(Select(("id",), From("students"), None, OrderBy(("x",))))
+
+    def test_aggregate(self):
+        self.table.insert_many(
+            [(x, "s{}".format(x % 3), None if x % 6 else x) for x in range(30)]
+        )
+        aggs = [
+            Aggregation(AggFunc.COUNT),
+            Aggregation(AggFunc.COUNT, 2),
+            Aggregation(AggFunc.SUM, 2),
+            Aggregation(AggFunc.MIN, 0),
+            Aggregation(AggFunc.MAX, 2),
+            Aggregation(AggFunc.AVG, 2),
+        ]
+        expected = {
+            ("s0",): ("s0", 10, 5, 60, 0, 24, 12.0),
+            ("s1",): ("s1", 10, 0, None, 1, None, None),
+            ("s2",): ("s2", 10, 0, None, 2, None, None),
+        }
+        by_name = HashAggregate(Scan(self.table), (1,), aggs)
+        self.assertEqual(sorted(by_name.exec()), sorted(expected.values()))
+        ordered = Sort(Scan(self.table), (1,))
+        streamed = StreamAggregate(ordered, (1,), aggs)
+        self.assertEqual(list(streamed.exec()), sorted(expected.values()))
+        partial = HashAggregate(Scan(self.table), (1,), aggs, partial=True)
+        final = FinalAggregate(partial, 1, aggs)
+        self.assertEqual(sorted(final.exec()), sorted(expected.values()))
+        # one group for everything, even for no rows
+        total = (30, 5, 60, 0, 24, 12.0)
+        none = (0, 0, None, None, None, None)
+        empty = FilteredScan(self.table, ValueComp(BinOp.LT, 0, 0))
+        for agg in (HashAggregate, StreamAggregate):
+            self.assertEqual(list(agg(Scan(self.table), (), aggs).exec()), [total])
+            self.assertEqual(list(agg(empty, (), aggs).exec()), [none])
+        partial = HashAggregate(empty, (), aggs, partial=True)
+        for expr in (partial, empty):
+            self.assertEqual(list(FinalAggregate(expr, 0, aggs).exec()), [none])
+        with self.assertRaises(ValueError):
+            list(HashAggregate(Scan(self.table), (), [Aggregation(AggFunc.SUM)]).exec())
+
+    def test_plan_aggregate(self):
+        index = self.table.create_index(IndexDef(("age",), kind=IndexKind.SORTED))
+        self.table.insert_many([(0, "a", 20), (1, "b", 21), (2, "c", 20)])
+        count = Select((Aggregate("count"),), From("students"))
+        self.assertEqual(self.planner.plan(count), TableCount(self.table))
+        self.assertEqual(list(self.planner.plan(count).exec()), [(3,)])
+        old = Where(BinExpr(">=", Symbol("age"), Const(20)))
+        query = Select(("age", Aggregate("MIN", "name")), From("students"), old)
+        query.group_by = ("age",)
+        plan = self.planner.plan(query)
+        scan = IndexRangeScan(self.table, index, 20)
+        self.assertEqual(
+            plan, StreamAggregate(scan, (2,), [Aggregation(AggFunc.MIN, 1)])
+        )
+        self.assertEqual(list(plan.exec()), [(20, "a"), (21, "b")])
+        query.where_clause = None
+        query.order_by = OrderBy(("age",), descending=True)
+        query.exprs = (Aggregate("COUNT"), "age")
+        plan = self.planner.plan(query)
+        aggregate = HashAggregate(Scan(self.table), (2,), [Aggregation(AggFunc.COUNT)])
+        self.assertEqual(plan, ColumnProjection(Sort(aggregate, (0,), True), (1, 0)))
+        self.assertEqual(list(plan.exec()), [(1, 21), (2, 20)])
+        bad = [
+            ("name", Aggregate("COUNT")),
+            (Aggregate("MEDIAN", "age"),),
+            (Aggregate("SUM"),),
+            (Aggregate("SUM", "x"),),
+        ]
+        for exprs in bad:
+            with self.assertRaises(ValueError):
+                self.planner.plan(Select(exprs, From("students")))
+        query.order_by = OrderBy(("name",))
+        with self.assertRaises(ValueError):
+            self.planner.plan(query)
+
+    def test_limit(self):
+        self.table.insert_many([(x, "s" + str(x % 4), x % 30) for x in range(100)])
+        read = []
+
+        class Counted(Scan):
+            def exec_batches(self, size):
+                for batch in super().exec_batches(size):
+                    read.extend(batch)
+                    yield batch
+
+        old = ValueComp(BinOp.GT, 2, 20)
+        rows = [row for row in self.table.rows() if row[2] > 20]
+        for limit, offset in [(5, 0), (5, 7), (0, 3), (None, 90), (30, 10)]:
+            read.clear()
+            plan = Limit(Filter(Counted(self.table), old), limit, offset)
+            end = None if limit is None else offset + limit
+            self.assertEqual(list(plan.exec()), rows[offset:end])
+            if end is not None and end < len(rows):
+                self.assertLess(len(read), 100)  # stopped early
+
+        query = Select(("id",), From("students"), limit=3, offset=2)
+        plan = self.planner.plan(query)
+        self.assertEqual(plan, Limit(ColumnProjection(Scan(self.table), (0,)), 3, 2))
+        self.assertEqual(list(plan.exec()), [(2,), (3,), (4,)])
+        query.order_by = OrderBy(("age", "id"), descending=True)
+        plan = self.planner.plan(query)
+        self.assertEqual(plan.expr.expr.limit, 5)
+        self.assertEqual(list(plan.exec()), [(29,), (88,), (58,)])
+        query.limit = -1
+        with self.assertRaises(ValueError):
+            self.planner.plan(query)
+
+    def test_plan_merge_join(self):
+        table2 = MemTable(
+            Schema("signups", Column("sid", DataType.INT), Column("ts", DataType.INT))
+        )
+        planner = SimplePlanner({"students": self.table, "signups": table2})
+        query = Select(
+            ("students.name", "signups.ts"),
+            From(
+                Join(
+                    ("students", "signups"),
+                    On(BinExpr("=", Symbol("students.age"), Symbol("signups.sid"))),
+                )
+            ),
+        )
+        index2 = table2.create_index(IndexDef(("sid",), kind=IndexKind.SORTED))
+        self.assertIsInstance(planner.plan(query).expr, IndexedJoin)
+        index1 = self.table.create_index(IndexDef(("age",), kind=IndexKind.SORTED))
+        plan = planner.plan(query)
+        expected = MergeJoin(
+            IndexRangeScan(self.table, index1), IndexRangeScan(table2, index2), 2, 0
+        )
+        self.assertEqual(plan.expr, expected)
+        self.table.insert_many([(0, "a", 20), (1, "b", 21), (2, "c", 20)])
+        table2.insert_many([(21, 100), (20, 101), (22, 102), (20, 103)])
+        rows = [("a", 101), ("a", 103), ("c", 101), ("c", 103), ("b", 100)]
+        self.assertEqual(list(plan.exec()), rows)
+        query.order_by = OrderBy(("signups.ts", "students.name"), descending=True)
+        rows.sort(key=lambda row: (row[1], row[0]), reverse=True)
+        self.assertEqual(list(planner.plan(query).exec()), rows)
+
     @unittest.skip
     def test_join_where(self):
         raise NotImplementedError()
+
+    def test_exec_batches(self):
+        signups = MemTable(
+            Schema("signups", Column("sid", DataType.INT), Column("ts", DataType.INT))
+        )
+        self.table.insert_many([(x, "s" + str(x % 3), 20 + x % 5) for x in range(50)])
+        signups.insert_many([(x % 7, x) for x in range(30)])
+        young = ValueComp(BinOp.LT, 2, 23)
+        cond = Conjunction([young, Negation(ValueComp(BinOp.EQ, 1, "s1"))])
+        exprs = [
+            Scan(self.table),
+            FilteredScan(self.table, young),
+            FilteredScan(self.table, cond),
+            Filter(Scan(self.table), Disjunction([young, ColumnComp(BinOp.GT, 0, 2)])),
+            ColumnProjection(FilteredScan(self.table, cond), (1, 0)),
+            ColumnProjection(Scan(self.table), (2,)),
+            HashJoin(Scan(self.table), Scan(signups), 0, 0),
+            IndexedLookup(self.table, self.table.indexes("id")[0], 3),
+        ]
+        for expr in exprs:
+            rows = list(expr.exec())
+            self.assertTrue(rows)
+            for size in (1, 4, 1000):
+                batches = list(expr.exec_batches(size))
+                self.assertTrue(all(0 < len(batch) <= size for batch in batches))
+                self.assertEqual(list(unbatched(batches)), rows)
+        with self.assertRaises(ValueError):
+            next(Scan(self.table).exec_batches(0))
+
+
+class CostBasedPlannerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = MemTable(students)
+        self.table.insert_many([(x, "s" + str(x % 10), x % 50) for x in range(1000)])
+        self.ages = self.table.create_index(IndexDef(("age",), kind=IndexKind.SORTED))
+        self.signups = MemTable(
+            Schema("signups", Column("sid", DataType.INT), Column("ts", DataType.INT))
+        )
+        self.signups.insert_many([(x, x) for x in range(1000)])
+        self.signups.create_index(IndexDef(("sid",)))
+        self.tables = {"students": self.table, "signups": self.signups}
+        stats = {name: analyze(table) for name, table in self.tables.items()}
+        self.planner = CostBasedPlanner(self.tables, stats)
+
+    def plan(self, cond):
+        return self.planner.plan(
+            Select(students.column_names(), From("students"), Where(cond))
+        )
+
+    def test_scan_or_index(self):
+        age = Symbol("age")
+        few = BinExpr("<", age, Const(5))
+        expected = IndexRangeScan(self.table, self.ages, high=5, high_inclusive=False)
+        self.assertEqual(self.plan(few), expected)
+        many = BinExpr("<", age, Const(45))
+        expected = FilteredScan(self.table, ValueComp(BinOp.LT, 2, 45))
+        self.assertEqual(self.plan(many), expected)
+        # without stats the index is always used
+        simple = SimplePlanner(self.tables)
+        query = Select(students.column_names(), From("students"), Where(many))
+        self.assertIsInstance(simple.plan(query), IndexRangeScan)
+        self.assertEqual(
+            self.plan(BinExpr("=", Symbol("id"), Const(3))),
+            IndexedLookup(self.table, self.table.indexes("id")[0], 3),
+        )
+
+    def test_predicate_order(self):
+        cond = BinExpr(
+            "AND",
+            BinExpr(">", Symbol("age"), Const(10)),
+            BinExpr("=", Symbol("name"), Const("s1")),
+        )
+        expected = FilteredScan(
+            self.table,
+            Conjunction([ValueComp(BinOp.EQ, 1, "s1"), ValueComp(BinOp.GT, 2, 10)]),
+        )
+        self.assertEqual(self.plan(cond), expected)
+
+    def test_join(self):
+        def plan(planner):
+            on = On(BinExpr("=", Symbol("students.id"), Symbol("signups.sid")))
+            join = Join(("students", "signups"), on, JoinKind.INNER)
+            return planner.plan(Select(("students.name",), From(join))).expr
+
+        # probing the index for every student costs more than hashing
+        self.assertIsInstance(plan(self.planner), HashJoin)
+        self.assertIsInstance(plan(SimplePlanner(self.tables)), IndexedJoin)
+        few = MemTable(students)
+        few.insert_many([(x, "s", 20) for x in range(10)])
+        tables = dict(self.tables, students=few)
+        stats = {name: analyze(table) for name, table in tables.items()}
+        self.assertIsInstance(plan(CostBasedPlanner(tables, stats)), IndexedJoin)
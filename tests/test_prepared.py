@@ -0,0 +1,142 @@
+from . import context
+from .base import STUDENTS_SCHEMA
+import unittest
+from pydb.expr import BinOp, FilteredScan, IndexedLookup, ValueComp
+from pydb.index import IndexKind
+from pydb.mem import MemDatabase, MemTable
+from pydb.pipeline import compile_pipeline
+from pydb.plan import SimplePlanner
+from pydb.prepared import PlanCache, binder, parameterize
+from pydb.query import (
+    BinExpr,
+    Const,
+    CreateIndex,
+    CreateTable,
+    From,
+    InsertMany,
+    Not,
+    Param,
+    Select,
+    Symbol,
+    Where,
+)
+from pydb.table import IndexDef
+
+
+def select(cond):
+    return Select(("id",), From("students"), Where(cond))
+
+
+class PreparedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.students = MemTable(STUDENTS_SCHEMA)
+        self.students.insert_many(
+            [(x, "s" + str(x % 4), 20 + x % 10) for x in range(40)]
+        )
+
+    def test_parameterize(self):
+        cond = BinExpr(
+            "OR",
+            BinExpr("=", Const("s1"), Symbol("name")),
+            Not(
+                BinExpr(
+                    "AND",
+                    BinExpr("=", Symbol("id"), Param(0)),
+                    BinExpr("<", Symbol("age"), Const(25)),
+                )
+            ),
+        )
+        shape, values, params = parameterize(select(cond))
+        self.assertEqual((values, params), (["s1"], 1))
+        expected = BinExpr(
+            "OR",
+            BinExpr("=", Param(1), Symbol("name")),
+            Not(
+                BinExpr(
+                    "AND",
+                    BinExpr("=", Symbol("id"), Param(0)),
+                    BinExpr("<", Symbol("age"), Const(25)),  # ranges are kept
+                )
+            ),
+        )
+        self.assertEqual(shape, select(expected))
+        other = BinExpr("OR", BinExpr("=", Const("s2"), Symbol("name")), cond.right)
+        self.assertEqual(repr(parameterize(select(other))[0]), repr(shape))
+        query = Select(("id",), From("students"))
+        self.assertEqual(parameterize(query), (query, [], 0))
+
+    def test_bind(self):
+        index = self.students.create_index(IndexDef(("name",)))
+        planner = SimplePlanner({"students": self.students})
+        cond = BinExpr(
+            "AND",
+            BinExpr("=", Symbol("name"), Param(0)),
+            BinExpr(">", Param(1), Symbol("age")),
+        )
+        plan = compile_pipeline(planner.plan(select(cond)))
+        bind = binder(plan)
+        for name, age in (("s1", 22), ("s2", 23)):
+            expected = [(x,) for x in range(40) if x % 4 == int(name[1])]
+            expected = [(x,) for (x,) in expected if 20 + x % 10 < age]
+            self.assertEqual(list(bind((name, age)).exec()), expected)
+        bound = bind(("s1", 22))
+        self.assertIn("Param(index=0)", repr(plan))  # the plan is unchanged
+        lookup = bound.expr.expr
+        self.assertIsInstance(lookup, IndexedLookup)
+        self.assertEqual((lookup.index, lookup.key), (index, "s1"))
+
+        scan = FilteredScan(self.students, ValueComp(BinOp.EQ, 0, 3))
+        self.assertIs(binder(scan)(()), scan)
+
+    def test_range_params(self):
+        self.students.create_index(IndexDef(("age",), kind=IndexKind.SORTED))
+        planner = SimplePlanner({"students": self.students})
+        cond = BinExpr(
+            "AND",
+            BinExpr(">=", Symbol("age"), Param(0)),
+            BinExpr(">", Symbol("age"), Const(27)),
+        )
+        bind = binder(planner.plan(select(cond)))
+        for low in (20, 29):
+            expected = [(x,) for x in range(40) if 20 + x % 10 >= max(low, 28)]
+            self.assertEqual(sorted(bind((low,)).exec()), expected)
+
+    def test_plan_cache(self):
+        cache = PlanCache(2)
+        plans = [
+            FilteredScan(self.students, ValueComp(BinOp.EQ, 0, x)) for x in range(3)
+        ]
+        self.assertIs(cache.get("a", lambda: plans[0])(()), plans[0])
+        self.assertIs(cache.get("a", lambda: plans[1])(()), plans[0])
+        cache.get("b", lambda: plans[1])
+        cache.get("a", lambda: plans[2])
+        cache.get("c", lambda: plans[2])  # evicts b, used least recently
+        self.assertIs(cache.get("a", lambda: plans[2])(()), plans[0])
+        self.assertIs(cache.get("b", lambda: plans[2])(()), plans[2])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (3, 4, 2))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        with self.assertRaises(ValueError):
+            PlanCache(0)
+
+    def test_invalidate(self):
+        db = MemDatabase("test")
+        db.exec(CreateTable(STUDENTS_SCHEMA))
+        db.exec(CreateIndex("students", ("age",), kind=IndexKind.SORTED))
+        statement = db.prepare(select(BinExpr("=", Symbol("name"), Param(0))))
+        list(statement.exec("s1"))
+        list(statement.exec("s2"))
+        self.assertEqual((db._plans.hits, db._plans.misses), (1, 1))
+        db.exec(CreateIndex("students", ("name",)))
+        list(statement.exec("s1"))
+        self.assertEqual(db._plans.misses, 2)
+        # replanned once the table is about 2x as large
+        db.exec(InsertMany("students", ("id", "name", "age"), [(0, "s0", 20)]))
+        list(statement.exec("s1"))
+        self.assertEqual(db._plans.misses, 3)
+        db.exec(InsertMany("students", ("id", "name", "age"), [(1, "s1", 20)]))
+        list(statement.exec("s1"))
+        self.assertEqual(db._plans.misses, 4)
+        db.exec(InsertMany("students", ("id", "name", "age"), [(2, "s1", 20)]))
+        list(statement.exec("s1"))
+        self.assertEqual((db._plans.hits, db._plans.misses), (2, 4))
@@ -0,0 +1,63 @@
+from . import context
+from .base import STUDENTS_SCHEMA
+import unittest
+from pydb.mem import MemTable
+from pydb.query import Param
+from pydb.stats import ColumnStats, analyze
+
+
+class StatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = MemTable(STUDENTS_SCHEMA)
+        self.table.insert_many(
+            [(x, "s" + str(x % 10), x % 50 if x % 4 else None) for x in range(2000)]
+        )
+
+    def test_analyze(self):
+        stats = analyze(self.table)
+        self.assertEqual(stats.rows, 2000)
+        ids, names, ages = (stats.columns[name] for name in ("id", "name", "age"))
+        self.assertEqual((ids.distinct, ids.null_frac), (2000, 0.0))
+        self.assertEqual((ids.bounds[0], ids.bounds[-1]), (0, 1999))
+        self.assertEqual(len(ids.bounds), 33)
+        self.assertEqual(names.distinct, 10)
+        self.assertEqual(ages.null_frac, 0.25)
+        # sampled, distinct values are estimated
+        sampled = analyze(self.table, sample_size=500)
+        self.assertEqual(sampled.rows, 2000)
+        self.assertLess(abs(sampled.columns["id"].distinct - 2000), 400)
+        self.assertEqual(sampled.columns["name"].distinct, 10)
+        self.assertLess(abs(sampled.columns["age"].null_frac - 0.25), 0.1)
+
+    def test_selectivity(self):
+        ages = analyze(self.table).columns["age"]
+        cases = [
+            ("=", 10, 0.75 / 37),  # odd ages are never null, even ones every other
+            ("=", 100, 0.0),
+            ("<", 0, 0.0),
+            ("<=", 49, 0.75),
+            (">", 49, 0.0),
+            ("<", 25, 0.375),
+            (">=", 25, 0.375),
+            ("=", None, 0.0),
+            ("<", "a", 0.0),
+            ("=", Param(0), 0.75 / 50),  # any value: an average one
+            (">=", Param(0), 0.75 / 3),
+        ]
+        for op, value, expected in cases:
+            with self.subTest(op=op, value=value):
+                self.assertAlmostEqual(
+                    ages.selectivity(op, value), expected, delta=0.04
+                )
+        self.assertEqual(ColumnStats(0, 1.0, []).selectivity("=", 1), 0.0)
+
+    def test_add(self):
+        stats = analyze(self.table)
+        stats.add(STUDENTS_SCHEMA, [(x, None, 100) for x in range(2000, 4000)])
+        self.assertEqual(stats.rows, 4000)
+        ids, names, ages = (stats.columns[name] for name in ("id", "name", "age"))
+        self.assertEqual((ids.distinct, ids.bounds[-1]), (4000, 3999))
+        self.assertEqual((names.distinct, names.null_frac), (10, 0.5))
+        self.assertEqual(ages.null_frac, 0.125)
+        self.assertEqual(ages.bounds[-1], 100)
+        self.assertGreater(ages.selectivity(">", 49), 0)
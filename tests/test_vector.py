@@ -0,0 +1,127 @@
+from . import context
+from .base import STUDENTS_SCHEMA
+import unittest
+from pydb import vector
+from pydb.expr import (
+    AggFunc,
+    Aggregation,
+    BinOp,
+    ColumnComp,
+    ColumnProjection,
+    Conjunction,
+    Disjunction,
+    FilteredScan,
+    HashAggregate,
+    Negation,
+    Scan,
+    ValueComp,
+    unbatched,
+)
+from pydb.mem import MemTable
+
+needs_numpy = unittest.skipIf(vector.numpy is None, "numpy is not installed")
+
+
+class VectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = MemTable(STUDENTS_SCHEMA)
+        self.table.insert_many([(x, "s" + str(x % 3), 20 + x % 7) for x in range(50)])
+
+    def tearDown(self):
+        vector.ENABLED = vector.numpy is not None
+
+    def test_reduce(self):
+        values = [3, None, -1, 7]
+        self.assertEqual(vector.reduce("COUNT", values), 3)
+        self.assertEqual(vector.reduce("SUM", values), 9)
+        self.assertEqual(vector.reduce("MIN", values), -1)
+        self.assertEqual(vector.reduce("MAX", values), 7)
+        self.assertEqual(vector.reduce("COUNT", [None]), 0)
+        self.assertIsNone(vector.reduce("SUM", [None]))
+        with self.assertRaises(ValueError):
+            vector.reduce("AVG", values)
+
+    @needs_numpy
+    def test_reduce_arrays(self):
+        for values in ([3, -1, 7], [], [2**62, 2**62]):
+            array = vector.int_array(values)
+            for op in ("COUNT", "SUM", "MIN", "MAX"):
+                self.assertEqual(vector.reduce(op, array), vector.reduce(op, values))
+
+    @needs_numpy
+    def test_int_array(self):
+        self.assertEqual(vector.int_array([1, 2]).tolist(), [1, 2])
+        for values in ([1, None], [1, "2"], [True], [2**64]):
+            self.assertIsNone(vector.int_array(values))
+        self.assertEqual(vector.extend(vector.int_array([1]), [2]).tolist(), [1, 2])
+        self.assertIsNone(vector.extend(vector.int_array([1]), [None]))
+        self.assertIsNone(vector.extend(None, [2]))
+
+    @needs_numpy
+    def test_column_array(self):
+        self.assertEqual(len(self.table.column_array(0)), 50)
+        self.assertIsNone(self.table.column_array(1))
+        self.table.insert((50, "x", 99))
+        self.assertEqual(self.table.column_array(2)[-2:].tolist(), [20, 99])
+        self.table.insert((51, "y", None))
+        self.assertIsNone(self.table.column_array(2))
+        self.assertEqual(len(self.table.column_array(0)), 52)
+        vector.ENABLED = False
+        self.assertIsNone(self.table.column_array(0))
+
+    def test_exec_batches(self):
+        young = ValueComp(BinOp.LT, 2, 23)
+        conds = [
+            young,
+            Conjunction([young, Negation(ValueComp(BinOp.EQ, 0, 3))]),
+            Disjunction([young, ColumnComp(BinOp.GT, 0, 2)]),
+            ValueComp(BinOp.EQ, 1, "s1"),
+            ValueComp(BinOp.EQ, 2, "x"),
+        ]
+        exprs = [ColumnProjection(Scan(self.table), (2, 0))]
+        for cond in conds:
+            exprs.append(FilteredScan(self.table, cond))
+            exprs.append(ColumnProjection(FilteredScan(self.table, cond), (0,)))
+            exprs.append(ColumnProjection(FilteredScan(self.table, cond), (2, 1)))
+        for enabled in (False, vector.numpy is not None):
+            vector.ENABLED = enabled
+            for expr in exprs:
+                rows = list(expr.exec())
+                for size in (1, 7, 100):
+                    batches = list(expr.exec_batches(size))
+                    self.assertTrue(all(0 < len(batch) <= size for batch in batches))
+                    self.assertEqual(list(unbatched(batches)), rows)
+
+    @needs_numpy
+    def test_array_mask(self):
+        column = self.table.column_array
+        self.assertIsNotNone(ValueComp(BinOp.LT, 2, 23).array_mask(column))
+        self.assertIsNone(ValueComp(BinOp.EQ, 1, "s1").array_mask(column))
+        self.assertIsNone(ValueComp(BinOp.EQ, 2, "x").array_mask(column))
+        cond = Conjunction([ValueComp(BinOp.LT, 2, 23), ValueComp(BinOp.EQ, 1, "s1")])
+        self.assertIsNone(cond.array_mask(column))
+        scan = FilteredScan(self.table, Negation(cond.conds[0]))
+        self.assertEqual(scan.selection().tolist(), [r[0] for r in scan.exec()])
+
+    @needs_numpy
+    def test_aggregate_arrays(self):
+        aggs = [Aggregation(AggFunc.COUNT)]
+        for func in (AggFunc.COUNT, AggFunc.SUM, AggFunc.MIN, AggFunc.MAX):
+            aggs.append(Aggregation(func, 2))
+        aggs.append(Aggregation(AggFunc.AVG, 0))
+        scans = [
+            Scan(self.table),
+            FilteredScan(self.table, ValueComp(BinOp.LT, 2, 23)),
+            FilteredScan(self.table, ValueComp(BinOp.GT, 2, 99)),  # no rows
+        ]
+        for scan in scans:
+            for partial in (False, True):
+                aggregate = HashAggregate(scan, (), aggs, partial)
+                self.assertIsNotNone(aggregate._array_state())
+                rows = list(aggregate.exec())
+                vector.ENABLED = False
+                self.assertEqual(list(aggregate.exec()), rows)
+                vector.ENABLED = True
+        names = FilteredScan(self.table, ValueComp(BinOp.EQ, 1, "s1"))
+        self.assertIsNone(HashAggregate(names, (), aggs)._array_state())
+        self.assertIsNone(HashAggregate(Scan(self.table), (1,), aggs)._array_state())